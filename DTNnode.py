@@ -1,7 +1,16 @@
-import socket, time, json, os
+import socket, time, json, os, heapq, random
 from bundle import bundle
 from time_evolving_graph import time_evolving_graph
-from copy import deepcopy
+from route import route
+from route_table import route_table
+from route_cache import route_cache
+from route_file import route_file
+from send_queue import send_queue
+from bundle_store import bundle_store
+from custody_signal import custody_signal
+from metrics import metrics, timed
+from datagram_reader import datagram_reader
+from event_queue import event_queue
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 spaceAddress_file = dir_path + '/time_graphs/space_address.txt'
@@ -9,13 +18,39 @@ with open(spaceAddress_file) as f:
   a = f.read().split()
   spaceAddress = (a[0], int(a[1]))
 
+def space_addresses(data: dict) -> list[tuple[str, int]]:
+  """
+  Addresses of the shards of space for a contact plan. A plan can split space
+  in several processes with 'space_shards', which listen on consecutive ports
+  from the one in space_address.txt
+  """
+  return [(spaceAddress[0], spaceAddress[1] + i) for i in range(data.get('space_shards', 1))]
+
+def console_flags(args: list[str]) -> tuple[list[str], dict]:
+  """
+  Take the flags out of the arguments from console, wherever they are: profile,
+  and direct, with an optional loss probability (as direct=0.1). Returns the
+  rest of the arguments, and the flags
+  """
+  flags = {'profile': False, 'direct': False, 'loss_probability': 0}
+  rest = []
+  for a in args:
+    if (a == 'profile'):
+      flags['profile'] = True
+    elif (a.split('=')[0] == 'direct'):
+      flags['direct'] = True
+      if ('=' in a): flags['loss_probability'] = float(a.split('=')[1])
+    else:
+      rest.append(a)
+  return rest, flags
+
 class DTNnode:
   """
   A class for creating a Delay-Tolerant Network Node,
   made for satellite networks in mind.
   """
 
-  def __init__(self, id: str, n_priorities: int) -> None:
+  def __init__(self, id: str, n_priorities: int, sockets: bool = True) -> None:
     """
     A class for creating a Delay-Tolerant Network Node,
     made for satellite networks in mind.
@@ -27,32 +62,103 @@ class DTNnode:
 
     n_priorities: int
       Number of priorities the bundles can have
+
+    sockets: bool
+      Whether to open the sockets of the node. Nodes driven by the
+      simulator don't use the network, so they don't need them
     """
 
     self.id = id              # Id for identifying the node
-    self.socketRecv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)   # sockets for receiving and
-    self.socketSend = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)   # sending messages
+    self.socketRecv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if sockets else None  # sockets for receiving and
+    self.socketSend = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if sockets else None  # sending messages
     self.address = None       # Satellite node
     self.contact_plan = None  # Contact plan
     self.address_list = {}    # Dictionary of the different addresses of the other nodes
-    self.route_list = {}      # List of route lists for the other nodes
+    self.space_list = [spaceAddress]  # Addresses of the shards of space
+    self.reader = None        # Reads the datagrams of the receiving socket into a buffer allocated once
+    self.timeout = None       # Timeout of the receiving socket, shortened while the outbox has something due sooner
+    self.direct = False       # Send straight to the next hop, waiting the distance in the node, instead of through space
+    self.loss_probability = 0 # When sending straight, probability of losing what is sent, for each second it travels
+    self.outbox = event_queue()   # What is sent straight, waiting until it reaches its next hop (by monotonic time)
+    self.route_list = route_cache(self.compute_routes)   # Routes to the other nodes, expired ones are evicted
     self.limbo_list = []      # List of bundles thtat didn't have a route
+    self.next_expiry = None   # Earliest deadline of the bundles held (or of some that already left), None if none expires
+    self.contact_booked = {}  # Bytes booked on each contact (by index in the contact plan) by the queued bundles
     self.time_graph = None    # Stores the time graph
+    self.route_table = route_table()  # Routes known by id, shared with the time graph when there is one
+    self.route_file = None    # Binary route table the routes are decoded from, when the node starts from one
+    self.verbose = True       # Print what the node is doing
+    self.binary = True        # Send bundles in the binary wire format, or else in the text one
+    self.store = None         # Bundle store where the queued and limbo bundles are kept on disk, if any
+    self.fragments = {}       # Fragments that reached this node, and the ranges of payload they cover, by (source, fragment id)
+    self.custody_list = {}    # Bundles sent with custody, waiting for the next node to accept them, by custody id
+    self.custody_timers = []  # Min-heap of (retransmission time, custody id) of the bundles in custody_list
+    self.next_custody_id = 1  # Custody id given to the next bundle sent with custody
+    self.accepted = {}        # Custody ids accepted from each custodian, and the distance to it, not signalled yet
+    self.signal_time = None   # When the accepted custody ids are signalled
+    self.signal_delay = 1     # Seconds accepted custody ids wait, so a single signal acknowledges many bundles
 
     self.n_priorities = n_priorities
-    # Dictionary for storing all the messages that have to be sent when available, stored by priority
-    self.send_queue = {}
-    for p in range(n_priorities, 0, -1):
-      self.send_queue[p] = []
+    # Queues for storing all the messages that have to be sent when available, by priority
+    self.send_queue = send_queue(n_priorities)
+
+    # Counters and latencies of the node. Gauges are only read when a snapshot is taken
+    self.metrics = metrics()
+    for p in range(1, n_priorities + 1):
+      self.metrics.gauge('queue.' + str(p), lambda p=p: len(self.send_queue[p]))
+    self.metrics.gauge('limbo', lambda: len(self.limbo_list))
+    self.metrics.gauge('custody', lambda: len(self.custody_list))
+    self.metrics.gauge('fragments', lambda: len(self.fragments))
 
     # For counting how many seconds have passed since the creation of the node
     self.start_time = time.time()
 
 
+  def open_store(self, directory: str) -> int:
+    """
+    Keep the bundles of the node (queued or in limbo) in a bundle store on disk.
+    Bundles stored by a previous run of the node are recovered and put in limbo,
+    so they are routed again from the current contact plan. Returns how many
+    bundles were recovered
+    """
+    self.store = bundle_store(directory)
+    recovered = list(self.store.bundles())
+    self.limbo_list.extend(recovered)
+    if (recovered): self.log(len(recovered), 'bundles recovered from the bundle store.')
+    return len(recovered)
+
+  def hold(self, bundle: bundle) -> None:
+    """
+    The node keeps a bundle, in queue or limbo. It is stored if there is a store
+    """
+    if (self.store is not None): self.store.put(bundle)
+    deadline = bundle.get_deadline()
+    if (deadline != -1 and (self.next_expiry is None or deadline < self.next_expiry)): self.next_expiry = deadline
+
+  def release(self, bundle: bundle) -> None:
+    """
+    The bundle left the node (sent or discarded). It is removed from the store
+    """
+    if (self.store is not None and bundle.store_key is not None): self.store.delete(bundle)
+
+  def open_metrics(self, snapshot_file: str, profile: bool = False) -> None:
+    """
+    Write the metrics of the node to a snapshot file every few seconds. With
+    profile, the routing of bundles is also profiled
+    """
+    self.metrics.export(snapshot_file, profile)
+
+  def log(self, *args) -> None:
+    """
+    Print a message about what the node is doing, only if it is verbose
+    """
+    if (self.verbose): print(*args)
+
   def settimeout(self, timeout: float) -> None:
     """
     Sets the timeout of the receiving socket of the node
     """
+    self.timeout = timeout
     self.socketRecv.settimeout(timeout)
 
   def bind(self, address: tuple[str, int]) -> None:
@@ -62,6 +168,15 @@ class DTNnode:
     self.address = address
     self.socketRecv.bind(self.address)
 
+  def space_address(self, next_hop: str) -> tuple[str, int]:
+    """
+    Address of the shard of space that carries what goes to a node. Each next hop
+    has its own shard, by its index in the contact plan, so what goes to a node
+    always takes the same way
+    """
+    if (len(self.space_list) == 1): return self.space_list[0]
+    return self.space_list[self.time_graph.labels[next_hop] % len(self.space_list)]
+
   def get_address(self, id: str) -> tuple[str, int]:
     """
     Get address corresponding to node id
@@ -81,36 +196,151 @@ class DTNnode:
       # Read data and assign it to the satellite
       data = json.load(f)
       self.time_graph = time_evolving_graph(data['labels'], data['edges'], data['start_time'], data['end_time'])
+      self.route_table = self.time_graph.route_table
       for address in data['addresses']:
         a = data['addresses'][address]
         self.address_list[address] = tuple(a)
+      self.space_list = space_addresses(data)
     f.close()
 
+  def share_time_graph(self, time_graph: time_evolving_graph, address_list: dict, space_list: list = None) -> None:
+    """
+    Use a time graph, and the addresses of the nodes and of space, that other
+    nodes of the same process also use. The contact plan, its contact graph
+    and the route table are then built only once
+    """
+    self.time_graph = time_graph
+    self.route_table = time_graph.route_table
+    self.address_list = address_list
+    if (space_list is not None): self.space_list = space_list
+
   def create_route_list(self, destination: str, current_time: int, K: int = 0, limbo: bool = False) -> None:
     """
-    Create route list based on a contact graph
+    Create route list based on the contact graph.
+    Only the first K routes (in order of arrival time) from current_time are computed,
+    K=0 means all
     """
-    g = self.time_graph.to_contact_graph(self.id, destination)
-    self.route_list[destination] = g.get_routes(K)
+    self.route_list.K = K
+    self.route_list[destination] = self.time_graph.get_routes(self.id, destination, K, current_time)
     # When contact plan changes, check if now limbo can send
     if (limbo): self.limbo_to_queue(current_time)
 
+  def create_route_lists(self, current_time: int, K: int = 0, limbo: bool = False) -> None:
+    """
+    Create the route lists to all other nodes. The contact graph is shared
+    between all destinations, and the best routes come from a single route tree
+    """
+    self.route_list.K = K
+    self.route_list.update(self.time_graph.get_all_routes(self.id, K, current_time))
+    # When contact plan changes, check if now limbo can send
+    if (limbo): self.limbo_to_queue(current_time)
+
+  def compute_routes(self, destination: str, current_time: float) -> list:
+    """
+    Compute the routes to a destination from current_time, when the route list runs low
+    """
+    # Routes of a route table file are only decoded the first time they are needed
+    if (self.route_file is not None and destination not in self.route_list):
+      routes = [self.route_table.intern(r) for r in self.route_file.routes(self.id, destination)]
+      if (not routes or any(route_cache.expiry_time(r) > current_time for r in routes)):
+        return routes
+    if (self.time_graph is None): return []
+    return self.time_graph.get_routes(self.id, destination, self.route_list.K, current_time)
+
+  def refresh_route_lists(self, current_time: float) -> None:
+    """
+    Forget the routes that can no longer be used, and check if the limbo can send.
+    New routes are computed for the destinations that run low on them
+    """
+    self.route_list.prune(current_time)
+    self.route_table.prune(current_time)
+    if (self.limbo_list): self.limbo_to_queue(current_time)
+
+  def apply_contact_delta(self, delta: list, current_time: float, K: int = 0) -> set:
+    """
+    Apply a list of changes to the contact plan of the node (added, shortened or
+    cancelled contacts, see time_evolving_graph.apply_delta) and update only the
+    routes they affect. Returns the destinations whose routes changed
+    """
+    changed = self.time_graph.apply_delta(delta)
+    return self.update_routes(changed, current_time, K)
+
+  def update_routes(self, contacts: set, current_time: float, K: int = 0) -> set:
+    """
+    The given contacts of the plan changed. Routes are only computed again for the
+    destinations that had routes through them, or that can get better routes through them.
+    Queued bundles going through them search a new route, and the limbo is only
+    checked for the destinations whose routes changed. Returns those destinations
+    """
+    contacts = set(contacts)
+    self.route_list.K = K
+    # A route table file doesn't know about the changes
+    self.route_file = None
+    affected = {d for d, routes in self.route_list.items()
+                if any(not contacts.isdisjoint(r.contacts or ()) for r in routes)}
+    # New routes through the contacts only matter if they would be among the first K
+    for d, arrival in self.time_graph.arrivals_through(self.id, list(contacts), current_time).items():
+      if (d == self.id): continue
+      routes = self.route_list.get(d, [])
+      if (K == 0 or len(routes) < K or arrival < routes[-1].total_time):
+        affected.add(d)
+    for d in affected:
+      self.route_list[d] = self.time_graph.get_routes(self.id, d, K, current_time)
+
+    # Queued bundles that still have to go through a changed contact lose their route
+    rerouted = self.send_queue.remove_if(
+      lambda b: not contacts.isdisjoint((b.get_route().contacts or ())[b.hop-1:]))
+    for b in rerouted:
+      self.book_volume(b, 1)
+      b.set_route(None)
+      b.set_next_hop(None)
+    limbo = [b for b in self.limbo_list if b.get_dest() in affected]
+    self.limbo_list = [b for b in self.limbo_list if b.get_dest() not in affected]
+    self.add_batch_to_queue(rerouted + limbo, current_time)
+    return affected
+
   def update_route_list(self, new_list_directory: str) -> None:
     """
     Update route list with a new one.
-    Route list file path is required.
+    Route list file path is required. Files made by compile_routes.py have
+    the routes under 'routes', along with the K they were computed with.
+    In older files, every key except 'addresses' is a destination.
+    Binary route tables (.rt) are also accepted
     """
+    if (new_list_directory.split('.')[-1] == 'rt'):
+      self.load_route_file(new_list_directory)
+      return
     # Open file and read it
     with open(new_list_directory) as f:
       # Check file extension
       if (new_list_directory.split('.')[-1] != 'json'):
         raise TypeError('File is not .json')
       data = json.load(f)
-      self.address_list = data['addresses']
-      self.route_list = {k: v for k, v in data.items() if k !='addresses'}
+      self.address_list = {k: tuple(v) for k, v in data['addresses'].items()}
+      routes = data['routes'] if 'routes' in data else {k: v for k, v in data.items() if k != 'addresses'}
+      self.route_list = route_cache(self.compute_routes)
+      self.route_list.K = data.get('K', 0)
+      self.route_list.update({k: [self.route_table.intern(r) for r in v] for k, v in routes.items()})
     f.close()
 
-  def is_candidate_route(self, bundle: bundle, route: dict, current_time: float) -> float:
+  def load_route_file(self, file_path: str) -> None:
+    """
+    Start from a binary route table, made by compile_routes.py. The file is
+    memory-mapped, and the routes to each destination are only decoded when
+    a bundle goes there for the first time
+    """
+    self.share_route_file(route_file(file_path))
+    self.address_list.update(self.route_file.addresses())
+
+  def share_route_file(self, file: route_file) -> None:
+    """
+    Start from a binary route table that is already open, and may be shared with other nodes
+    """
+    self.route_file = file
+    self.route_list = route_cache(self.compute_routes)
+    self.route_list.K = file.K
+
+  def is_candidate_route(self, bundle: bundle, route: route, current_time: float) -> float:
     """
     Checks if a given route is a plausible candidate for the bundle.
     If all passed, return Projected Arrival Time (PAT)
@@ -123,27 +353,67 @@ class DTNnode:
 
       # 2. Bundle deadline is before it can reach destination
       # Deadline <= Best Delivery Time (BDT)
-      if (deadline <= current_time + route['total_time']): return -1
+      if (deadline <= current_time + route.total_time): return -1
 
     # 3. Based on queue, check whether the route will be available when it reaches the front
     # Route End Time <= Earliest Transmission Opportunity (ETO)
-    queue_available_time = 0
-    for hops in route['path'].split()[1:]:
-      queue_available_time = max(queue_available_time, current_time, route['start_time'][hops])
-      for b in self.send_queue[bundle.priority]:
-        queue_available_time = max(queue_available_time, b.route['start_time'][b.next_hop])
-      if (route['end_time'][hops] <= queue_available_time): return -1
+    pat = self.route_pat(route, bundle.priority, current_time)
+    if (pat == -1): return -1
 
     # 4. Based on queue, check if it can reach destination on time
     # Deadline <= Projected Arrival Time (PAT)
-    if (deadline != -1 and deadline <= queue_available_time + route['total_time']): return -1
+    if (deadline != -1 and deadline <= pat): return -1
 
     # 5. The bundle size is less than the route volume
-    for hops in route['path'].split()[1:]:
-      if (bundle.get_size() > (int(route['rate']) * (int(route['end_time'][hops]) - int(route['start_time'][hops])))): return -1
+    if (not self.fits_volume(bundle, route)): return -1
 
     # Passed all checks yay!
-    return queue_available_time + route['total_time']
+    return pat
+
+  def route_pat(self, route: route, priority: int, current_time: float) -> float:
+    """
+    Projected Arrival Time (PAT) of a route for a bundle of the given priority, based
+    on the queue. -1 if a contact of the route ends before the bundle gets to it.
+    It doesn't depend on the bundle, so it can be shared by bundles of the same priority
+    """
+    # The backlog of the queue is kept updated by it, so it doesn't have to be searched
+    queue_available_time = self.send_queue.available_time(priority)
+    for hops in route.nodes[1:]:
+      queue_available_time = max(queue_available_time, current_time, route.start_time[hops])
+      if (route.end_time[hops] <= queue_available_time): return -1
+    return queue_available_time + route.total_time
+
+  def fits_volume(self, bundle: bundle, route: route) -> bool:
+    """
+    Whether the bundle size is less than the route volume
+    """
+    return bundle.get_size() <= self.route_volume(route)
+
+  def route_volume(self, route: route) -> float:
+    """
+    Bytes a route can still carry. What is left of each contact is used,
+    after the bundles already booked on it
+    """
+    if (route.contacts is not None):
+      return min(self.residual_volume(c) for c in route.contacts)
+    return min(int(route.rate) * (int(route.end_time[hops]) - int(route.start_time[hops])) for hops in route.nodes[1:])
+
+  def residual_volume(self, contact: int) -> float:
+    """
+    Volume left in a contact, after the bundles booked on it
+    """
+    return float(self.time_graph.volumes[contact]) - self.contact_booked.get(contact, 0)
+
+  def book_volume(self, bundle: bundle, sign: int) -> None:
+    """
+    Debit (sign=-1) or credit (sign=1) the size of a bundle to the residual
+    volume of the contacts it still has to go through in its route
+    """
+    route = bundle.get_route()
+    if (route.contacts is None): return
+    # The contact to the next hop, and all the ones after it
+    for c in route.contacts[bundle.hop-1:]:
+      self.contact_booked[c] = self.contact_booked.get(c, 0) - sign * bundle.get_size()
 
   def select_best_route(self, route_list: list, pat_list: list) -> dict:
     """
@@ -163,7 +433,7 @@ class DTNnode:
 
     # 2. Least number of hops
     route_list = [route_list[i] for i in min_pat_index]
-    min_pat_routes_len = [len(r['path']) for r in route_list]
+    min_pat_routes_len = [len(r.path) for r in route_list]
     min_hop = min(min_pat_routes_len)
     min_hop_index = [idx for idx, value in enumerate(min_pat_routes_len) if value == min_hop]
     if (len(min_hop_index) == 1):
@@ -171,8 +441,7 @@ class DTNnode:
 
     # 3. The one that ends the last
     route_list = [route_list[i] for i in min_hop_index]
-    end_time_last = []
-    end_time_last.append(r['end_time'].values() for r in route_list)
+    end_time_last = [max(r.end_time.values()) for r in route_list]
     max_time_last = max(end_time_last)
     max_time_last_index = [idx for idx, value in enumerate(end_time_last) if value == max_time_last]
     return route_list[max_time_last_index[0]]
@@ -180,6 +449,7 @@ class DTNnode:
     # 4. First index, between the ones that are tied (same as 3, since the first index is selected anyway)
     # return route_list[max_time_last_index[0]]
 
+  @timed('check_routes')
   def check_routes(self, bundle: bundle, current_time: float) -> bundle | list[bundle] | None:
     """
     Check possible routes for a bundle.
@@ -188,9 +458,17 @@ class DTNnode:
     # Get bundle destination
     dest = bundle.get_dest()
 
+    # Received bundles only carry the id of their route, look it up.
+    # If it is not known by this node, a new route is searched
+    received = bundle.get_route() is None and bundle.route_id is not None
+    if (received):
+      route = self.route_table.get(bundle.route_id)
+      if (route is None): self.log('Route of the bundle is unknown, searching a new one.')
+      bundle.set_route(route)
+
     # If no route has been assigned, search one for it. If it is critical, search all possible routes
     if (bundle.get_route() is None):
-      all_routes = self.route_list[dest] # Get list of all routes (dictionaries) to the destination
+      all_routes = self.route_list.viable(dest, current_time) # Get list of all routes (dictionaries) to the destination that can still be used
       candidate_routes = []   # Where all candidate routes will be stored
       route_pats = []         # For storing the Projected Arrival Time of eaach route
       for r in all_routes:
@@ -207,76 +485,246 @@ class DTNnode:
 
       # If routes were found, search among them
       if (len(candidate_routes) > 0):
-        # If critical, send through all routes
-        if bundle.critical:
-          candidate_routes.sort(key=lambda d: d['start_time'])
+        # If critical, send through all routes. Only its source does it, a
+        # copy that is already on its way only needs a new route for itself
+        if (bundle.critical and not received):
+          # Sort them by the start of their first contact
+          candidate_routes.sort(key=lambda d: d.start_time[d.first_hop()])
           critical_list = []
-          # Return a list with bundles that will go to all routes
+          # Return a list with bundles that will go to all routes. Routes are
+          # shared, so a shallow copy of the bundle is enough
           for r in candidate_routes:
-            new_bundle = deepcopy(bundle)
+            new_bundle = bundle.copy()
             new_bundle.set_route(r)
+            new_bundle.set_next_hop(r.first_hop(), 1)
             critical_list.append(new_bundle)
           return critical_list
         else:
         # Search best route and set it to the bundle
           best_route = self.select_best_route(candidate_routes, route_pats)
           bundle.set_route(best_route)
-          bundle.set_next_hop(best_route['path'][2])
+          bundle.set_next_hop(best_route.first_hop(), 1)
       else:
-        print('No possible route found, putting bundle in limbo.')
+        self.log('No possible route found, putting bundle in limbo.')
 
     else:
-      # Check the route and get next hop
-      route_splitted = bundle.get_route()['path'].split()
-      try:
-        i = route_splitted.index(self.id)
-      except ValueError:
-        print('Current node not in route, something happened. Discarding bundle')
-        return None
+      # Check the route and get next hop. The bundle says where this node
+      # is in the path, only if it doesn't the path is searched
+      route_splitted = bundle.get_route().nodes
+      i = bundle.hop
+      if (i is None or i >= len(route_splitted) or route_splitted[i] != self.id):
+        try:
+          i = route_splitted.index(self.id)
+        except ValueError:
+          self.log('Current node not in route, something happened. Discarding bundle')
+          self.metrics.count('dropped.not_in_route')
+          return None
       # Set the next hop for the bundle
-      bundle.set_next_hop(route_splitted[i+1])
+      bundle.set_next_hop(route_splitted[i+1], i+1)
 
     return bundle
 
-  def add_to_queue(self, bundle: bundle, current_time: float) -> None:
+  def add_to_queue(self, bundle: bundle, current_time: float) -> float:
     """
-    Add a bundle to send queue of the node
+    Add a bundle to send queue of the node, and start sending the queue
+    """
+    if (self.enqueue(bundle, current_time)):
+      return self.send_bundles_in_queue(current_time)
+    return 0
+
+  def enqueue(self, bundle: bundle, current_time: float) -> bool:
+    """
+    Find a route for a bundle and add it to the send queue, or to the limbo
+    list if there is none. A bundle too big for the volume left in its routes
+    is fragmented, so what fits goes now. Returns whether something was added
+    to the queue
     """
     # If deadline already passed, discard it
     deadline = bundle.get_deadline()
     if (deadline != -1 and deadline <= current_time):
-      print("Bundle deadline already passed, discarding.")
-      return 0
+      self.log("Bundle deadline already passed, discarding.")
+      self.metrics.count('dropped.ttl')
+      self.release(bundle)
+      return False
 
-    # Check routes for the bundle and return updated bundle
-    updated_bundle = self.check_routes(bundle, current_time)
+    queued = False
+    while True:
+      # Check routes for the bundle and return updated bundle
+      updated_bundle = self.check_routes(bundle, current_time)
 
-    # Discarded bundle, continue
-    if (updated_bundle is None):
-      return 0
+      # Discarded bundle, continue
+      if (updated_bundle is None):
+        self.release(bundle)
+        return queued
 
-    # Critical bundle
-    if (type(updated_bundle) is list):
-      for b in updated_bundle:
-        self.send_queue[b.priority].append(b)
-      return self.send_bundles_in_queue(current_time)
+      # Critical bundle. The copies are kept instead of it
+      if (type(updated_bundle) is list):
+        for b in updated_bundle:
+          self.send_queue.append(b)
+          self.book_volume(b, -1)
+          self.hold(b)
+        self.release(bundle)
+        return True
 
-    # If a route was found, add it to queue
-    if (updated_bundle.get_route() is not None):
-      self.send_queue[updated_bundle.priority].append(updated_bundle)
-      # Start sending queue
-      return self.send_bundles_in_queue(current_time)
-    else:
-      # Add to limbo list
-      self.limbo_list.append(bundle)
-      return 0
+      # If a route was found, add it to queue
+      if (updated_bundle.get_route() is not None):
+        self.send_queue.append(updated_bundle)
+        self.book_volume(updated_bundle, -1)
+        self.hold(updated_bundle)
+        return True
+
+      # Too big for the volume left in its routes: the first fragment fills
+      # the best route that has room, and the rest tries again
+      split = self.fragment_to_fit(bundle, current_time)
+      if (split is None): break
+      self.log('Bundle too big for its routes, fragmenting it.')
+      self.metrics.count('fragmented')
+      self.release(bundle)
+      first, bundle = split
+      queued = self.enqueue(first, current_time) or queued
+
+    # Add to limbo list
+    self.limbo_list.append(bundle)
+    self.hold(bundle)
+    self.metrics.count('limbo.no_route')
+    return queued
+
+  def fragment_to_fit(self, bundle: bundle, current_time: float) -> tuple[bundle, bundle] | None:
+    """
+    Split a bundle that doesn't fit in the volume left in any of its routes,
+    so that its first fragment fills the best route that still has room.
+    None if it can't be fragmented, or no route can take a fragment of it
+    """
+    if (not bundle.fragment or bundle.critical): return None
+    deadline = bundle.get_deadline()
+    for pat, r in self.rank_routes(bundle.get_dest(), bundle.priority, current_time):
+      if (deadline != -1 and (deadline <= current_time + r.total_time or deadline <= pat)): continue
+      volume = int(self.route_volume(r))
+      if (bundle.fragment_overhead() < volume < bundle.get_size()): return bundle.split(volume)
+    return None
+
+  @timed('route_batch')
+  def add_batch_to_queue(self, bundles: list, current_time: float) -> float:
+    """
+    Search routes for many bundles at once, and start sending the queue.
+    Bundles that need a route are grouped by destination and priority, and the
+    routes of each group are checked only once. Routes are then given in order
+    of priority and deadline, booking the volume of the contacts as they go,
+    so the most urgent bundles get the room that is left first
+    """
+    batch = []
+    queued = False
+    for b in bundles:
+      # Critical bundles and the ones that already have a route go one by one
+      if (b.critical or b.get_route() is not None or b.route_id is not None):
+        queued = self.enqueue(b, current_time) or queued
+        continue
+      deadline = b.get_deadline()
+      if (deadline != -1 and deadline <= current_time):
+        self.log("Bundle deadline already passed, discarding.")
+        self.metrics.count('dropped.ttl')
+        self.release(b)
+        continue
+      batch.append(b)
+
+    batch.sort(key=lambda b: (-b.priority, b.get_deadline() if b.get_deadline() != -1 else float('inf')))
+    groups = {}   # Queue time, ranked routes and volume of each (priority, destination)
+    for b in batch:
+      key = (b.priority, b.get_dest())
+      available = self.send_queue.available_time(b.priority)
+      # Bundles queued before may have moved the time the queue is available
+      if (key not in groups or groups[key][0] != available):
+        ranked = self.rank_routes(b.get_dest(), b.priority, current_time)
+        groups[key] = (available, ranked, max((self.route_volume(r) for _, r in ranked), default=0))
+      # Volume only goes down while booking, so bundles bigger than what the group could carry are skipped
+      route = None
+      if (b.get_size() <= groups[key][2]):
+        route = self.first_fitting_route(b, groups[key][1], current_time)
+      if (route is None and b.fragment and groups[key][1]):
+        # It may still go in fragments
+        queued = self.enqueue(b, current_time) or queued
+        continue
+      if (route is None):
+        self.log('No possible route found, putting bundle in limbo.')
+        self.limbo_list.append(b)
+        self.hold(b)
+        self.metrics.count('limbo.no_route')
+        continue
+      b.set_route(route)
+      b.set_next_hop(route.first_hop(), 1)
+      self.send_queue.append(b)
+      self.book_volume(b, -1)
+      self.hold(b)
+      queued = True
+
+    if (queued): return self.send_bundles_in_queue(current_time)
+    return 0
 
-  def limbo_to_queue(self, current_time: float) -> None:
+  def rank_routes(self, destination: str, priority: int, current_time: float) -> list:
     """
-    Go through limbo list and check if bundles can be added to queue
+    Routes to a destination that a bundle of the given priority could take, with
+    their PAT, from best to worst. The order is the one of select_best_route
     """
-    for b in self.limbo_list:
-      self.add_to_queue(b, current_time)
+    ranked = []
+    for r in self.route_list.viable(destination, current_time):
+      pat = self.route_pat(r, priority, current_time)
+      if (pat > -1): ranked.append((pat, r))
+    # Smallest PAT, then least number of hops, then the one that ends the last
+    ranked.sort(key=lambda x: (x[0], len(x[1].path), -max(x[1].end_time.values())))
+    return ranked
+
+  def first_fitting_route(self, bundle: bundle, ranked: list, current_time: float) -> dict | None:
+    """
+    The best of the ranked routes that the bundle can take, given its deadline
+    and its size. None if there is none
+    """
+    deadline = bundle.get_deadline()
+    for pat, r in ranked:
+      if (deadline != -1 and (deadline <= current_time + r.total_time or deadline <= pat)): continue
+      if (self.fits_volume(bundle, r)): return r
+    return None
+
+  def limbo_to_queue(self, current_time: float) -> float:
+    """
+    Go through limbo list and check if bundles can be added to queue.
+    They are routed together
+    """
+    # Bundles that still have no route are added again to the list
+    limbo = self.limbo_list
+    self.limbo_list = []
+    return self.add_batch_to_queue(limbo, current_time)
+
+  def drop_expired(self, current_time: float) -> int:
+    """
+    Discard all bundles, in queue or limbo, whose deadline already passed.
+    Returns how many were discarded
+    """
+    def alive(b: bundle) -> bool:
+      deadline = b.get_deadline()
+      return deadline == -1 or deadline > current_time
+
+    # Queued bundles give back the volume they booked
+    removed = self.send_queue.remove_if(lambda b: not alive(b))
+    for b in removed:
+      self.book_volume(b, 1)
+    # The ones in limbo expired because they never found a route
+    no_route = [b for b in self.limbo_list if not alive(b)]
+    self.limbo_list = [b for b in self.limbo_list if alive(b)]
+    if (removed): self.metrics.count('dropped.ttl', len(removed))
+    if (no_route): self.metrics.count('dropped.no_route', len(no_route))
+    removed += no_route
+    for b in removed:
+      self.release(b)
+    dropped = len(removed)
+    # Bundles that expired while being reassembled won't be completed
+    for key in [k for k, (fragments, _) in self.fragments.items() if not alive(fragments[0])]:
+      del self.fragments[key]
+    if (dropped > 0): self.log(dropped, 'bundles expired, discarding.')
+    # The next one to expire, of those that are left
+    deadlines = [b.get_deadline() for queue in self.send_queue.values() for b in queue] + [b.get_deadline() for b in self.limbo_list]
+    deadlines = [d for d in deadlines if d != -1]
+    self.next_expiry = min(deadlines) if deadlines else None
+    return dropped
 
 
   def send_bundles_in_queue(self, current_time: float) -> float:
@@ -299,27 +747,47 @@ class DTNnode:
     """
     # If list is empty, do nothing
     if (not self.send_queue[priority]):
-      print("Queue list", priority, "is empty.")
+      self.log("Queue list", priority, "is empty.")
       return -1
 
     # Retrieve bundle from list
-    bundle_to_send = self.send_queue[priority][0]
-    # Check deadline and discard it if it passed
+    bundle_to_send = self.send_queue.peek(priority)
+    # Check deadline and discard it if it passed, so the rest of the queue can go on
     deadline = bundle_to_send.get_deadline()
     if (deadline != -1 and deadline <= current_time):
-      print("Bundle deadline already passed, discarding.")
-      return -1
+      self.log("Bundle deadline already passed, discarding.")
+      self.metrics.count('dropped.ttl')
+      self.book_volume(self.send_queue.popleft(priority), 1)
+      self.release(bundle_to_send)
+      return 0
+
+    route = bundle_to_send.get_route()
+    # The contact already finished, so the route is lost. Put the bundle in limbo
+    # for finding another one
+    if (route.end_time[bundle_to_send.get_next_hop()] <= current_time):
+      self.log('Contact to', bundle_to_send.get_next_hop(), 'already finished, putting bundle in limbo.')
+      self.book_volume(self.send_queue.popleft(priority), 1)
+      bundle_to_send.set_route(None)
+      bundle_to_send.set_next_hop(None)
+      self.limbo_list.append(bundle_to_send)
+      self.metrics.count('limbo.contact_ended')
+      return 0
 
-    route_start_time = bundle_to_send.get_route()['start_time'][bundle_to_send.get_next_hop()]
+    route_start_time = route.start_time[bundle_to_send.get_next_hop()]
     delta_time = route_start_time-current_time
     # Route not yet available, have to wait
     if (delta_time > 0):
-      print('Route not yet available, have to wait', str(delta_time)+'s')
+      self.log('Route not yet available, have to wait', str(delta_time)+'s')
       return delta_time
 
     # Passed all checks, delete it from the list and send
-    bundle_to_send = self.send_queue[priority].pop(0)
-    self.send(bundle_to_send)
+    bundle_to_send = self.send_queue.popleft(priority)
+    # Bundles with custody are kept until the next node accepts them
+    if (bundle_to_send.custody):
+      self.send(self.take_custody(bundle_to_send, current_time))
+    else:
+      self.send(bundle_to_send)
+      self.release(bundle_to_send)
     return 0
 
   def send(self, bundle: bundle) -> None:
@@ -327,21 +795,174 @@ class DTNnode:
     Send a bundle forward to the next hop
     """
     self.send_to_space(bundle)
-    print('Bundle forwarded to node:', bundle.get_next_hop())
+    self.metrics.count('forwarded')
+    self.log('Bundle forwarded to node:', bundle.get_next_hop())
+
+  def take_custody(self, bundle: bundle, current_time: float) -> bundle:
+    """
+    Keep a bundle sent with custody until the next node signals it accepted
+    it, and return the copy that is sent, with this node as its custodian.
+    If no signal arrives within a round trip to the next hop, plus the time
+    signals wait, the bundle is sent again
+    """
+    custody_id = self.next_custody_id
+    self.next_custody_id += 1
+    distance = bundle.get_route().distance[bundle.get_next_hop()]
+    self.custody_list[custody_id] = bundle
+    heapq.heappush(self.custody_timers, (current_time + 2 * (distance + self.signal_delay), custody_id))
+    sent_bundle = bundle.copy()
+    sent_bundle.custodian = self.id
+    sent_bundle.custody_id = custody_id
+    return sent_bundle
+
+  def accept_custody(self, bundle: bundle, current_time: float) -> None:
+    """
+    Accept custody of a bundle from the node that sent it. Its custody id is
+    signalled back along with the others accepted in the next signal_delay seconds
+    """
+    if (bundle.custodian not in self.accepted):
+      self.accepted[bundle.custodian] = (self.signal_distance(bundle.custodian, current_time), [])
+    self.accepted[bundle.custodian][1].append(bundle.custody_id)
+    if (self.signal_time is None): self.signal_time = current_time + self.signal_delay
+
+  def signal_distance(self, custodian: str, current_time: float) -> float:
+    """
+    Distance to a custodian, for its custody signal: that of the last contact
+    from it to this node that already started. Distance is the same both ways
+    """
+    graph = self.time_graph
+    if (graph is None or custodian not in graph.labels): return 0
+    contacts = graph.contacts_between(graph.labels[custodian], graph.labels[self.id])
+    started = contacts[graph.start[contacts] <= current_time]
+    if (len(started) > 0): return float(graph.distance[started[-1]])
+    return float(graph.distance[contacts[0]]) if len(contacts) > 0 else 0
+
+  def send_custody_signals(self) -> None:
+    """
+    Signal each custodian all the custody ids accepted from it
+    """
+    for custodian, (distance, ids) in self.accepted.items():
+      signal = custody_signal(self.id, custodian, ids)
+      self.send_signal(signal, custodian, distance)
+      self.metrics.count('custody.signals_sent')
+      self.log('Custody of', len(signal), 'bundles signalled to node:', custodian)
+    self.accepted = {}
+    self.signal_time = None
+
+  def send_signal(self, signal: custody_signal, custodian: str, distance: float) -> None:
+    """
+    Send a custody signal to a custodian, through space or straight to it
+    """
+    if (self.direct):
+      self.transmit(signal.to_bytes(), custodian, distance)
+      return
+    self.send_datagram(signal.to_space_bytes(self.get_address(custodian), custodian, distance), self.space_address(custodian))
+
+  def process_custody_signal(self, signal: custody_signal, current_time: float) -> None:
+    """
+    The next node accepted custody of some bundles, so this node no longer keeps them
+    """
+    released = 0
+    for custody_id in signal.ids():
+      b = self.custody_list.pop(custody_id, None)
+      if (b is None): continue
+      self.release(b)
+      released += 1
+    self.metrics.count('custody.signals_received')
+    self.metrics.count('custody.released', released)
+    self.log('Node', signal.sender, 'accepted custody of', released, 'bundles.')
+
+  def next_custody_time(self) -> float | None:
+    """
+    When custody signals must be sent, or a bundle in custody sent again.
+    None if there is nothing to do
+    """
+    # Bundles that were already accepted are removed lazily
+    while self.custody_timers and self.custody_timers[0][1] not in self.custody_list:
+      heapq.heappop(self.custody_timers)
+    times = [t for t in (self.signal_time, self.custody_timers[0][0] if self.custody_timers else None) if t is not None]
+    return min(times) if times else None
+
+  def custody_tick(self, current_time: float) -> float:
+    """
+    Send the custody signals that are due, and send again the bundles whose custody
+    signal didn't arrive in time. Return codes are the same as add_batch_to_queue
+    """
+    if (self.signal_time is not None and self.signal_time <= current_time):
+      self.send_custody_signals()
+    expired = []
+    while self.custody_timers and self.custody_timers[0][0] <= current_time:
+      _, custody_id = heapq.heappop(self.custody_timers)
+      b = self.custody_list.pop(custody_id, None)
+      if (b is not None): expired.append(b)
+    if (not expired): return 0
+    self.log(len(expired), 'bundles were not accepted in time, sending them again.')
+    self.metrics.count('custody.retransmitted', len(expired))
+    return self.add_batch_to_queue(expired, current_time)
 
   def send_to_space(self, bundle: bundle) -> None:
     """
     Send a bundle simulating the delay associated to the distance
-    that must be traveled through space
+    that must be traveled through space, by space or by the node itself
     """
     next_hop_id = bundle.get_next_hop()
+    distance = bundle.get_route().distance[next_hop_id]
+    # Without space, the node itself makes it wait
+    if (self.direct):
+      self.transmit(bundle.to_bytes() if self.binary else bundle.to_text_bytes(), next_hop_id, distance)
+      return
     dest = self.get_address(next_hop_id)
-    self.socketSend.sendto((str(bundle) + '###' + str(dest) + '###' + next_hop_id).encode(), spaceAddress)
+    self.send_datagram(bundle.to_space_bytes(dest, next_hop_id, distance, self.binary), self.space_address(next_hop_id))
+
+  def send_datagram(self, data: bytes, address: tuple[str, int]) -> None:
+    """
+    Send data through the socket of the node
+    """
+    self.socketSend.sendto(data, address)
+
+  def lost(self, distance: float) -> bool:
+    """
+    Whether something sent straight to the next hop is lost on the way. As in
+    space, the loss probability applies to each second it travels
+    """
+    if (self.loss_probability > 0 and random.random() < 1 - (1 - self.loss_probability) ** distance):
+      self.metrics.count('dropped.loss')
+      self.log('Lost on the way to the next hop.')
+      return True
+    return False
+
+  def transmit(self, data: bytes, next_hop: str, distance: float) -> None:
+    """
+    Send data straight to a node, once it has travelled the distance to it.
+    Until then it waits in the outbox, which is sent as the node goes round its loop
+    """
+    if (self.lost(distance)): return
+    self.outbox.push(time.monotonic() + distance, (data, self.get_address(next_hop)))
+
+  def recv_timeout(self) -> float:
+    """
+    How long recv waits for a datagram: the timeout of the node (a second if
+    it has none, so the alarm and the outbox are still checked), or less if
+    something in the outbox must be sent before
+    """
+    timeout = self.timeout if self.timeout is not None else 1
+    if (not self.outbox): return timeout
+    return min(timeout, max(self.outbox.peek_time() - time.monotonic(), 0.0001))
+
+  def flush_outbox(self) -> None:
+    """
+    Send everything in the outbox that already reached its next hop
+    """
+    now = time.monotonic()
+    while self.outbox and self.outbox.peek_time() <= now:
+      _, (data, address) = self.outbox.pop()
+      self.send_datagram(data, address)
 
   def recv(self, buff_size: int, current_time: float, alarm_on : bool = False, timer : int = 0) -> int:
     """
     Receives a bundle Then prints if it's destination was this node,
-    or forward it through the appropiate route
+    or forward it through the appropiate route. The ones that arrived
+    while it was being received are also taken, without waiting for more
 
     Return codes:
     - 0: Arrived to destination correctly or was forwarded to the next hop.
@@ -349,10 +970,16 @@ class DTNnode:
     - >0: No route available for bundle, have to wait.
     """
 
-    print('Node', self.id, 'waiting for message. Elapsed time: 0s')
+    if (self.reader is None or len(self.reader.buffer) != buff_size):
+      self.reader = datagram_reader(self.socketRecv, buff_size)
+
+    self.log('Node', self.id, 'waiting for message. Elapsed time: 0s')
+    start_time = time.time()
     # Main cycle of receiving
     while True:
       try:
+        # Wake up when the first in the outbox reaches its next hop, if it is sooner than the timeout
+        self.socketRecv.settimeout(self.recv_timeout())
         # Before receiving, check every second if timer expired or not
         # This only applies if alarm_on is True
         if (alarm_on):
@@ -360,26 +987,98 @@ class DTNnode:
             return -1
           timer -= self.socketRecv.gettimeout()
 
-        recv_bundle, _ = self.socketRecv.recvfrom(buff_size)
+        data = self.reader.read()
         break
       except TimeoutError:
-        print ("\033[A\033[A")
-        print('Node', self.id, 'waiting for message. Elapsed time:', str(round(time.time()-self.start_time)) + 's')
+        self.flush_outbox()
+        self.metrics.maybe_snapshot()
+        if (self.verbose):
+          print ("\033[A\033[A")
+          print('Node', self.id, 'waiting for message. Elapsed time:', str(round(time.time()-self.start_time)) + 's')
         continue
 
-    # Transform to bundle structure
-    recv_bundle = bundle.to_bundle(recv_bundle.decode())
+    # Calculate how many seconds have passed since the start of the function
+    # specially because of the while True loop
+    end_time = time.time()
+    current_time += (end_time - start_time)
+
+    timers = [self.process_datagram(data, current_time)]
+    for data in self.reader.pending():
+      timers.append(self.process_datagram(data, current_time))
+    # The earliest wait, if any of them has to wait for its route
+    waits = [t for t in timers if t > 0]
+    return min(waits) if waits else 0
+
+  def process_datagram(self, data: bytes | memoryview, current_time: float) -> int:
+    """
+    Process something that arrived to the node. Return codes are the same as recv
+    """
+    # Transform to bundle structure. Custody signals are not bundles
+    recv_bundle = self.parse(data)
+    if (type(recv_bundle) is custody_signal):
+      self.process_custody_signal(recv_bundle, current_time)
+      return 0
+
+    return self.process_bundle(recv_bundle, current_time)
+
+  def parse(self, data: bytes | memoryview) -> bundle | custody_signal:
+    """
+    Decode what arrived to the node: a custody signal, or a bundle in any of its formats
+    """
+    start = time.perf_counter()
+    parsed = custody_signal.from_bytes(data) if custody_signal.is_signal(data) else bundle.decode(data)
+    # Fragments keep their payload as a slice of the data, which may be a receive buffer that is reused
+    if (type(parsed) is bundle and parsed.is_fragment()): parsed.message = bytes(parsed.message)
+    self.metrics.observe('parse', time.perf_counter() - start)
+    return parsed
+
+  def process_bundle(self, recv_bundle: bundle, current_time: float) -> int:
+    """
+    Process a bundle that arrived to this node. If this is its destination,
+    deliver it. Else, forward it through the appropiate route.
+    Return codes are the same as recv.
+    """
+    self.metrics.count('received')
+    # Take custody from the node that sent it, it is told in the next custody signal
+    deadline = recv_bundle.get_deadline()
+    if (recv_bundle.custodian is not None and (deadline == -1 or deadline > current_time)):
+      self.accept_custody(recv_bundle, current_time)
 
     # Check destination
     if (recv_bundle.get_dest() == self.id):
-      # If it is for this node, print message
-      print('Mensaje recibido:', recv_bundle.get_message())
+      # Fragments are only delivered once the whole bundle is here
+      if (recv_bundle.is_fragment()):
+        recv_bundle = self.reassemble(recv_bundle)
+        if (recv_bundle is None): return 0
+      self.metrics.count('delivered')
+      self.deliver(recv_bundle, current_time)
       return 0
 
-    # Calculate how many seconds have passed since the start of the function
-    # specially because of the while True loop
-    end_time = time.time()
-    current_time += (end_time - self.start_time)
-
     # If it is for other node, forward it
     return self.add_to_queue(recv_bundle, current_time)
+
+  def reassemble(self, fragment: bundle) -> bundle | None:
+    """
+    Keep a fragment that reached its destination. Once the fragments of its
+    bundle cover all of its payload, returns the whole bundle
+    """
+    key = (fragment.source, fragment.fragment_id)
+    fragments, covered = self.fragments.setdefault(key, ([], []))
+    fragments.append(fragment)
+    # Ranges of the payload received, merged
+    ranges = sorted(covered + [(fragment.fragment_offset, fragment.fragment_offset + len(fragment.message))])
+    covered.clear()
+    for start, end in ranges:
+      if (covered and start <= covered[-1][1]):
+        covered[-1] = (covered[-1][0], max(covered[-1][1], end))
+      else:
+        covered.append((start, end))
+    if (covered != [(0, fragment.total_length)]): return None
+    del self.fragments[key]
+    return bundle.reassemble(fragments)
+
+  def deliver(self, recv_bundle: bundle, current_time: float) -> None:
+    """
+    A bundle reached its destination, this node. Print its message
+    """
+    print('Mensaje recibido:', recv_bundle.get_message())
@@ -0,0 +1,203 @@
+import asyncio, sys, os, time, json
+from async_satellite import async_DTNnode
+from DTNnode import space_addresses, console_flags
+from bundle import bundle
+from custody_signal import custody_signal
+from compile_routes import load_time_graph
+from route_file import route_file
+from metrics import metrics
+from launcher import launch, as_child, shard_file
+
+# For example, all the nodes of a plan, with one process per core: python3 async_host.py graph2.json 3
+# Or, in 2 processes, routing only the first 2 routes of each destination: python3 async_host.py walker66.json 3 2 2
+# Or, from a binary route table, writing the metrics of each process: python3 async_host.py graph2.json 3 0 1 graph2_routes.rt metrics_host.json
+# Or, also profiling the routing of all the nodes of each process: python3 async_host.py graph2.json 3 0 1 none metrics_host.json profile
+# Or, sending straight between nodes, without space, with a loss probability of 0.1: python3 async_host.py graph2.json 3 direct=0.1
+
+def shard_of(index: int, n_shards: int) -> int:
+  """
+  Host process of a node, given its index in the contact plan
+  """
+  return index % n_shards
+
+def host_addresses(data: dict, n_shards: int) -> dict:
+  """
+  Address of the node host of each node. Each host binds the address that
+  the contact plan gives to its first node, and all of its nodes are reached there
+  """
+  first = {}
+  for id, index in sorted(data['labels'].items(), key=lambda x: x[1]):
+    first.setdefault(shard_of(index, n_shards), tuple(data['addresses'][id]))
+  return {id: first[shard_of(index, n_shards)] for id, index in data['labels'].items()}
+
+
+class node_host(asyncio.DatagramProtocol):
+  """
+  Many DTN nodes in a single process, on one event loop and behind a
+  single socket. The nodes share the contact plan, its contact graph
+  and the route table, so they are only built once, and a route found
+  by one node is known by all the others. What arrives is handed to
+  the node it is for: bundles carry their next hop, and custody signals
+  their custodian.
+  """
+
+  def __init__(self, nodes: dict[str, async_DTNnode], profile: bool = False) -> None:
+    """
+    Many DTN nodes in a single process, behind a single socket.
+
+    Parameters
+    ----------
+    nodes : dict[str, async_DTNnode]
+      Nodes of the host, by id
+    profile : bool
+      Whether to profile the routing of the nodes. They all share the profiler
+      of the host, which is written with its metrics
+    """
+    self.nodes = nodes
+    self.transport = None
+    self.metrics = metrics(profile=profile)    # Metrics of the host, plus the queues of all its nodes
+    for node in nodes.values():
+      node.metrics.profiler = self.metrics.profiler
+    self.metrics.gauge('nodes', lambda: len(self.nodes))
+    self.metrics.gauge('queued', lambda: sum(len(n.send_queue) for n in self.nodes.values()))
+    self.metrics.gauge('limbo', lambda: sum(len(n.limbo_list) for n in self.nodes.values()))
+    self.metrics.gauge('custody', lambda: sum(len(n.custody_list) for n in self.nodes.values()))
+    self.metrics.gauge('node_counters', self.node_counters)
+
+  def node_counters(self) -> dict:
+    """
+    Counters of all the nodes, added up
+    """
+    counters = {}
+    for n in self.nodes.values():
+      for name, value in n.metrics.counters.items():
+        counters[name] = counters.get(name, 0) + value
+    return counters
+
+  def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+    """
+    The host is bound. Every node starts, sending through the same transport
+    """
+    self.transport = transport
+    for node in self.nodes.values():
+      node.connection_made(transport)
+    if (self.metrics.snapshot_file is not None):
+      asyncio.get_running_loop().call_later(self.metrics.snapshot_interval, self.snapshot_now)
+    print('Host of', len(self.nodes), 'nodes waiting for messages.')
+
+  def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+    """
+    A bundle or a custody signal arrived, hand it to its node
+    """
+    start = time.perf_counter()
+    received = custody_signal.from_bytes(data) if custody_signal.is_signal(data) else bundle.decode(data)
+    self.metrics.observe('parse', time.perf_counter() - start)
+    node = self.nodes.get(self.receiver(received))
+    if (node is None):
+      self.metrics.count('unknown_node')
+      return
+    self.metrics.count('received')
+    node.handle(received)
+
+  @staticmethod
+  def receiver(received: bundle | custody_signal) -> str:
+    """
+    Id of the node something that arrived is for. Bundles sent by a node carry
+    their next hop, and the ones sent from outside (for example, with netcat) start at their source
+    """
+    if (type(received) is custody_signal): return received.custodian
+    return received.get_next_hop() or received.source
+
+  def snapshot_now(self) -> None:
+    """
+    Write a snapshot of the metrics of the host, and schedule the next one
+    """
+    self.metrics.write_snapshot()
+    asyncio.get_running_loop().call_later(self.metrics.snapshot_interval, self.snapshot_now)
+
+  def error_received(self, exc: Exception) -> None:
+    """
+    Errors of the transport, for example when space is not running
+    """
+    print('Error on host:', exc)
+
+
+def make_host(file_path: str, n_priorities: int, K: int = 0, shard: int = 0, n_shards: int = 1, route_lists: str = None,
+              direct: bool = False, loss_probability: float = 0, profile: bool = False) -> tuple[node_host, tuple[str, int]]:
+  """
+  Create the nodes of a shard of a contact plan, sharing its time graph, and
+  their host. Routes come from route_lists if given (a binary route table, or
+  a folder with one route list per node), or else are computed. With direct,
+  nodes send straight to each other instead of through space. With profile,
+  the routing of all the nodes is profiled. Returns the host and the address it must bind
+  """
+  data, time_graph = load_time_graph(file_path)
+  addresses = host_addresses(data, n_shards)
+  space_list = space_addresses(data)
+  shared_file = route_file(route_lists) if route_lists is not None and route_lists.endswith('.rt') else None
+  nodes = {}
+  for id, index in data['labels'].items():
+    if (shard_of(index, n_shards) != shard): continue
+    node = async_DTNnode(id, n_priorities, K)
+    node.verbose = False
+    node.direct = direct
+    node.loss_probability = loss_probability
+    node.share_time_graph(time_graph, addresses, space_list)
+    if (shared_file is not None):
+      node.share_route_file(shared_file)
+      node.K = node.route_list.K
+    elif (route_lists is not None):
+      node.update_route_list(route_lists + '/' + id + '.json')
+      node.address_list = addresses
+      node.K = node.route_list.K
+    else:
+      node.create_route_lists(0, K)
+    nodes[id] = node
+  return node_host(nodes, profile), addresses[next(iter(nodes))]
+
+async def main(host: node_host, address: tuple[str, int]) -> None:
+  """
+  Bind the host and run its nodes until it is interrupted
+  """
+  loop = asyncio.get_running_loop()
+  transport, _ = await loop.create_datagram_endpoint(lambda: host, local_addr=address)
+  try:
+    await asyncio.Event().wait()
+  finally:
+    transport.close()
+    host.metrics.write_snapshot()
+
+def run_shard(file_path: str, n_priorities: int, K: int, shard: int, n_shards: int, route_lists: str = None, metrics_file: str = None,
+              direct: bool = False, loss_probability: float = 0, profile: bool = False) -> None:
+  """
+  Run one host, with its shard of the nodes of the contact plan. Each host
+  writes its metrics to its own file, with the number of the shard added
+  """
+  as_child()
+  host, address = make_host(file_path, n_priorities, K, shard, n_shards, route_lists, direct, loss_probability, profile)
+  if (metrics_file is not None):
+    host.metrics.export(shard_file(metrics_file, shard))
+  try:
+    asyncio.run(main(host, address))
+  except KeyboardInterrupt:
+    print('Host', shard, 'finished.')
+
+
+if __name__ == '__main__':
+  # Get variables from console. Flags (profile, direct) can go anywhere after the time graph
+  args, flags = console_flags(sys.argv)
+  if (len(args) < 3):
+    raise ValueError('ValueError: 2 values needed from console: time graph, amout of priority queues. Optional: K, number of processes, route lists folder or route table (or none), metrics file. Flags: profile (with a metrics file), direct[=loss_prob]')
+
+  dir_path = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+  K = int(args[3]) if len(args) > 3 else 0
+  n_shards = int(args[4]) if len(args) > 4 else os.cpu_count()
+  route_lists = dir_path + args[5] if len(args) > 5 and args[5] != 'none' else None
+  metrics_file = args[6] if len(args) > 6 else None
+  with open(dir_path + args[1]) as f:
+    n_nodes = len(json.load(f)['labels'])
+  # One host per process, and never more hosts than nodes
+  n_shards = max(1, min(n_shards, n_nodes))
+  launch(run_shard, [(dir_path + args[1], int(args[2]), K, shard, n_shards, route_lists, metrics_file, flags['direct'], flags['loss_probability'], flags['profile'])
+                     for shard in range(n_shards)])
+  print('Program finished.')
@@ -0,0 +1,210 @@
+import asyncio, sys, os
+from DTNnode import DTNnode, console_flags
+from bundle import bundle
+from custody_signal import custody_signal
+
+# For example: python3 async_satellite.py A 3 graph1.json
+# Or, with route lists made by compile_routes.py: python3 async_satellite.py A 3 graph1.json 0 graph1_routes
+# Or, keeping its bundles on disk: python3 async_satellite.py A 3 graph1.json 0 none store_A
+# Or, writing its metrics and profiling its routing: python3 async_satellite.py A 3 graph1.json 0 none none metrics_A.json profile
+# Or, sending straight to the other nodes, without space, with a loss probability of 0.1: python3 async_satellite.py A 3 graph1.json direct=0.1
+
+class async_DTNnode(DTNnode, asyncio.DatagramProtocol):
+  """
+  A DTN node that runs on an asyncio event loop. Receiving bundles,
+  waking up when a contact starts and discarding expired bundles are
+  all callbacks of the loop, so the node never blocks: a bundle is
+  forwarded as soon as its contact opens.
+  """
+
+  def __init__(self, id: str, n_priorities: int, K: int = 0) -> None:
+    """
+    A DTN node that runs on an asyncio event loop.
+
+    Parameters
+    ----------
+    id : str
+      Unique identifier of the node
+    n_priorities: int
+      Number of priorities the bundles can have
+    K : int
+      Number of routes to compute to each destination. 0 means all
+    """
+    super().__init__(id, n_priorities, sockets=False)
+    self.K = K
+    self.loop = None          # Event loop the node runs on
+    self.transport = None     # Datagram transport, for receiving and sending
+    self.loop_start = None    # Loop time when the node started, which is time 0 of the contact plan
+    self.wakeup = None        # Handle of the next queue wake-up
+    self.custody_wakeup = None  # Handle of the next custody wake-up
+
+  def now(self) -> float:
+    """
+    Seconds passed since the node started
+    """
+    return self.loop.time() - self.loop_start
+
+  def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+    """
+    The node is bound and ready. Schedule a wake-up for the start of
+    each contact the node can send through
+    """
+    self.transport = transport
+    self.loop = asyncio.get_running_loop()
+    self.loop_start = self.loop.time()
+    starts = self.time_graph.start[self.time_graph.node_contacts(self.time_graph.labels[self.id])]
+    for start in starts[starts > 0].tolist():
+      self.loop.call_at(self.loop_start + start, self.contact_started)
+    # Bundles recovered from the bundle store are routed again, and discarded when they expire
+    for b in self.limbo_list:
+      if (b.get_deadline() != -1): self.loop.call_at(self.loop_start + b.get_deadline(), self.drop_expired_now)
+    if (self.limbo_list): self.schedule_wakeup(self.limbo_to_queue(self.now()))
+    if (self.metrics.snapshot_file is not None): self.loop.call_later(self.metrics.snapshot_interval, self.snapshot_now)
+    self.log('Node', self.id, 'waiting for messages.')
+
+  def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+    """
+    A bundle or a custody signal arrived
+    """
+    self.handle(self.parse(data))
+
+  def handle(self, recv_bundle: bundle | custody_signal) -> None:
+    """
+    Deliver or forward a bundle that arrived. Custody signals are processed
+    """
+    if (type(recv_bundle) is custody_signal):
+      self.process_custody_signal(recv_bundle, self.now())
+      return
+    # Discard it when it expires, if it is still here
+    deadline = recv_bundle.get_deadline()
+    if (deadline != -1 and deadline > self.now()):
+      self.loop.call_at(self.loop_start + deadline, self.drop_expired_now)
+    self.schedule_wakeup(self.process_bundle(recv_bundle, self.now()))
+    self.schedule_custody()
+
+  def schedule_wakeup(self, delta_time: float) -> None:
+    """
+    Try to send the queues again after delta_time, if it has to wait for a route.
+    Only the earliest wake-up is kept
+    """
+    if (delta_time <= 0): return
+    when = self.loop.time() + delta_time
+    if (self.wakeup is not None and not self.wakeup.cancelled() and self.wakeup.when() <= when): return
+    if (self.wakeup is not None): self.wakeup.cancel()
+    self.wakeup = self.loop.call_at(when, self.send_queues)
+
+  def send_queues(self) -> None:
+    """
+    Send all bundles in queue that can go now
+    """
+    self.wakeup = None
+    self.schedule_wakeup(self.send_bundles_in_queue(self.now()))
+    self.schedule_custody()
+
+  def schedule_custody(self) -> None:
+    """
+    Wake up when custody signals must be sent, or a bundle in custody sent again
+    """
+    custody_time = self.next_custody_time()
+    if (custody_time is None): return
+    when = self.loop_start + custody_time
+    if (self.custody_wakeup is not None and not self.custody_wakeup.cancelled() and self.custody_wakeup.when() <= when): return
+    if (self.custody_wakeup is not None): self.custody_wakeup.cancel()
+    self.custody_wakeup = self.loop.call_at(when, self.custody_now)
+
+  def custody_now(self) -> None:
+    """
+    Send the custody signals that are due, and the bundles that were not accepted in time
+    """
+    self.custody_wakeup = None
+    self.schedule_wakeup(self.custody_tick(self.now()))
+    self.schedule_custody()
+
+  def contact_started(self) -> None:
+    """
+    A contact opened. Routes that ended are forgotten, bundles in limbo may have
+    a route now, and queued bundles may go
+    """
+    self.refresh_route_lists(self.now())
+    self.send_queues()
+
+  def drop_expired_now(self) -> None:
+    """
+    Discard the bundles whose deadline already passed
+    """
+    self.drop_expired(self.now())
+
+  def snapshot_now(self) -> None:
+    """
+    Write a snapshot of the metrics of the node, and schedule the next one
+    """
+    self.metrics.write_snapshot()
+    self.loop.call_later(self.metrics.snapshot_interval, self.snapshot_now)
+
+  def send_datagram(self, data: bytes, address: tuple[str, int]) -> None:
+    """
+    Send data through the transport of the node
+    """
+    self.transport.sendto(data, address)
+
+  def transmit(self, data: bytes, next_hop: str, distance: float) -> None:
+    """
+    Send data straight to a node, once it has travelled the distance to it.
+    The loop sends it then
+    """
+    if (self.lost(distance)): return
+    self.loop.call_later(distance, self.send_datagram, data, self.get_address(next_hop))
+
+  def error_received(self, exc: Exception) -> None:
+    """
+    Errors of the transport, for example when space is not running
+    """
+    self.log('Error on node', self.id + ':', exc)
+
+
+async def main(node: async_DTNnode) -> None:
+  """
+  Bind the node and run it until it is interrupted
+  """
+  loop = asyncio.get_running_loop()
+  transport, _ = await loop.create_datagram_endpoint(lambda: node, local_addr=node.get_address(node.id))
+  try:
+    await asyncio.Event().wait()
+  finally:
+    transport.close()
+    if (node.store is not None): node.store.close()
+    node.metrics.write_snapshot()
+
+
+if __name__ == '__main__':
+  # Get variables from console. Flags (profile, direct) can go anywhere after the time graph
+  args, flags = console_flags(sys.argv)
+  if (len(args) < 4):
+    raise ValueError('ValueError: 3 values needed from console: id, amout of priority queues, time graph. Optional: K, route lists folder (or none), bundle store folder (or none), metrics file. Flags: profile, direct[=loss_prob]')
+
+  dir_path = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+  satellite = async_DTNnode(args[1], int(args[2]), int(args[4]) if len(args) > 4 else 0)
+  satellite.assign_time_graph(dir_path + args[3])
+  # Bundles go straight to the next hop, the node makes them wait and loses some of them
+  satellite.direct = flags['direct']
+  satellite.loss_probability = flags['loss_probability']
+  # Start from the route list made by compile_routes.py, if there is one
+  # A binary route table (.rt) is shared by all nodes, a folder has one route list per node
+  if (len(args) > 5 and args[5] != 'none'):
+    route_lists = dir_path + args[5]
+    satellite.update_route_list(route_lists if route_lists.endswith('.rt') else route_lists + '/' + satellite.id + '.json')
+    satellite.K = satellite.route_list.K
+  else:
+    satellite.create_route_lists(0, satellite.K)
+  # Keep the bundles on disk, and recover the ones of a previous run
+  if (len(args) > 6 and args[6] != 'none'):
+    satellite.open_store(args[6])
+  # Write the metrics of the node, instead of printing what it does with each bundle
+  if (len(args) > 7):
+    satellite.open_metrics(args[7], flags['profile'])
+    satellite.verbose = False
+
+  try:
+    asyncio.run(main(satellite))
+  except KeyboardInterrupt:
+    print('Program finished.')
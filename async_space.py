@@ -0,0 +1,138 @@
+import asyncio, sys, os, json, random, time
+from bundle import bundle
+from DTNnode import spaceAddress, space_addresses
+from metrics import metrics
+from launcher import launch, as_child, shard_file
+
+# For example: python3 async_space.py 0.1
+# Or, writing its metrics instead of printing each bundle: python3 async_space.py 0.1 metrics_space.json
+# Or, in the shards given by the 'space_shards' of a contact plan, one process each: python3 async_space.py 0.1 none walker66.json
+
+loss_causes = [
+  'It hit an asteroid!',
+  'A cosmic laser got in the way!!',
+  'Space swalloed it, nobody know where it went...',
+  'Someone though this was important and stole it.'
+]
+
+class async_space(asyncio.DatagramProtocol):
+  """
+  Space running on an asyncio event loop. Each bundle that arrives
+  is scheduled to be delivered to its next hop after the time it
+  has to travel, using the same transport that received it.
+  """
+
+  def __init__(self, loss_probability: float = 0, metrics_file: str = None) -> None:
+    """
+    Space running on an asyncio event loop.
+
+    Parameters
+    ----------
+    loss_probability : float
+      Probability of a bundle being lost, for each second it travels
+    metrics_file : str
+      File where the metrics of space are written. If there is one,
+      bundles are not printed as they go
+    """
+    self.loss_probability = loss_probability
+    self.transport = None
+    self.loop = None
+    self.in_flight = 0        # Bundles travelling through space
+    self.metrics = metrics(metrics_file)
+    self.metrics.gauge('in_flight', lambda: self.in_flight)
+    self.verbose = metrics_file is None
+
+  def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+    """
+    Space is bound and ready to receive bundles
+    """
+    self.transport = transport
+    self.loop = asyncio.get_running_loop()
+    if (self.metrics.snapshot_file is not None): self.loop.call_later(self.metrics.snapshot_interval, self.snapshot_now)
+    print('Space running.')
+
+  def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+    """
+    A bundle entered space. Schedule its arrival to the next hop
+    """
+    start = time.perf_counter()
+    destination, next_hop_id, distance, bundle_data = bundle.from_space_bytes(data)
+    self.metrics.observe('parse', time.perf_counter() - start)
+    self.metrics.count('received')
+
+    # Probability of bundle getting lost in space, for each second it travels
+    if (random.random() < 1 - (1 - self.loss_probability) ** distance):
+      self.metrics.count('dropped.loss')
+      if (self.verbose): print('Bundle lost. ' + random.choice(loss_causes) + ' \n')
+      return
+
+    self.loop.call_later(distance, self.deliver, bundle_data, destination, next_hop_id)
+    self.in_flight += 1
+    if (self.verbose): print('Bundle travelling through space to the next hop, node {hop_id}. Has to travel {dist} light-seconds\n'.format(hop_id=next_hop_id, dist=distance))
+
+  def deliver(self, bundle_data: bytes, destination: tuple[str, int], next_hop_id: str) -> None:
+    """
+    Send the bundle to the next hop, it finished travelling.
+    It goes in the same format it arrived
+    """
+    self.transport.sendto(bundle_data, destination)
+    self.in_flight -= 1
+    self.metrics.count('delivered')
+    if (self.verbose): print('Bundle arriving to node', next_hop_id, '\n')
+
+  def snapshot_now(self) -> None:
+    """
+    Write a snapshot of the metrics of space, and schedule the next one
+    """
+    self.metrics.write_snapshot()
+    self.loop.call_later(self.metrics.snapshot_interval, self.snapshot_now)
+
+
+async def main(loss_probability: float, metrics_file: str = None, address: tuple[str, int] = spaceAddress) -> None:
+  """
+  Bind space and run it until it is interrupted
+  """
+  loop = asyncio.get_running_loop()
+  space = async_space(loss_probability, metrics_file)
+  transport, _ = await loop.create_datagram_endpoint(lambda: space, local_addr=address)
+  try:
+    await asyncio.Event().wait()
+  finally:
+    transport.close()
+    space.metrics.write_snapshot()
+
+def run_shard(loss_probability: float, metrics_file: str, address: tuple[str, int], shard: int) -> None:
+  """
+  Run one shard of space, in its own process. Each shard writes its metrics
+  to its own file, with the number of the shard added
+  """
+  as_child()
+  try:
+    asyncio.run(main(loss_probability, shard_file(metrics_file, shard) if metrics_file is not None else None, address))
+  except KeyboardInterrupt:
+    print('Space shard', shard, 'finished.')
+
+
+if __name__ == '__main__':
+  # Get variables from console
+  try:
+    loss_probability = float(sys.argv[1]) #Between 0 and 1
+  except (IndexError, ValueError):
+    loss_probability = 0
+
+  metrics_file = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != 'none' else None
+
+  # The contact plan says in how many shards space is split
+  addresses = [spaceAddress]
+  if (len(sys.argv) > 3):
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/' + sys.argv[3]) as f:
+      addresses = space_addresses(json.load(f))
+
+  if (len(addresses) > 1):
+    launch(run_shard, [(loss_probability, metrics_file, address, shard) for shard, address in enumerate(addresses)])
+    print('Program finished.')
+  else:
+    try:
+      asyncio.run(main(loss_probability, metrics_file))
+    except KeyboardInterrupt:
+      print('Program finished.')
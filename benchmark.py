@@ -0,0 +1,166 @@
+import sys, os, json, time, random, resource, tempfile, socket
+from time_evolving_graph import time_evolving_graph
+from DTNnode import DTNnode
+from bundle import bundle
+from simulation import simulation
+import generate_plan
+
+# For example: python3 benchmark.py walker 66
+# Or, comparing with the results of an earlier run: python3 benchmark.py ring 200 1000 1 ring200.json
+# Or, without simulating the whole network, for big plans: python3 benchmark.py walker 1000 1000 1 none nosim
+
+# Timings and memory, where lower is better and where higher is better. They depend on the
+# machine, so they are only checked against a baseline recorded on the same host
+LOWER_IS_BETTER = ('contact_graph_time', 'route_time_per_source', 'simulation_time', 'peak_memory_mb')
+HIGHER_IS_BETTER = ('decisions_per_second', 'space_bundles_per_second')
+# Results of the simulation, the same on any machine for the same plan and traffic, checked strictly
+EXACT_LOWER_IS_BETTER = ('mean_latency',)
+EXACT_HIGHER_IS_BETTER = ('delivery_ratio',)
+
+def peak_memory() -> float:
+  """
+  Peak memory of the process so far, in MB
+  """
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux gives it in KB, macOS in bytes
+  return usage / 1024 if sys.platform != 'darwin' else usage / 1024**2
+
+def bench_routes(plan: dict, K: int, n_sources: int, seed: int = 1) -> dict:
+  """
+  Time to build the contact graph, and to compute the routes of some nodes to all the others
+  """
+  start = time.perf_counter()
+  graph = time_evolving_graph(plan['labels'], plan['edges'], plan['start_time'], plan['end_time'])
+  graph.to_contact_graph()
+  contact_graph_time = time.perf_counter() - start
+
+  sources = random.Random(seed).sample(list(plan['labels']), min(n_sources, len(plan['labels'])))
+  n_routes = 0
+  start = time.perf_counter()
+  for origin in sources:
+    n_routes += sum(len(r) for r in graph.get_all_routes(origin, K, plan['start_time']).values())
+  route_time = time.perf_counter() - start
+  return {'contacts': len(plan['edges']), 'contact_graph_time': contact_graph_time,
+          'route_time_per_source': route_time / len(sources), 'routes_per_source': n_routes / len(sources)}
+
+def bench_decisions(plan: dict, bundles: list, K: int) -> dict:
+  """
+  Routing decisions per second of a single node: every bundle is routed from the same
+  source at the same time, each one seeing the queue and volume left by the ones before
+  """
+  graph = time_evolving_graph(plan['labels'], plan['edges'], plan['start_time'], plan['end_time'])
+  origin = max(plan['labels'], key=lambda id: sum(1 for _, b in bundles if b.startswith(id + '|||')))
+  node = DTNnode(origin, 3, sockets=False)
+  node.verbose = False
+  node.time_graph = graph
+  node.route_table = graph.route_table
+  node.create_route_lists(plan['start_time'], K)
+  to_route = [bundle.to_bundle(b) for _, b in bundles]
+  for b in to_route:
+    b.source = origin
+    if (b.destination == origin): b.destination = next(id for id in plan['labels'] if id != origin)
+  start = time.perf_counter()
+  for b in to_route:
+    node.enqueue(b, plan['start_time'])
+  elapsed = time.perf_counter() - start
+  return {'decisions_per_second': len(to_route) / elapsed if elapsed > 0 else 0,
+          'queued': len(node.send_queue), 'limbo': len(node.limbo_list)}
+
+def bench_simulation(plan_file: str, bundles: list, K: int, loss_probability: float) -> dict:
+  """
+  Run the whole plan in the simulator: delivery ratio and end-to-end latency of the traffic
+  """
+  start = time.perf_counter()
+  sim = simulation(plan_file, 3, loss_probability, K, seed=1)
+  for injection, b in bundles:
+    sim.inject(bundle.to_bundle(b), injection)
+  sim.run()
+  elapsed = time.perf_counter() - start
+  return {'simulation_time': elapsed, 'delivery_ratio': len(sim.delivered_bundles) / sim.injected if sim.injected else 0,
+          'mean_latency': sum(sim.latencies) / len(sim.latencies) if sim.latencies else 0, 'lost': sim.lost}
+
+def bench_space(n: int = 20000) -> dict:
+  """
+  Bundles per second that space can take apart: what space.py does with every datagram
+  """
+  data = bundle('x' * 64, 'N1', 'N2').to_space_bytes(('127.0.0.1', 9000), 'N2', 1.5)
+  start = time.perf_counter()
+  for _ in range(n):
+    bundle.from_space_bytes(data)
+  elapsed = time.perf_counter() - start
+  return {'space_bundles_per_second': n / elapsed if elapsed > 0 else 0}
+
+def run(topology: str, n: int, n_bundles: int = 500, K: int = 1, loss_probability: float = 0, seed: int = 1, simulate: bool = True) -> dict:
+  """
+  Generate a contact plan and its traffic, and run every benchmark on them.
+  Simulating the whole network has every node compute its routes, which
+  takes the longest on big plans, so it can be left out
+  """
+  start = time.perf_counter()
+  plan = generate_plan.constellation(topology, n, seed)
+  bundles = generate_plan.traffic(plan, n_bundles, seed=seed)
+  results = {'host': socket.gethostname(), 'topology': topology, 'nodes': len(plan['labels']), 'bundles': n_bundles, 'K': K,
+             'generation_time': time.perf_counter() - start}
+  results.update(bench_routes(plan, K, 10, seed))
+  results.update(bench_decisions(plan, bundles, K))
+  if (simulate):
+    with tempfile.TemporaryDirectory() as directory:
+      plan_file = os.path.join(directory, 'plan.json')
+      generate_plan.write_plan(plan, plan_file)
+      results.update(bench_simulation(plan_file, bundles, K, loss_probability))
+  results.update(bench_space())
+  results['peak_memory_mb'] = peak_memory()
+  return results
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.25) -> tuple[list[str], list[str]]:
+  """
+  Metrics that got worse than the baseline. Results of the simulation can't get
+  worse at all, and timings by more than the tolerance (a fraction of their value).
+  Timings are only checked if the baseline was recorded on the same host, otherwise
+  they are only reported. Returns the regressions, and the timings that were not checked
+  """
+  same_host = baseline.get('host') == results.get('host')
+  regressions = []
+  unchecked = []
+  for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER + EXACT_LOWER_IS_BETTER + EXACT_HIGHER_IS_BETTER:
+    if (metric not in baseline or metric not in results): continue
+    exact = metric in EXACT_LOWER_IS_BETTER + EXACT_HIGHER_IS_BETTER
+    if (not exact and baseline[metric] == 0): continue
+    change = results[metric] - baseline[metric] if exact else (results[metric] - baseline[metric]) / abs(baseline[metric])
+    allowed = 1e-9 if exact else tolerance
+    line = '{}: {:.4g} -> {:.4g} ({:+.4g})'.format(metric, baseline[metric], results[metric], change) if exact \
+      else '{}: {:.4g} -> {:.4g} ({:+.0%})'.format(metric, baseline[metric], results[metric], change)
+    if (not exact and not same_host):
+      unchecked.append(line)
+    elif ((metric in LOWER_IS_BETTER + EXACT_LOWER_IS_BETTER and change > allowed) or (metric in HIGHER_IS_BETTER + EXACT_HIGHER_IS_BETTER and change < -allowed)):
+      regressions.append(line)
+  return regressions, unchecked
+
+if __name__ == '__main__':
+  # Get variables from console
+  args = sys.argv
+  if (len(args) < 3):
+    raise ValueError('ValueError: 2 values needed from console: topology (walker, ring or mesh), number of nodes. Optional: number of bundles, K, baseline results file (or none), nosim')
+
+  n_bundles = int(args[3]) if len(args) > 3 else 500
+  K = int(args[4]) if len(args) > 4 else 1
+  baseline = args[5] if len(args) > 5 and args[5] != 'none' else None
+  results = run(args[1], int(args[2]), n_bundles, K, simulate=not (len(args) > 6 and args[6] == 'nosim'))
+  for metric, value in results.items():
+    print(metric + ':', round(value, 4) if isinstance(value, float) else value)
+
+  # The first run writes the baseline, the next ones are compared with it
+  if (baseline is not None):
+    if (os.path.exists(baseline)):
+      with open(baseline) as f:
+        regressions, unchecked = compare(results, json.load(f))
+      for t in unchecked:
+        print('Timing, not checked (baseline from another host):', t)
+      for r in regressions:
+        print('Regression:', r)
+      if (regressions): sys.exit(1)
+      print('No regressions against', baseline)
+    else:
+      with open(baseline, 'w') as f:
+        json.dump(results, f, indent=2)
+      print('Baseline written to', baseline)
@@ -1,10 +1,36 @@
 from __future__ import annotations
-import ast
+import ast, random, struct
+from route import route
+
+# Binary wire format. All numbers are in network byte order
+BUNDLE_MAGIC = 0xD7   # First byte of a binary bundle
+SPACE_MAGIC = 0xD8    # First byte of a binary bundle sent to space
+WIRE_VERSION = 5
+# magic, version, flags, priority, deadline, size, route id, hop index, source len, destination len, next hop len, message len
+BUNDLE_HEADER = struct.Struct('!BBBBiIQBBBBI')
+# fragment id, offset of the fragment and length of the whole payload, after the header of fragments
+FRAGMENT_HEADER = struct.Struct('!QII')
+# custody id and custodian len, after the fragment header of bundles sent with custody
+CUSTODY_HEADER = struct.Struct('!QB')
+# magic, version, port, distance to the next hop, host len, next hop len
+SPACE_HEADER = struct.Struct('!BBHdBB')
+
+# Flags of the binary header
+FLAG_CRITICAL = 0x01
+FLAG_CUSTODY = 0x02
+FLAG_FRAGMENT = 0x04
+FLAG_ROUTE = 0x08
+FLAG_IS_FRAGMENT = 0x10
+FLAG_CUSTODIAN = 0x20
 
 class bundle:
   """
   A class that describes a bundle to be sent in the DTN.
+  Bundles have no per-instance dictionary, so a node can hold a large
+  number of them, and their route is shared with the other bundles that use it.
   """
+  __slots__ = ('message', 'source', 'destination', 'size', 'priority', 'critical', 'custody', 'fragment', 'deadline',
+               'route', 'route_id', 'next_hop', 'hop', 'creation_time', 'store_key', 'fragment_id', 'fragment_offset', 'total_length', 'custodian', 'custody_id')
 
   def __init__(self, message: str, src: str, dest: str, size: str ='00000000',p: int =1, crit: bool =False, cust: bool =False, frag: bool =True, deadline: int =-1) -> None:
     """
@@ -44,19 +70,44 @@ class bundle:
     self.fragment = frag      # Fragmentation authorized flag
     self.deadline = deadline  # TTL for the bundle in sec (-1 means infinite)
     self.route = None         # For checking if it has an assigned route
+    self.route_id = None      # Id of the route in the route table, which is what is sent
     self.next_hop = None      # For using the route assigned
+    self.hop = None           # Index of the next hop in the path of the route
+    self.creation_time = None # When the bundle entered the network, only tracked by the simulator
+    self.store_key = None     # Key of the bundle in the bundle store of the node holding it, if any
+    self.fragment_id = None   # For fragments, id shared by all the fragments of the same bundle
+    self.fragment_offset = None # For fragments, where their payload starts in the payload of the whole bundle
+    self.total_length = None  # For fragments, length in bytes of the payload of the whole bundle
+    self.custodian = None     # Node that has custody of the bundle, while it waits for the next one to accept it
+    self.custody_id = None    # Id given to the bundle by its custodian
 
     if (self.size == '00000000'): self.compute_size() # Size of the bundle in bytes
 
   def __str__(self) -> str:
     """
     Parse the bundle to string. The delimiter ||| was chosen.
+    Only the id of the route is included, with the index of the next hop.
     """
     crit = '1' if self.critical else '0'
     cust = '1' if self.custody else '0'
     frag = '1' if self.fragment else '0'
-    return self.source + '|||' + self.destination + '|||' + self.size + '|||' + str(self.priority) + '|||' + crit + '|||' \
-      + cust + '|||' + frag + '|||' + str(self.deadline) + '|||' + self.message + '|||' + str(self.route) + '|||' + str(self.next_hop)
+    string = self.source + '|||' + self.destination + '|||' + self.size + '|||' + str(self.priority) + '|||' + crit + '|||' \
+      + cust + '|||' + frag + '|||' + str(self.deadline) + '|||' + self.get_message() + '|||' + str(self.route_id) + '|||' + str(self.next_hop) \
+      + '|||' + str(self.hop)
+    # Fragments go with their id, offset and the length of the whole payload,
+    # and bundles sent with custody with their custodian and custody id
+    if (self.is_fragment() or self.custodian is not None):
+      string += '|||' + str(self.fragment_id) + '|||' + str(self.fragment_offset) + '|||' + str(self.total_length)
+    if (self.custodian is not None):
+      string += '|||' + self.custodian + '|||' + str(self.custody_id)
+    return string
+
+  def to_text_bytes(self) -> bytes:
+    """
+    Encode the bundle in the text format. The bytes of a character cut in half by
+    a fragment are kept as surrogates in the string, and go back to the same bytes
+    """
+    return str(self).encode('utf-8', 'surrogateescape')
 
   @staticmethod
   def to_bundle(string: str) -> bundle:
@@ -71,23 +122,174 @@ class bundle:
     frag = True if fragment=='1' else False
 
     new_bundle = bundle(message, source, destination, size=size, p=int(priority), crit=crit, cust=cust, frag=frag, deadline=int(deadline))
-    if (len(str_splitted) >= 10):
-      new_bundle.set_route(ast.literal_eval(str_splitted[9]))
+    if (len(str_splitted) >= 10 and str_splitted[9] != 'None'):
+      # Older versions sent the whole route dictionary
+      if (str_splitted[9].startswith('{')):
+        new_bundle.set_route(route.from_dict(ast.literal_eval(str_splitted[9])))
+      else:
+        new_bundle.route_id = int(str_splitted[9])
+    if (len(str_splitted) >= 12 and str_splitted[10] != 'None'):
+      new_bundle.set_next_hop(str_splitted[10], int(str_splitted[11]))
+    if (len(str_splitted) >= 15 and str_splitted[13] != 'None'):
+      # The payload of a fragment may cut a character in half, so it is kept as bytes
+      new_bundle.message = memoryview(message.encode('utf-8', 'surrogateescape'))
+      new_bundle.fragment_id, new_bundle.fragment_offset, new_bundle.total_length = (int(x) for x in str_splitted[12:15])
+    if (len(str_splitted) >= 17):
+      new_bundle.custodian, new_bundle.custody_id = str_splitted[15], int(str_splitted[16])
     return new_bundle
 
+  def to_space_string(self, destination: tuple[str, int], next_hop_id: str, distance: float) -> str:
+    """
+    Parse the bundle to the string sent to space, with the address
+    and id of the next hop, and the distance to it. The delimiter ### was chosen.
+    """
+    return str(self) + '###' + str(destination) + '###' + next_hop_id + '###' + str(distance)
+
+  @staticmethod
+  def from_space_string(string: str) -> tuple[tuple[str, int], str, float, str]:
+    """
+    Take a bundle sent to space as a string, and get the address of the next hop,
+    its id, the distance to it and the bundle itself (still as a string).
+    """
+    bundle_string, destination, next_hop_id, distance = string.split('###')
+    destination_split = destination.split(',')
+    destination = (destination_split[0][2:-1], int(destination_split[1][1:-1]))
+    return destination, next_hop_id, float(distance), bundle_string
+
+  def to_bytes(self) -> bytes:
+    """
+    Encode the bundle in the binary wire format: a fixed size header, with the
+    id of the route and the index of the next hop, followed by the length-prefixed
+    strings and message. The header has the same size whatever the route is.
+    """
+    source = self.source.encode()
+    destination = self.destination.encode()
+    next_hop = self.next_hop.encode() if self.next_hop is not None else b''
+    message = self.payload()
+    flags = (FLAG_CRITICAL if self.critical else 0) | (FLAG_CUSTODY if self.custody else 0) \
+      | (FLAG_FRAGMENT if self.fragment else 0) | (FLAG_ROUTE if self.route_id is not None else 0) \
+      | (FLAG_IS_FRAGMENT if self.is_fragment() else 0) | (FLAG_CUSTODIAN if self.custodian is not None else 0)
+    fragment = FRAGMENT_HEADER.pack(self.fragment_id, self.fragment_offset, self.total_length) if self.is_fragment() else b''
+    if (self.custodian is not None):
+      custodian = self.custodian.encode()
+      fragment += CUSTODY_HEADER.pack(self.custody_id, len(custodian)) + custodian
+    return BUNDLE_HEADER.pack(BUNDLE_MAGIC, WIRE_VERSION, flags, self.priority, int(self.deadline), int(self.size),
+                              self.route_id or 0, self.hop or 0, len(source), len(destination), len(next_hop), len(message)) \
+      + fragment + source + destination + next_hop + message
+
+  @staticmethod
+  def from_bytes(data: bytes | memoryview, offset: int = 0) -> bundle:
+    """
+    Take a bundle in the binary wire format and transform it to a bundle.
+    The header is read in place through a memoryview, without copying the data.
+    The route is not looked up, only its id is set.
+    """
+    view = memoryview(data)
+    magic, version, flags, priority, deadline, size, route_id, hop, src_len, dest_len, hop_len, msg_len = BUNDLE_HEADER.unpack_from(view, offset)
+    if (magic != BUNDLE_MAGIC or version != WIRE_VERSION):
+      raise ValueError('Not a binary bundle of version ' + str(WIRE_VERSION))
+    offset += BUNDLE_HEADER.size
+    if (flags & FLAG_IS_FRAGMENT):
+      fragment = FRAGMENT_HEADER.unpack_from(view, offset)
+      offset += FRAGMENT_HEADER.size
+    if (flags & FLAG_CUSTODIAN):
+      custody_id, custodian_len = CUSTODY_HEADER.unpack_from(view, offset)
+      offset += CUSTODY_HEADER.size
+      custodian = str(view[offset:offset+custodian_len], 'utf-8')
+      offset += custodian_len
+    source = str(view[offset:offset+src_len], 'utf-8'); offset += src_len
+    destination = str(view[offset:offset+dest_len], 'utf-8'); offset += dest_len
+    next_hop = str(view[offset:offset+hop_len], 'utf-8'); offset += hop_len
+    # The payload of a fragment is kept as a slice of the data, it is only decoded once reassembled
+    message = view[offset:offset+msg_len] if flags & FLAG_IS_FRAGMENT else str(view[offset:offset+msg_len], 'utf-8')
+
+    new_bundle = bundle(message, source, destination, size='%08d' % size, p=priority, crit=bool(flags & FLAG_CRITICAL),
+                        cust=bool(flags & FLAG_CUSTODY), frag=bool(flags & FLAG_FRAGMENT), deadline=deadline)
+    if (flags & FLAG_ROUTE): new_bundle.route_id = route_id
+    if (hop_len > 0): new_bundle.set_next_hop(next_hop, hop)
+    if (flags & FLAG_IS_FRAGMENT): new_bundle.fragment_id, new_bundle.fragment_offset, new_bundle.total_length = fragment
+    if (flags & FLAG_CUSTODIAN): new_bundle.custodian, new_bundle.custody_id = custodian, custody_id
+    return new_bundle
+
+  @staticmethod
+  def decode(data: bytes | memoryview) -> bundle:
+    """
+    Transform received data to a bundle, in whichever format it comes:
+    binary, or the text format (for example, when sent with netcat)
+    """
+    if (data and data[0] == BUNDLE_MAGIC):
+      return bundle.from_bytes(data)
+    return bundle.to_bundle(str(data, 'utf-8', 'surrogateescape'))
+
+  def to_space_bytes(self, destination: tuple[str, int], next_hop_id: str, distance: float, binary: bool = True) -> bytes:
+    """
+    Encode the bundle to be sent to space, with the address and id of the next hop,
+    and the distance to it. In binary, a small header with them is put before the binary bundle
+    """
+    if (not binary):
+      return self.to_space_string(destination, next_hop_id, distance).encode('utf-8', 'surrogateescape')
+    host = destination[0].encode()
+    next_hop = next_hop_id.encode()
+    return SPACE_HEADER.pack(SPACE_MAGIC, WIRE_VERSION, destination[1], distance, len(host), len(next_hop)) + host + next_hop + self.to_bytes()
+
+  @staticmethod
+  def from_space_bytes(data: bytes | memoryview) -> tuple[tuple[str, int], str, float, bytes | memoryview]:
+    """
+    Take a bundle sent to space, in binary or text format, and get the address of
+    the next hop, its id and the distance to it. The bundle is not decoded: it is
+    returned as it came, so it can be forwarded without encoding it again
+    """
+    if (not data or data[0] != SPACE_MAGIC):
+      destination, next_hop_id, distance, bundle_string = bundle.from_space_string(str(data, 'utf-8', 'surrogateescape'))
+      return destination, next_hop_id, distance, bundle_string.encode('utf-8', 'surrogateescape')
+    view = memoryview(data)
+    magic, version, port, distance, host_len, hop_len = SPACE_HEADER.unpack_from(view)
+    if (version != WIRE_VERSION):
+      raise ValueError('Not a binary bundle of version ' + str(WIRE_VERSION))
+    offset = SPACE_HEADER.size
+    host = str(view[offset:offset+host_len], 'utf-8'); offset += host_len
+    next_hop_id = str(view[offset:offset+hop_len], 'utf-8'); offset += hop_len
+    return (host, port), next_hop_id, distance, view[offset:]
+
   def get_message(self) -> str:
     """
-    Message getter
+    Message getter. The payload of a fragment may cut a character in half,
+    those bytes are kept as surrogates
+    """
+    if (isinstance(self.message, str)): return self.message
+    return str(self.message, 'utf-8', 'surrogateescape')
+
+  def payload(self) -> bytes | memoryview:
+    """
+    The message as bytes. For fragments, it is a slice of the payload of the whole bundle
     """
+    if (isinstance(self.message, str)): return self.message.encode()
     return self.message
 
+  def is_fragment(self) -> bool:
+    """
+    Whether the bundle is a fragment of another one
+    """
+    return self.fragment_offset is not None
+
   def get_dest(self) -> str:
     """
     Destination getter
     """
     return self.destination
 
-  def get_route(self) -> dict:
+  def copy(self) -> bundle:
+    """
+    Copy the bundle. Routes are immutable, so the copy shares the same one.
+    The copy is not in any bundle store
+    """
+    new_bundle = bundle.__new__(bundle)
+    for name in bundle.__slots__:
+      setattr(new_bundle, name, getattr(self, name))
+    new_bundle.store_key = None
+    return new_bundle
+
+  def get_route(self) -> route:
     """
     Route getter
     """
@@ -113,28 +315,90 @@ class bundle:
 
   def compute_size(self) -> None:
     """
-    Calculate the total size of the bundle, as a string, in bytes
+    Calculate the total size of the bundle, as a string, in bytes.
+    It is the size of its binary encoding, whose header is the same
+    whatever route it takes, so only the message counts as payload
     """
-    new_size = str(len(str(self).encode()))
+    new_size = str(len(self.to_bytes()))
     while len(new_size) < 8:
       new_size = '0' + new_size
     self.size = new_size
 
-  def set_route(self, route: dict) -> None:
+  def set_route(self, route: route) -> None:
     """
     Set a new route for the bundle
     """
-    # A route dict is passed
     self.route = route
+    self.route_id = route.id if route is not None else None
 
-  def set_next_hop(self, hop: str) -> None:
+  def set_next_hop(self, hop: str, index: int = None) -> None:
     """
-    Set the next hop for the route
+    Set the next hop for the route, and its index in the path
     """
     self.next_hop = hop
+    self.hop = index
+
+  def fragment_overhead(self) -> int:
+    """
+    Bytes of a fragment of this bundle that are not payload
+    """
+    return BUNDLE_HEADER.size + FRAGMENT_HEADER.size + len(self.source.encode()) + len(self.destination.encode())
+
+  def split(self, size: int) -> tuple[bundle, bundle]:
+    """
+    Split the bundle in two fragments, the first one of the given size in bytes.
+    Their payloads are slices of the same memory, nothing is copied. Fragments of
+    a fragment keep the id and offsets of the whole bundle, so they can be reassembled
+    together. Fragments have no route
+    """
+    payload = memoryview(self.payload())
+    cut = size - self.fragment_overhead()
+    if (not self.fragment or cut <= 0 or cut >= len(payload)):
+      raise ValueError('Bundle can not be split in a fragment of ' + str(size) + ' bytes')
+    fragment_id = self.fragment_id if self.is_fragment() else random.getrandbits(64)
+    offset = self.fragment_offset if self.is_fragment() else 0
+    total_length = self.total_length if self.is_fragment() else len(payload)
+    fragments = []
+    for start, end in ((0, cut), (cut, len(payload))):
+      fragment = self.copy()
+      fragment.message = payload[start:end]
+      fragment.fragment_id, fragment.fragment_offset, fragment.total_length = fragment_id, offset + start, total_length
+      fragment.custodian = fragment.custody_id = None
+      fragment.set_route(None)
+      fragment.set_next_hop(None)
+      fragment.compute_size()
+      fragments.append(fragment)
+    return fragments[0], fragments[1]
 
-  # TODO
-  def fragment_message(self, max_size):
-    pass
+  def fragment_message(self, max_size: int) -> list[bundle]:
+    """
+    Split the bundle in fragments of at most max_size bytes each.
+    If it already fits, it is returned as it is
+    """
+    fragments = []
+    rest = self
+    while rest.get_size() > max_size:
+      fragment, rest = rest.split(max_size)
+      fragments.append(fragment)
+    return fragments + [rest]
+
+  @staticmethod
+  def reassemble(fragments: list[bundle]) -> bundle:
+    """
+    Build the whole bundle from its fragments, which must cover all of its payload
+    """
+    first = fragments[0]
+    payload = bytearray(first.total_length)
+    view = memoryview(payload)
+    for fragment in fragments:
+      view[fragment.fragment_offset:fragment.fragment_offset+len(fragment.message)] = fragment.message
+    whole = first.copy()
+    whole.message = payload.decode()
+    whole.fragment_id = whole.fragment_offset = whole.total_length = None
+    whole.custodian = whole.custody_id = None
+    whole.set_route(None)
+    whole.set_next_hop(None)
+    whole.compute_size()
+    return whole
 
 
@@ -0,0 +1,289 @@
+from __future__ import annotations
+import mmap, os, struct, threading, time, zlib
+from bundle import bundle, BUNDLE_HEADER
+
+# Log layout: a file header, then one record per change, all numbers in network byte order
+# record: operation, key of the bundle, length and crc32 of the payload, payload (the binary bundle)
+STORE_MAGIC = b'DTNB'
+STORE_VERSION = 1
+FILE_HEADER = struct.Struct('!4sH')
+RECORD_HEADER = struct.Struct('!BQII')
+LOG_NAME = 'bundles.log'
+
+# Operations of the records
+OP_PUT = 1      # The node holds the bundle
+OP_DELETE = 2   # The bundle left the node (sent, delivered or discarded)
+
+class bundle_store:
+  """
+  A class for keeping the bundles held by a node (queued or in limbo) on
+  disk, so they survive a restart of the node. Every change is appended to
+  a log, and the log is only flushed to disk (fsync) every few records or
+  every few seconds, so storing a bundle costs one buffered write. The store
+  is for recovery: the node still keeps the bundles it holds in memory, and
+  the store only keeps an index of where each one is in the log, to read
+  them back after a restart. When most of the log is bundles that already
+  left, it is compacted into a new one, in a thread of its own, while the
+  node goes on storing and deleting bundles.
+  """
+
+  def __init__(self, directory: str, sync_every: int = 64, sync_interval: float = 1, compact_bytes: int = 1 << 20) -> None:
+    """
+    A class for keeping the bundles held by a node on disk. If the
+    directory already has a log, the bundles in it are recovered.
+
+    Parameters
+    ----------
+    directory : str
+      Folder of the log. It is created if it doesn't exist
+    sync_every : int
+      Number of records after which the log is flushed to disk
+    sync_interval : float
+      Seconds after which the log is flushed to disk, if there are records to flush
+    compact_bytes : int
+      Bytes of deleted bundles the log must have before it is compacted
+    """
+    os.makedirs(directory, exist_ok=True)
+    self.path = os.path.join(directory, LOG_NAME)
+    self.sync_every = sync_every
+    self.sync_interval = sync_interval
+    self.compact_bytes = compact_bytes
+    self.index = {}         # Offset and length of the payload, and deadline, of each stored bundle, by key
+    self.next_key = 1       # Key given to the next bundle
+    self.dead_bytes = 0     # Bytes of the log taken by bundles that were deleted, and their delete records
+    self.pending = 0        # Records written since the last sync
+    self.last_sync = time.monotonic()
+    self.file = None
+    self.lock = threading.RLock()   # Held while the log or the index change, so a compaction can run meanwhile
+    self.compactor = None   # Thread compacting the log, if one is running
+    self.recover()
+
+  def __len__(self) -> int:
+    """
+    Number of stored bundles
+    """
+    return len(self.index)
+
+  def __contains__(self, b: bundle) -> bool:
+    """
+    Whether the bundle is stored
+    """
+    return b.store_key in self.index
+
+  def recover(self) -> None:
+    """
+    Read the log and rebuild the index. A record that was cut in half by a
+    crash, and everything after it, is dropped from the log
+    """
+    # A log without its whole file header (a crash right after creating it) is started again.
+    # An empty file can't be memory-mapped either
+    if (not os.path.exists(self.path) or os.path.getsize(self.path) < FILE_HEADER.size):
+      with open(self.path, 'wb') as f:
+        f.write(FILE_HEADER.pack(STORE_MAGIC, STORE_VERSION))
+        f.flush()
+        os.fsync(f.fileno())
+      self.sync_directory()
+    # The log is memory-mapped, so records are checked in place instead of copied
+    with open(self.path, 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version = FILE_HEADER.unpack_from(data)
+    if (magic != STORE_MAGIC):
+      raise ValueError('Not a bundle store: ' + self.path)
+    if (version != STORE_VERSION):
+      raise ValueError('Unknown bundle store version: ' + str(version))
+    offset = FILE_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+      op, key, length, crc = RECORD_HEADER.unpack_from(data, offset)
+      start = offset + RECORD_HEADER.size
+      payload = data[start:start+length]
+      if (op not in (OP_PUT, OP_DELETE) or len(payload) != length or zlib.crc32(payload) != crc): break
+      if (op == OP_PUT):
+        deadline = BUNDLE_HEADER.unpack_from(payload)[4]
+        self.index[key] = (start, length, deadline)
+      else:
+        self.remove_from_index(key)
+        self.dead_bytes += RECORD_HEADER.size
+      self.next_key = max(self.next_key, key + 1)
+      offset = start + length
+    size = len(data)
+    data.close()
+    self.file = open(self.path, 'r+b')
+    if (offset < size):
+      self.file.truncate(offset)
+      os.fsync(self.file.fileno())
+    self.file.seek(offset)
+    self.end = offset       # Where the next record is written
+
+  def remove_from_index(self, key: int) -> None:
+    """
+    Forget a stored bundle
+    """
+    entry = self.index.pop(key, None)
+    if (entry is not None): self.dead_bytes += RECORD_HEADER.size + entry[1]
+
+  def append(self, op: int, key: int, payload: bytes = b'') -> int:
+    """
+    Append a record to the log, with the lock held. Returns the offset of its payload
+    """
+    self.file.write(RECORD_HEADER.pack(op, key, len(payload), zlib.crc32(payload)) + payload)
+    offset = self.end + RECORD_HEADER.size
+    self.end = offset + len(payload)
+    self.pending += 1
+    if (self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval):
+      self.sync()
+    return offset
+
+  def put(self, b: bundle) -> int:
+    """
+    Store a bundle, if it isn't already. Returns its key
+    """
+    if (b.store_key in self.index): return b.store_key
+    payload = b.to_bytes()
+    with self.lock:
+      key = self.next_key
+      self.next_key += 1
+      offset = self.append(OP_PUT, key, payload)
+      self.index[key] = (offset, len(payload), b.get_deadline())
+    b.store_key = key
+    return key
+
+  def delete(self, b: bundle) -> None:
+    """
+    Remove a bundle from the store, if it is there. Once most of the log
+    is bundles that left, a thread is started to compact it
+    """
+    key = b.store_key
+    b.store_key = None
+    with self.lock:
+      if (key not in self.index): return
+      self.remove_from_index(key)
+      self.append(OP_DELETE, key)
+      self.dead_bytes += RECORD_HEADER.size
+      if (self.compactor is None and self.needs_compaction()):
+        self.compactor = threading.Thread(target=self.compact_in_background, daemon=True)
+        self.compactor.start()
+
+  def load(self, key: int) -> bundle:
+    """
+    Read a stored bundle from the log
+    """
+    with self.lock:
+      offset, length, _ = self.index[key]
+      # The bundle may still be in the write buffer
+      if (offset + length > os.fstat(self.file.fileno()).st_size):
+        self.file.flush()
+      data = os.pread(self.file.fileno(), length, offset)
+    b = bundle.from_bytes(data)
+    b.store_key = key
+    return b
+
+  def bundles(self):
+    """
+    Go through the stored bundles, in the order they were stored
+    """
+    with self.lock:
+      keys = sorted(self.index, key=lambda k: self.index[k][0])
+    for key in keys:
+      if (key in self.index): yield self.load(key)
+
+  def sync(self) -> None:
+    """
+    Flush the log to disk
+    """
+    with self.lock:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.pending = 0
+      self.last_sync = time.monotonic()
+
+  def sync_directory(self) -> None:
+    """
+    Flush the folder of the log to disk, so a new or replaced log is not lost
+    """
+    fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def needs_compaction(self) -> bool:
+    """
+    Whether most of the log is bundles that were deleted, and it is big enough to be worth it
+    """
+    return self.dead_bytes >= self.compact_bytes and self.dead_bytes > self.end - self.dead_bytes
+
+  def compact(self, current_time: float = None) -> int:
+    """
+    Write a new log with only the stored bundles, and replace the old one with it.
+    If current_time is given, bundles whose deadline already passed are left out too.
+    The stored bundles are copied and flushed to disk without holding the lock, so
+    the node can go on storing and deleting bundles meanwhile. Then, with the lock,
+    the records appended in the meantime are copied after them, and the logs are swapped.
+    Returns the number of bytes the log shrank
+    """
+    with self.lock:
+      if (current_time is not None):
+        for key in [k for k, e in self.index.items() if e[2] != -1 and e[2] <= current_time]:
+          self.remove_from_index(key)
+      self.file.flush()
+      copied_end = self.end   # Records before this are copied from the index, the rest as they are
+      stored = sorted(self.index.items(), key=lambda e: e[1][0])
+    new_path = self.path + '.compact'
+    moved = {}    # Offset of the payload of each copied bundle in the new log, by key
+    with open(self.path, 'rb') as old, open(new_path, 'wb') as f:
+      f.write(FILE_HEADER.pack(STORE_MAGIC, STORE_VERSION))
+      offset = FILE_HEADER.size
+      # Records are copied in the order they were written
+      for key, (old_offset, length, _) in stored:
+        payload = os.pread(old.fileno(), length, old_offset)
+        f.write(RECORD_HEADER.pack(OP_PUT, key, length, zlib.crc32(payload)) + payload)
+        moved[key] = offset + RECORD_HEADER.size
+        offset += RECORD_HEADER.size + length
+      f.flush()
+      os.fsync(f.fileno())
+
+      with self.lock:
+        self.file.flush()
+        tail = os.pread(self.file.fileno(), self.end - copied_end, copied_end)
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+        shift = offset - copied_end   # How much the records appended meanwhile moved
+        offset += len(tail)
+        index = {}
+        live = 0
+        for key, (old_offset, length, deadline) in self.index.items():
+          index[key] = (moved[key] if old_offset < copied_end else old_offset + shift, length, deadline)
+          live += RECORD_HEADER.size + length
+        self.file.close()
+        os.replace(new_path, self.path)
+        self.sync_directory()
+        self.file = open(self.path, 'r+b')
+        self.file.seek(offset)
+        old_end = self.end
+        self.end = offset
+        self.index = index
+        self.dead_bytes = offset - FILE_HEADER.size - live
+        self.pending = 0
+        self.last_sync = time.monotonic()
+    return old_end - offset
+
+  def compact_in_background(self) -> None:
+    """
+    Compact the log, in the thread started by delete
+    """
+    try:
+      self.compact()
+    finally:
+      self.compactor = None
+
+  def close(self) -> None:
+    """
+    Wait for a compaction that is running, flush the log to disk and close it
+    """
+    compactor = self.compactor
+    if (compactor is not None): compactor.join()
+    if (self.file is None): return
+    self.sync()
+    self.file.close()
+    self.file = None
@@ -0,0 +1,94 @@
+import sys, os, json, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time_evolving_graph import time_evolving_graph
+from route_file import route_file
+
+# For example: python3 compile_routes.py graph2.json 0 0 4
+# Or, for a binary route table: python3 compile_routes.py graph2.json 0 0 4 binary
+
+time_graph = None   # Time graph of each worker process, loaded only once
+
+def load_time_graph(file_path: str) -> tuple[dict, time_evolving_graph]:
+  """
+  Read a time graph file. Returns its data and the time graph
+  """
+  if (file_path.split('.')[-1] != 'json'):
+    raise TypeError('File is not .json')
+  with open(file_path) as f:
+    data = json.load(f)
+  return data, time_evolving_graph(data['labels'], data['edges'], data['start_time'], data['end_time'])
+
+def init_worker(file_path: str) -> None:
+  """
+  Build the time graph (and its contact graph) in a worker process
+  """
+  global time_graph
+  _, time_graph = load_time_graph(file_path)
+  time_graph.to_contact_graph()
+
+def node_routes(origin: str, K: int, start_time: float) -> tuple[str, dict]:
+  """
+  Routes from a node to all the others. They share a single route tree,
+  so all destinations of a node are computed by the same worker
+  """
+  return origin, time_graph.get_all_routes(origin, K, start_time)
+
+def compile_routes(file_path: str, output: str, K: int = 0, start_time: float = 0, workers: int = None, binary: bool = False) -> None:
+  """
+  Compute the routes of every node of a time graph, spread over a pool of
+  processes. They are written either as one JSON route list per node in the
+  output folder, named after the node, or as a single binary route table
+  shared by all nodes. Both can be loaded with DTNnode.update_route_list.
+
+  Parameters
+  ----------
+  file_path : str
+    Time graph (.json) with the contact plan
+  output : str
+    Folder where the route lists are written, or file for the binary route table
+  K : int
+    Number of routes to compute to each destination. 0 means all
+  start_time : float
+    Time from which routes are computed
+  workers : int
+    Number of processes. None means one per core
+  binary : bool
+    Write a binary route table instead of JSON route lists
+  """
+  with open(file_path) as f:
+    data = json.load(f)
+  if (not binary): os.makedirs(output, exist_ok=True)
+  addresses = data.get('addresses', {})
+  all_routes = {}
+  with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(file_path,)) as pool:
+    futures = [pool.submit(node_routes, origin, K, start_time) for origin in data['labels']]
+    for future in as_completed(futures):
+      origin, routes = future.result()
+      if (binary):
+        all_routes[origin] = routes
+        continue
+      with open(os.path.join(output, origin + '.json'), 'w') as f:
+        json_routes = {d: [r.to_dict() for r in rs] for d, rs in routes.items()}
+        json.dump({'addresses': addresses, 'K': K, 'start_time': start_time, 'routes': json_routes}, f)
+  if (binary):
+    route_file.write(output, all_routes, addresses, K, start_time)
+
+
+if __name__ == '__main__':
+  # Get variables from console
+  args = sys.argv
+  if (len(args) < 2):
+    raise ValueError('ValueError: 1 value needed from console: time graph. Optional: K, start time, amount of processes, binary')
+
+  dir_path = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+  K = int(args[2]) if len(args) > 2 else 0
+  start_time = float(args[3]) if len(args) > 3 else 0
+  workers = int(args[4]) if len(args) > 4 and args[4] != '0' else None
+  binary = len(args) > 5 and args[5] == 'binary'
+
+  # Route lists go to a folder (or file) named after the time graph
+  output = dir_path + args[1].rsplit('.', 1)[0] + '_routes' + ('.rt' if binary else '')
+  wall_start = time.time()
+  compile_routes(dir_path + args[1], output, K, start_time, workers, binary)
+  print('Route lists written to', output)
+  print('Wall time:', str(round(time.time() - wall_start, 3)) + 's')
@@ -1,24 +1,30 @@
 import igraph as ig
+import heapq, itertools
 import matplotlib.pyplot as plt
+from route import route
 
 class contact_graph:
   """
   A class for representing a contact graph, which is a model
-  that visualizes the contacts between two nodes in a DTN and
-  the routes between them.
+  that visualizes the contacts of a DTN and the routes between them.
+  It is built once from the contact plan and shared by all queries:
+  the root (origin) and terminal (destination) contacts are virtual,
+  and only exist while searching routes between two nodes.
   """
 
+  ROOT = -1       # Index of the virtual root contact (origin-origin) in paths
+  TERMINAL = -2   # Index of the virtual terminal contact (destination-destination) in paths
+
   def __init__(self, n_vertices : int, edges : list = None, layout : str = 'rt'):
     """
     A class for representing a contact graph, which is a model
-    that visualizes the contacts between two nodes in a DTN and
-    the routes between them.
+    that visualizes the contacts of a DTN and the routes between them.
 
     Parameters
     ----------
     n_vertices : int
       Number of vertices of the graph, which translates into number of
-      contacts in the contact plan plus the root and terminal contact
+      contacts in the contact plan
     edges : list
       List that contains the edges of the graph. These represent the time
       between two contacts
@@ -27,26 +33,78 @@ class contact_graph:
     """
     self.n_vertices = n_vertices    # Number of vertices of the graph
     self.graph = ig.Graph(n=n_vertices, edges=edges, directed=True)   # The graph itself is created
-    self.layout = self.graph.layout(layout)   # The layour for drawing
+    self.layout_name = layout       # Layout algorithm, only computed when drawing
+    self.layout = None              # The layout for drawing
     self.visual_style = {}          # Dictionary for storing the visual style options for drawing
+    self.adjacency = None           # Cached adjacency list for routing, built on the first query
 
   def layout_delete(self, idx : int) -> None:
     """
     For deleting and item from the layout by its index
     """
+    self.compute_layout()
     self.layout.__delitem__(idx)
 
   def layout_append(self, node : list) -> None:
     """
     Append a new item to the layout at the end of the list
     """
+    self.compute_layout()
     self.layout.append(node)
 
+  def compute_layout(self) -> None:
+    """
+    Compute the layout for drawing, if it wasn't already.
+    It is expensive for big graphs, so it is only done when needed
+    """
+    if (self.layout is None):
+      self.layout = self.graph.layout(self.layout_name)
+
   def add_attributes(self, attr_name : str, attr : any) -> None:
     """
     Add a new attribute to the graph vertices
     """
     self.graph.vs[attr_name] = attr
+    self.adjacency = None   # Routing cache is no longer valid
+
+  def add_contact(self, label : str, start : float, end : float, distance : float, rate : float,
+                  predecessors : list, successors : list) -> int:
+    """
+    Add a new contact to the graph, after the contacts in predecessors and
+    before the ones in successors. The routing cache is updated instead of
+    being thrown away. Returns the index of the new contact
+    """
+    v = self.n_vertices
+    self.graph.add_vertex(label=label, start=start, end=end, distance=distance, rate=rate)
+    self.graph.add_edges([(u, v) for u in predecessors] + [(v, w) for w in successors])
+    self.n_vertices += 1
+    self.layout = None
+    if (self.adjacency is not None):
+      from_node, to_node = label.split('-')
+      self.starts.append(start)
+      self.ends.append(end)
+      self.distances.append(distance)
+      self.rates.append(rate)
+      self.from_nodes.append(from_node)
+      self.to_nodes.append(to_node)
+      self.volumes.append(rate * (end - start))
+      self.adjacency.append(list(successors))
+      for u in predecessors:
+        self.adjacency[u].append(v)
+      self.node_contacts.setdefault(from_node, []).append(v)
+    return v
+
+  def update_contact(self, v : int, start : float, end : float) -> None:
+    """
+    Change when a contact starts and ends. Edges that can no longer be used
+    are kept, since the routing search already skips closed contacts
+    """
+    self.graph.vs[v]['start'] = start
+    self.graph.vs[v]['end'] = end
+    if (self.adjacency is not None):
+      self.starts[v] = start
+      self.ends[v] = end
+      self.volumes[v] = self.rates[v] * (end - start)
 
   def add_visual_style(self, attr_name : str, attr : any) -> None:
     """
@@ -59,83 +117,262 @@ class contact_graph:
     """
     Plot the graph with the layout and visual style given
     """
+    self.compute_layout()
     fig, ax = plt.subplots(figsize=(7, 7))
     self.visual_style['layout'] = self.layout
     self.visual_style['target'] = ax
     ig.plot(self.graph, **self.visual_style)
     plt.show()
 
-  def get_all_routes(self) -> list:
-    """
-    Find all routes from root node to terminal.
-    It gets all possible paths from the starting node to the
-    finishing one, sorts them by length and calculates all
-    their corresponding attributes
-    """
-    # Get all paths from start to finish
-    paths = self.graph.get_all_simple_paths(0, self.n_vertices-1)
-    # Sort them by length (number of hops)
-    paths.sort(key=len)
-
-    routes = []
-
-    # Go through all paths and create the routes from it
-    for p in paths:
-      distance = {}
-      rate = 10000
-      route = {}
-      # The route will be a dictionary of each contact with it's time window
-      for node_idx in p[1:-1]:
-        # Add the distance between nodes
-        distance[self.graph.vs[node_idx]['label'].split('-')[1]] = self.graph.vs[node_idx]['distance']
-        # The rate is the minimum rate of all the contacts
-        rate = min(rate, self.graph.vs[node_idx]['rate'] * (self.graph.vs[node_idx]['end'] - self.graph.vs[node_idx]['start']))
-        # Add to route dictionary
-        route[self.graph.vs[node_idx]['label']] = [self.graph.vs[node_idx]['start'], self.graph.vs[node_idx]['end']]
-      # if it is a plausible route, add to list
-      if (rate > 0):
-        dict = {'route': route, 'distance': distance,'rate': rate}
-        routes.append(dict)
-
-    return routes
-
-  def get_routes(self, K: int = 0) -> list:
-    """
-    After getting all routes, get only the first K ones
-    and return them with the correct format for the sattelites
-    K=0 means all
+  def prepare_routing(self) -> None:
+    """
+    Cache the vertex attributes and the adjacency list used by the
+    routing engine, so they are not pulled out of igraph on every query
     """
+    vs = self.graph.vs
+    self.starts = vs['start']
+    self.ends = vs['end']
+    self.distances = vs['distance']
+    self.rates = vs['rate']
+    self.from_nodes = [l.split('-')[0] for l in vs['label']]
+    self.to_nodes = [l.split('-')[1] for l in vs['label']]
+    self.adjacency = self.graph.get_adjlist()
+    # Contacts without volume can never be used
+    self.volumes = [r * (e - s) for r, s, e in zip(self.rates, self.starts, self.ends)]
+    # Contacts leaving each node, which are the successors of a virtual root
+    self.node_contacts = {}
+    for v in range(self.n_vertices):
+      self.node_contacts.setdefault(self.from_nodes[v], []).append(v)
 
-    # Get all routes
-    all_routes = self.get_all_routes()
-
-    if K==0: K=len(all_routes)
-
-    routes = []
-    # Go through the list of routes
-    for k in range(K):
-      route = {}
-      dic = all_routes[k]
-      total_time = 0
-      path = ''
-      start_time = {}
-      end_time = {}
-      for contact in dic['route']:
-        node1, node2 = contact.split('-')
-        path += node1 + ' '
-        start_time[node2] = dic['route'][contact][0]
-        end_time[node2] = dic['route'][contact][1]
-        total_time = max(total_time, start_time[node2])
-        total_time += dic['distance'][node2]
-      path += node2
-      route['path'] = path
-      route['start_time'] = start_time
-      route['end_time'] = end_time
-      route['total_time'] = total_time
-      route['distance'] = dic['distance']
-      route['rate'] = dic['rate']
-      routes.append(route)
-
-    return routes
+  def successors(self, u: int, origin: str, destination: str) -> list:
+    """
+    Successors of a vertex, taking into account the virtual
+    root and terminal contacts of the query
+    """
+    if (u == self.ROOT):
+      succ = self.node_contacts.get(origin, [])
+    else:
+      succ = self.adjacency[u]
+    if (destination is not None and u != self.ROOT and self.to_nodes[u] == destination):
+      succ = succ + [self.TERMINAL]
+    return succ
 
+  def dijkstra(self, origin: str, destination: str | None, source: int, start_time: float, removed_vertices: set = (),
+               removed_edges: set = (), visited_nodes: set = (), max_time: float = None) -> tuple[dict, dict, dict]:
+    """
+    Contact graph Dijkstra on earliest arrival time, leaving source at start_time.
+    Returns the arrival time, number of hops and predecessor of every vertex reached.
+    If destination is None, the whole route tree from source is computed, otherwise
+    the search stops when the terminal is reached.
 
+    Parameters
+    ----------
+    origin : str
+      Node where routes start, the one of the virtual root contact
+    destination : str | None
+      Node where routes end, the one of the virtual terminal contact
+    source : int
+      Vertex where the search starts
+    start_time : float
+      Time at which the bundle is at the source vertex
+    removed_vertices : set
+      Vertices that can't be used (Yen's root path)
+    removed_edges : set
+      Edges (u, v) that can't be used (Yen's previous spurs)
+    visited_nodes : set
+      Nodes already visited before the source, which can't be visited again
+    max_time : float
+      Arrival time after which the search is abandoned, since the path would be useless
+    """
+    starts, ends, distances, volumes, to_nodes = self.starts, self.ends, self.distances, self.volumes, self.to_nodes
+    arrival = {source: start_time}
+    hops = {source: 0}
+    previous = {source: None}
+    # Nodes already in the path to each vertex, for avoiding routing loops
+    first_nodes = set(visited_nodes)
+    first_nodes.add(origin)
+    if (source != self.ROOT): first_nodes.add(to_nodes[source])
+    path_nodes = {source: frozenset(first_nodes)}
+    done = set()
+    heap = [(start_time, 0, source)]
+    while heap:
+      t, h, u = heapq.heappop(heap)
+      if (u in done): continue
+      if (u == self.TERMINAL): break
+      if (max_time is not None and t > max_time): break
+      done.add(u)
+
+      if (u not in path_nodes):
+        path_nodes[u] = path_nodes[previous[u]] | {to_nodes[u]}
+      u_nodes = path_nodes[u]
+
+      for v in self.successors(u, origin, destination):
+        if (v in done or v in removed_vertices or (u, v) in removed_edges): continue
+        if (v == self.TERMINAL):
+          # Reaching the terminal contact doesn't take any time
+          t_v = t
+        else:
+          if (to_nodes[v] in u_nodes): continue
+          # The bundle can't leave before the contact starts, and the contact
+          # must still be open (and have some volume) when it does
+          transmit = t if t > starts[v] else starts[v]
+          if (transmit >= ends[v] or volumes[v] <= 0): continue
+          t_v = transmit + distances[v]
+        if (v not in arrival or (t_v, h+1) < (arrival[v], hops[v])):
+          arrival[v] = t_v
+          hops[v] = h+1
+          previous[v] = u
+          heapq.heappush(heap, (t_v, h+1, v))
+    return arrival, hops, previous
+
+  @staticmethod
+  def build_path(previous: dict, arrival: dict, last: int) -> tuple[list, list]:
+    """
+    Rebuild a path from the predecessors of a search,
+    with the arrival time at each one of its vertices
+    """
+    path = []
+    u = last
+    while u is not None:
+      path.append(u)
+      u = previous[u]
+    path.reverse()
+    return path, [arrival[v] for v in path]
+
+  def shortest_path(self, origin: str, destination: str, source: int, start_time: float, removed_vertices: set = (),
+                    removed_edges: set = (), visited_nodes: set = (), max_time: float = None) -> tuple[list, list] | None:
+    """
+    Finds the path from source to the terminal with the earliest arrival time.
+    Returns the list of vertices of the path and the arrival time at each one,
+    or None if the terminal can't be reached.
+    """
+    arrival, _, previous = self.dijkstra(origin, destination, source, start_time, removed_vertices, removed_edges, visited_nodes, max_time)
+    if (self.TERMINAL not in arrival): return None
+    return self.build_path(previous, arrival, self.TERMINAL)
+
+  def route_tree(self, origin: str, start_time: float) -> dict:
+    """
+    Compute, with a single search, the best path from origin to every other node.
+    Returns a dictionary with the path (list of vertices) and arrival times for each
+    reachable destination, ready to be used as the first route by iter_routes.
+    """
+    if (self.adjacency is None): self.prepare_routing()
+    arrival, hops, previous = self.dijkstra(origin, None, self.ROOT, start_time)
+    # For each destination, keep the contact reaching it first
+    best = {}
+    for v in arrival:
+      if (v == self.ROOT): continue
+      node = self.to_nodes[v]
+      if (node not in best or (arrival[v], hops[v]) < (arrival[best[node]], hops[best[node]])):
+        best[node] = v
+    tree = {}
+    for node, v in best.items():
+      path, arrivals = self.build_path(previous, arrival, v)
+      tree[node] = (path + [self.TERMINAL], arrivals + [arrivals[-1]])
+    return tree
+
+  def arrivals_through(self, origin: str, contacts: list, start_time: float) -> dict:
+    """
+    Earliest arrival time at each node, for routes from origin that go through
+    one of the given contacts. Nodes that can't be reached through them are left out
+    """
+    if (self.adjacency is None): self.prepare_routing()
+    arrival, _, previous = self.dijkstra(origin, None, self.ROOT, start_time)
+    best = {}
+    for c in contacts:
+      if (c not in arrival): continue
+      # Continue from the contact, without going back to the nodes before it
+      path, _ = self.build_path(previous, arrival, c)
+      visited_nodes = {self.to_nodes[v] for v in path[1:-1]}
+      reached, _, _ = self.dijkstra(origin, None, c, arrival[c], visited_nodes=visited_nodes)
+      for v, t in reached.items():
+        node = self.to_nodes[v]
+        if (node not in best or t < best[node]):
+          best[node] = t
+    return best
+
+  def iter_routes(self, origin: str, destination: str, start_time: float = 0, first: tuple[list, list] = None, K: int = 0):
+    """
+    Lazily generate the routes from origin to destination, in order of
+    Projected Arrival Time (ties broken by number of hops), using
+    Yen's K shortest paths over the contact graph Dijkstra.
+    Routes are only computed when they are asked for.
+    If the best path is already known (from a route tree), it can be passed as first.
+    If it is known that only K routes will be asked for, spur searches that can't
+    give one of those K are cut short. K=0 means no limit
+    """
+    if (origin == destination):
+      raise ValueError("Origin same as destination")
+    if (self.adjacency is None): self.prepare_routing()
+
+    best = first if first is not None else self.shortest_path(origin, destination, self.ROOT, start_time)
+    if (best is None): return
+    found = [best]
+    seen = {tuple(best[0])}
+    candidates = []   # Heap of (arrival, hops, counter, path, arrivals, deviation index)
+    counter = itertools.count()
+    deviation = 0     # Where the last route deviated from the one it came from
+    yield self.to_route(*best)
+
+    while True:
+      last_path, last_arrivals = found[-1]
+      # Every vertex of the last route (except the terminal) is a spur. The ones before
+      # its deviation were already spurs of its parent route (Lawler's improvement)
+      for i in range(deviation, len(last_path)-1):
+        root_path = last_path[:i+1]
+        # Don't take the same next contact as routes sharing this root path
+        removed_edges = {(p[i], p[i+1]) for p, _ in found if len(p) > i+1 and p[:i+1] == root_path}
+        removed_vertices = set(root_path[:-1])
+        visited_nodes = {self.to_nodes[v] for v in root_path[1:-1]}
+        # With enough candidates for the routes left, only better ones are useful
+        max_time = None
+        missing = K - len(found)
+        if (K > 0 and len(candidates) >= missing):
+          max_time = heapq.nsmallest(missing, candidates)[-1][0]
+        spur = self.shortest_path(origin, destination, last_path[i], last_arrivals[i], removed_vertices, removed_edges, visited_nodes, max_time)
+        if (spur is None): continue
+        path = root_path[:-1] + spur[0]
+        if (tuple(path) in seen): continue
+        seen.add(tuple(path))
+        arrivals = last_arrivals[:i] + spur[1]
+        heapq.heappush(candidates, (arrivals[-1], len(path), next(counter), path, arrivals, i))
+
+      if (not candidates): return
+      _, _, _, path, arrivals, deviation = heapq.heappop(candidates)
+      found.append((path, arrivals))
+      yield self.to_route(path, arrivals)
+
+  def to_route(self, path: list, arrivals: list) -> route:
+    """
+    Transform a path of the contact graph into a route,
+    with the correct format for the satellites
+    """
+    route_path = ''
+    start_time = {}
+    end_time = {}
+    distance = {}
+    rate = 10000
+    # Root and terminal are not real contacts
+    for v in path[1:-1]:
+      node1, node2 = self.from_nodes[v], self.to_nodes[v]
+      route_path += node1 + ' '
+      start_time[node2] = self.starts[v]
+      end_time[node2] = self.ends[v]
+      distance[node2] = self.distances[v]
+      # The rate is the minimum volume of all the contacts
+      rate = min(rate, self.rates[v] * (self.ends[v] - self.starts[v]))
+    route_path += node2
+    # Contacts are the index of each contact in the contact plan
+    return route(route_path, start_time, end_time, distance, arrivals[-1], rate, path[1:-1])
+
+  def get_routes(self, origin: str, destination: str, K: int = 0, start_time: float = 0, first: tuple[list, list] = None) -> list:
+    """
+    Get the first K routes from origin to destination, in order of
+    Projected Arrival Time, with the correct format for the sattelites.
+    Only those K routes are computed.
+    K=0 means all
+    """
+    routes = self.iter_routes(origin, destination, start_time, first, K)
+    if (K == 0):
+      return list(routes)
+    return list(itertools.islice(routes, K))
@@ -0,0 +1,105 @@
+from __future__ import annotations
+import struct
+from bundle import SPACE_HEADER, SPACE_MAGIC, WIRE_VERSION
+
+# Binary format of a signal. All numbers are in network byte order
+SIGNAL_MAGIC = 0xD9   # First byte of a custody signal
+# magic, version, sender len, custodian len, number of ranges
+SIGNAL_HEADER = struct.Struct('!BBBBH')
+# first custody id of the range, number of ids
+SIGNAL_RANGE = struct.Struct('!QI')
+
+class custody_signal:
+  """
+  A class for an aggregate custody signal: a node tells the custodian of
+  many bundles that it accepted custody of them, all in one signal. The
+  custody ids are given in order by each custodian, so the accepted ones
+  are sent as ranges of consecutive ids, which take a few bytes however
+  many bundles they acknowledge.
+  """
+
+  def __init__(self, sender: str, custodian: str, ids: list[int] = (), ranges: list[tuple[int, int]] = None) -> None:
+    """
+    A class for an aggregate custody signal.
+
+    Parameters
+    ----------
+    sender : str
+      Node that accepted custody of the bundles
+    custodian : str
+      Node the signal is for, which gave the custody ids
+    ids : list[int]
+      Custody ids accepted, in any order
+    ranges : list[tuple[int, int]]
+      Or else, the ranges of ids accepted, as (first id, number of ids)
+    """
+    self.sender = sender
+    self.custodian = custodian
+    self.ranges = ranges if ranges is not None else self.to_ranges(ids)   # (first id, number of ids) of each range
+
+  @staticmethod
+  def to_ranges(ids: list[int]) -> list[tuple[int, int]]:
+    """
+    Group custody ids in ranges of consecutive ids
+    """
+    ranges = []
+    for id in sorted(set(ids)):
+      if (ranges and ranges[-1][0] + ranges[-1][1] == id):
+        ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+      else:
+        ranges.append((id, 1))
+    return ranges
+
+  def ids(self):
+    """
+    Go through the custody ids accepted
+    """
+    for first, count in self.ranges:
+      yield from range(first, first + count)
+
+  def __len__(self) -> int:
+    """
+    Number of custody ids accepted
+    """
+    return sum(count for _, count in self.ranges)
+
+  def to_bytes(self) -> bytes:
+    """
+    Encode the signal: a header, the ids of the sender and the custodian, and its ranges
+    """
+    sender = self.sender.encode()
+    custodian = self.custodian.encode()
+    return SIGNAL_HEADER.pack(SIGNAL_MAGIC, WIRE_VERSION, len(sender), len(custodian), len(self.ranges)) + sender + custodian \
+      + b''.join(SIGNAL_RANGE.pack(first, count) for first, count in self.ranges)
+
+  @staticmethod
+  def from_bytes(data: bytes | memoryview) -> custody_signal:
+    """
+    Take a signal in the binary format and transform it to a custody signal
+    """
+    view = memoryview(data)
+    magic, version, sender_len, custodian_len, n_ranges = SIGNAL_HEADER.unpack_from(view)
+    if (magic != SIGNAL_MAGIC or version != WIRE_VERSION):
+      raise ValueError('Not a custody signal of version ' + str(WIRE_VERSION))
+    offset = SIGNAL_HEADER.size
+    sender = str(view[offset:offset+sender_len], 'utf-8')
+    offset += sender_len
+    custodian = str(view[offset:offset+custodian_len], 'utf-8')
+    offset += custodian_len
+    ranges = [SIGNAL_RANGE.unpack_from(view, offset + i*SIGNAL_RANGE.size) for i in range(n_ranges)]
+    return custody_signal(sender, custodian, ranges=ranges)
+
+  @staticmethod
+  def is_signal(data: bytes) -> bool:
+    """
+    Whether received data is a custody signal, instead of a bundle
+    """
+    return len(data) > 0 and data[0] == SIGNAL_MAGIC
+
+  def to_space_bytes(self, destination: tuple[str, int], next_hop_id: str, distance: float) -> bytes:
+    """
+    Encode the signal to be sent to space, with the same header as bundles
+    """
+    host = destination[0].encode()
+    next_hop = next_hop_id.encode()
+    return SPACE_HEADER.pack(SPACE_MAGIC, WIRE_VERSION, destination[1], distance, len(host), len(next_hop)) + host + next_hop + self.to_bytes()
@@ -0,0 +1,70 @@
+import socket
+
+# Size of the buffers datagrams are read into. UDP payloads are at most 65507 bytes,
+# so no datagram is cut short. Every socket of the network reads with this size
+MAX_DATAGRAM = 65536
+
+class datagram_reader:
+  """
+  A class for reading the datagrams of a socket into a buffer allocated once,
+  instead of a new one for each datagram. After waiting for a datagram, all
+  the ones that already arrived are read without waiting, so a busy socket is
+  emptied in each wake-up. Each datagram is a view of the buffer, which is
+  only valid until the next one is read: what must be kept has to be copied.
+  A datagram that fills the whole buffer may have been cut short, so it is dropped.
+  """
+
+  def __init__(self, sock: socket.socket, size: int = MAX_DATAGRAM, max_batch: int = 64) -> None:
+    """
+    A class for reading the datagrams of a socket into a buffer allocated once.
+
+    Parameters
+    ----------
+    sock : socket.socket
+      Socket to read from
+    size : int
+      Size of the buffer, the largest datagram that can be read
+    max_batch : int
+      Most datagrams read without waiting in a single wake-up, so a flood of
+      them doesn't keep the owner of the socket from doing anything else
+    """
+    self.socket = sock
+    self.buffer = bytearray(size)
+    self.view = memoryview(self.buffer)
+    self.max_batch = max_batch
+    self.truncated = 0      # Datagrams dropped because they didn't fit in the buffer
+
+  def read(self) -> memoryview:
+    """
+    Wait for a datagram, as long as the timeout of the socket
+    """
+    while True:
+      n, _ = self.socket.recvfrom_into(self.buffer)
+      if (self.fits(n)): return self.view[:n]
+
+  def fits(self, n: int) -> bool:
+    """
+    Whether a datagram of n bytes was read whole. If it filled the buffer, the
+    rest of it was discarded by the socket, and it is counted as truncated
+    """
+    if (n < len(self.buffer)): return True
+    self.truncated += 1
+    print('Datagram of at least', n, 'bytes dropped, it does not fit in the buffer.')
+    return False
+
+  def pending(self):
+    """
+    Go through the datagrams that already arrived, without waiting
+    """
+    # With a timeout, the socket would wait before reading, so it is taken off while reading
+    timeout = self.socket.gettimeout()
+    self.socket.settimeout(0)
+    try:
+      for _ in range(self.max_batch):
+        try:
+          n, _ = self.socket.recvfrom_into(self.buffer)
+        except BlockingIOError:
+          return
+        if (self.fits(n)): yield self.view[:n]
+    finally:
+      self.socket.settimeout(timeout)
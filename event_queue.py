@@ -0,0 +1,40 @@
+import heapq, itertools
+
+class event_queue:
+  """
+  A class for a queue of events ordered by the time they must happen.
+  Events with the same time are returned in the order they were added.
+  """
+
+  def __init__(self) -> None:
+    """
+    A class for a queue of events ordered by the time they must happen.
+    Events with the same time are returned in the order they were added.
+    """
+    self.heap = []                      # Min-heap of (time, counter, event)
+    self.counter = itertools.count()    # Tie breaker, so events are never compared
+
+  def __len__(self) -> int:
+    """
+    Number of events waiting in the queue
+    """
+    return len(self.heap)
+
+  def push(self, time: float, event: any) -> None:
+    """
+    Add an event that must happen at the given time
+    """
+    heapq.heappush(self.heap, (time, next(self.counter), event))
+
+  def pop(self) -> tuple[float, any]:
+    """
+    Remove and return the next event, with its time
+    """
+    time, _, event = heapq.heappop(self.heap)
+    return time, event
+
+  def peek_time(self) -> float | None:
+    """
+    Time of the next event, or None if the queue is empty
+    """
+    return self.heap[0][0] if self.heap else None
@@ -0,0 +1,229 @@
+import sys, os, json, math, random
+import numpy as np
+
+# For example: python3 generate_plan.py walker 66 walker66
+# Or, with 500 bundles of traffic: python3 generate_plan.py ring 100 ring100 500
+
+EARTH_RADIUS = 6371e3     # m
+EARTH_MU = 3.986004418e14 # Gravitational parameter of the Earth, m^3/s^2
+LIGHT_SPEED = 299792458   # m/s
+
+def node_labels(n: int) -> dict:
+  """
+  Labels N0 ... N(n-1) of a plan with n nodes
+  """
+  return {'N' + str(i): i for i in range(n)}
+
+def make_plan(n: int, edges: list, duration: float) -> dict:
+  """
+  Time graph with the given contacts, in the format of the files in time_graphs.
+  Nodes get consecutive local ports, so the plan can also be run with real satellites
+  """
+  labels = node_labels(n)
+  return {'labels': labels, 'addresses': {id: ['127.0.0.1', 9000 + i] for id, i in labels.items()},
+          'edges': edges, 'start_time': 0, 'end_time': duration}
+
+def contact(a: int, b: int, start: float, end: float, distance: float, rate: float) -> dict:
+  """
+  A contact of the plan, from node a to node b
+  """
+  return {'contact': [a, b], 'start_time': start, 'end_time': end, 'distance': distance, 'rate': rate}
+
+def walker(n_planes: int, sats_per_plane: int, phasing: int = 1, inclination: float = 86.4, altitude: float = 780e3,
+           duration: float = 21600, step: float = 60, polar_cutoff: float = 60, rate: float = 1000) -> dict:
+  """
+  Contact plan of a Walker delta constellation, i:T/P/F in Walker notation (inclination,
+  n_planes*sats_per_plane satellites, n_planes planes, phasing),
+  with the usual +Grid of inter-satellite links: each satellite is always in contact with
+  the one before and after it in its plane, and with the closest one of each neighbour
+  plane while both are below the polar cutoff latitude, where cross-plane links are switched off.
+  The one way light time of each contact is the mean distance between the satellites over it.
+
+  Parameters
+  ----------
+  n_planes : int
+    Number of orbital planes
+  sats_per_plane : int
+    Number of satellites in each plane
+  phasing : int
+    Walker phasing factor, between 0 and n_planes-1
+  inclination : float
+    Inclination of the planes, in degrees
+  altitude : float
+    Altitude of the orbits, in meters
+  duration : float
+    Length of the plan, in seconds
+  step : float
+    Seconds between the positions used to find the contacts
+  polar_cutoff : float
+    Latitude, in degrees, above which cross-plane links are off
+  rate : float
+    Bytes per second of every link
+  """
+  n = n_planes * sats_per_plane
+  radius = EARTH_RADIUS + altitude
+  mean_motion = math.sqrt(EARTH_MU / radius**3)
+  times = np.arange(0, duration + step, step)
+  plane = np.repeat(np.arange(n_planes), sats_per_plane)
+  slot = np.tile(np.arange(sats_per_plane), n_planes)
+  raan = 2 * np.pi * plane / n_planes
+  anomaly = 2 * np.pi * slot / sats_per_plane + 2 * np.pi * phasing * plane / n
+  incl = math.radians(inclination)
+  # Position of every satellite at every time: (times, satellites, 3)
+  u = anomaly[None, :] + mean_motion * times[:, None]
+  cos_raan, sin_raan = np.cos(raan)[None, :], np.sin(raan)[None, :]
+  positions = radius * np.stack([cos_raan * np.cos(u) - sin_raan * np.sin(u) * math.cos(incl),
+                                 sin_raan * np.cos(u) + cos_raan * np.sin(u) * math.cos(incl),
+                                 np.sin(u) * math.sin(incl)], axis=-1)
+  latitude = np.degrees(np.arcsin(positions[..., 2] / radius))
+
+  # Links of the +Grid, as pairs of satellites
+  index = np.arange(n).reshape(n_planes, sats_per_plane)
+  pairs = [(int(index[p, s]), int(index[p, (s + 1) % sats_per_plane])) for p in range(n_planes) for s in range(sats_per_plane)]
+  cross = []
+  for p in range(n_planes if n_planes > 2 else n_planes - 1):
+    q = (p + 1) % n_planes
+    for s in range(sats_per_plane):
+      a = int(index[p, s])
+      # The closest satellite of the next plane, at the start of the plan
+      b = int(index[q, np.argmin(np.linalg.norm(positions[0, index[q]] - positions[0, a], axis=1))])
+      cross.append((a, b))
+
+  edges = []
+  for (a, b), always in [(pair, True) for pair in pairs if pair[0] != pair[1]] + [(pair, False) for pair in cross]:
+    distance = np.linalg.norm(positions[:, a] - positions[:, b], axis=1) / LIGHT_SPEED
+    on = np.ones(len(times), dtype=bool) if always else (np.abs(latitude[:, a]) < polar_cutoff) & (np.abs(latitude[:, b]) < polar_cutoff)
+    # Each run of steps with the link on is a contact, in both directions
+    changes = np.flatnonzero(np.diff(np.concatenate([[0], on.astype(np.int8), [0]])))
+    for first, last in zip(changes[::2], changes[1::2]):
+      start, end = float(times[first]), float(min(times[last - 1] + step, duration))
+      if (end <= start): continue
+      owlt = round(float(distance[first:last].mean()), 6)
+      edges.append(contact(a, b, start, end, owlt, rate))
+      edges.append(contact(b, a, start, end, owlt, rate))
+  return make_plan(n, edges, duration)
+
+def periodic_contacts(pairs: list, duration: float, period: float, contact_time: float, owlt: tuple, rate: float,
+                      rng: random.Random) -> list:
+  """
+  Contacts of each pair of nodes, in both directions: one of contact_time seconds every
+  period, starting at a random phase. The one way light time of each pair is drawn from owlt
+  """
+  edges = []
+  for a, b in pairs:
+    phase = rng.uniform(0, period)
+    distance = round(rng.uniform(*owlt), 3)
+    start = phase - period
+    while start < duration:
+      s, e = round(max(start, 0), 3), round(min(start + contact_time, duration), 3)
+      if (e > s):
+        edges.append(contact(a, b, s, e, distance, rate))
+        edges.append(contact(b, a, s, e, distance, rate))
+      start += period
+  return edges
+
+def ring(n: int, duration: float = 21600, period: float = 600, density: float = 0.2, owlt: tuple = (1, 5),
+         rate: float = 1000, seed: int = 1) -> dict:
+  """
+  Contact plan of n nodes in a ring: each node has periodic contacts with the next one.
+
+  Parameters
+  ----------
+  n : int
+    Number of nodes
+  duration : float
+    Length of the plan, in seconds
+  period : float
+    Seconds between the starts of the contacts of a pair of nodes
+  density : float
+    Fraction of each period a pair of nodes is in contact
+  owlt : tuple
+    Range of the one way light time of each pair, in seconds
+  rate : float
+    Bytes per second of every contact
+  seed : int
+    Seed for the phases and light times, for repeatable plans
+  """
+  rng = random.Random(seed)
+  pairs = [(i, (i + 1) % n) for i in range(n if n > 2 else n - 1)]
+  return make_plan(n, periodic_contacts(pairs, duration, period, density * period, owlt, rate, rng), duration)
+
+def mesh(n: int, degree: int = 4, duration: float = 21600, period: float = 600, density: float = 0.2, owlt: tuple = (1, 5),
+         rate: float = 1000, seed: int = 1) -> dict:
+  """
+  Contact plan of n nodes in a random mesh: each node has periodic contacts with
+  degree other nodes (on average), always including the next one, so the mesh is connected.
+  Parameters are the same as ring, and degree. A degree of n-1 gives a full mesh
+  """
+  rng = random.Random(seed)
+  pairs = {tuple(sorted((i, (i + 1) % n))) for i in range(n if n > 2 else n - 1)}
+  target = min(n * degree // 2, n * (n - 1) // 2)
+  while len(pairs) < target:
+    a, b = rng.sample(range(n), 2)
+    pairs.add((min(a, b), max(a, b)))
+  return make_plan(n, periodic_contacts(sorted(pairs), duration, period, density * period, owlt, rate, rng), duration)
+
+def constellation(topology: str, n: int, seed: int = 1) -> dict:
+  """
+  Contact plan of about n nodes with the default parameters of a topology: walker, ring or mesh.
+  Walker constellations get as many planes as the largest divisor of n that is at most its square root
+  """
+  if (topology == 'walker'):
+    n_planes = max(p for p in range(1, int(math.isqrt(n)) + 1) if n % p == 0)
+    return walker(n_planes, n // n_planes)
+  if (topology == 'ring'):
+    return ring(n, seed=seed)
+  if (topology == 'mesh'):
+    return mesh(n, seed=seed)
+  raise ValueError('Unknown topology: ' + topology)
+
+def traffic(plan: dict, n_bundles: int, message_size: int = 32, n_priorities: int = 1, deadline: float = -1,
+            custody: bool = False, seed: int = 1) -> list[tuple[float, str]]:
+  """
+  Bundles between random pairs of nodes, injected at random times in the first half
+  of the plan. Returns (injection time, bundle parsed as a string), as in the traffic files
+  """
+  rng = random.Random(seed)
+  ids = list(plan['labels'])
+  horizon = plan['end_time'] - plan['start_time']
+  bundles = []
+  for i in range(n_bundles):
+    source, destination = rng.sample(ids, 2)
+    injection = round(plan['start_time'] + rng.uniform(0, horizon / 2), 3)
+    ttl = int(injection + deadline) if deadline != -1 else -1
+    message = ('m' + str(i) + '-').ljust(message_size, 'x')
+    bundles.append((injection, '|||'.join([source, destination, '00000000', str(rng.randint(1, n_priorities)), '0',
+                                          '1' if custody else '0', '1', str(ttl), message])))
+  return sorted(bundles)
+
+def write_plan(plan: dict, file_path: str) -> None:
+  """
+  Write a contact plan as a time graph file
+  """
+  with open(file_path, 'w') as f:
+    json.dump(plan, f)
+
+def write_traffic(bundles: list, file_path: str) -> None:
+  """
+  Write bundles to a traffic file, which simulation.py can load
+  """
+  with open(file_path, 'w') as f:
+    f.write('# time bundle\n')
+    for injection, bundle_string in bundles:
+      f.write(str(injection) + ' ' + bundle_string + '\n')
+
+
+if __name__ == '__main__':
+  # Get variables from console
+  args = sys.argv
+  if (len(args) < 4):
+    raise ValueError('ValueError: 3 values needed from console: topology (walker, ring or mesh), number of nodes, name. Optional: number of bundles, seed')
+
+  dir_path = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+  seed = int(args[5]) if len(args) > 5 else 1
+  plan = constellation(args[1], int(args[2]), seed)
+  write_plan(plan, dir_path + args[3] + '.json')
+  print('Contact plan with', len(plan['labels']), 'nodes and', len(plan['edges']), 'contacts written to', dir_path + args[3] + '.json')
+  if (len(args) > 4):
+    write_traffic(traffic(plan, int(args[4]), seed=seed), dir_path + 'traffic_' + args[3] + '.txt')
+    print('Traffic written to', dir_path + 'traffic_' + args[3] + '.txt')
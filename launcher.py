@@ -0,0 +1,40 @@
+import os, signal
+from multiprocessing import Process
+
+def interrupt(signum: int, frame) -> None:
+  """
+  Stop a process as if it was interrupted from the console
+  """
+  raise KeyboardInterrupt
+
+def as_child() -> None:
+  """
+  Called by each process started by launch. Ctrl+C is only handled by the
+  launcher, which stops its processes with a SIGTERM, seen as an interrupt
+  """
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGTERM, interrupt)
+
+def shard_file(file_path: str, shard: int) -> str:
+  """
+  File of one of the processes, with the number of its shard added to the name
+  """
+  name, extension = os.path.splitext(file_path)
+  return name + '_' + str(shard) + extension
+
+def launch(target, args_list: list[tuple]) -> None:
+  """
+  Run the target in one process for each tuple of arguments, until they all
+  finish or the launcher is interrupted, which stops them all
+  """
+  processes = [Process(target=target, args=args) for args in args_list]
+  for p in processes:
+    p.start()
+  try:
+    for p in processes:
+      p.join()
+  except KeyboardInterrupt:
+    for p in processes:
+      p.terminate()
+    for p in processes:
+      p.join()
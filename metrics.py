@@ -0,0 +1,206 @@
+import os, sys, json, time, math, functools, cProfile
+
+# For example, to read the snapshot of a node: python3 metrics.py metrics_A.json
+# Or, with the functions that took the longest when profiling: python3 metrics.py metrics_A.json 20
+
+class histogram:
+  """
+  A class for a latency histogram. Values are counted in buckets whose upper
+  bounds are powers of two of microseconds, so observing one is a few operations
+  and the histogram stays small whatever the values are.
+  """
+  __slots__ = ('count', 'total', 'max', 'buckets')
+
+  def __init__(self) -> None:
+    """
+    A class for a latency histogram, with buckets of powers of two of microseconds.
+    """
+    self.count = 0      # Number of values observed
+    self.total = 0.0    # Sum of the values, in seconds
+    self.max = 0.0      # Largest value
+    self.buckets = {}   # Number of values in each bucket, by the exponent of its upper bound
+
+  def observe(self, seconds: float) -> None:
+    """
+    Count a value, in seconds
+    """
+    self.count += 1
+    self.total += seconds
+    if (seconds > self.max): self.max = seconds
+    # seconds*1e6 < 2**exponent, values under a microsecond go to the first bucket
+    exponent = max(math.frexp(seconds * 1e6)[1], 0)
+    self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+  def quantile(self, q: float) -> float:
+    """
+    Upper bound of the bucket where the given fraction of the values is reached
+    """
+    rank = q * self.count
+    seen = 0
+    for exponent in sorted(self.buckets):
+      seen += self.buckets[exponent]
+      if (seen >= rank): return min(2**exponent / 1e6, self.max)
+    return self.max
+
+  def to_dict(self) -> dict:
+    """
+    Summary of the histogram, with the buckets by their upper bound in microseconds
+    """
+    return {'count': self.count, 'sum': self.total, 'mean': self.total / self.count if self.count else 0,
+            'max': self.max, 'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+            'buckets_us': {str(2**e): self.buckets[e] for e in sorted(self.buckets)}}
+
+
+class metrics:
+  """
+  A class for the metrics of a node or of space: counters, gauges and
+  latency histograms. Updating them only touches a dictionary, and gauges
+  are functions that are only called when a snapshot is taken. Snapshots
+  are written as JSON to a file every few seconds, replacing the previous
+  one, so other programs can read the current state of the process.
+  The routing path can also be profiled, and the profile is written next
+  to the snapshot, in the format read by pstats.
+  """
+
+  def __init__(self, snapshot_file: str = None, snapshot_interval: float = 10, profile: bool = False) -> None:
+    """
+    A class for the metrics of a node or of space.
+
+    Parameters
+    ----------
+    snapshot_file : str
+      File where snapshots are written. None if they are only kept in memory
+    snapshot_interval : float
+      Seconds between snapshots
+    profile : bool
+      Whether to profile the timed functions with cProfile
+    """
+    self.counters = {}      # Counters by name
+    self.gauges = {}        # Functions that give the current value of each gauge, by name
+    self.histograms = {}    # Latency histograms by name
+    self.snapshot_file = snapshot_file
+    self.snapshot_interval = snapshot_interval
+    self.start_time = time.monotonic()
+    self.next_snapshot = self.start_time + snapshot_interval  # When the next snapshot is due
+    self.profiler = cProfile.Profile() if profile else None
+    self.profile_depth = 0  # Nested timed calls, the profiler runs while it is above 0
+
+  def export(self, snapshot_file: str, profile: bool = False) -> None:
+    """
+    Start writing snapshots to a file, and profiling if asked. What was counted so far is kept
+    """
+    self.snapshot_file = snapshot_file
+    self.next_snapshot = time.monotonic() + self.snapshot_interval
+    if (profile and self.profiler is None): self.profiler = cProfile.Profile()
+
+  def count(self, name: str, n: int = 1) -> None:
+    """
+    Add n to a counter
+    """
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def gauge(self, name: str, function) -> None:
+    """
+    Register a gauge, whose value is given by a function without arguments
+    """
+    self.gauges[name] = function
+
+  def observe(self, name: str, seconds: float) -> None:
+    """
+    Add a duration, in seconds, to a latency histogram
+    """
+    h = self.histograms.get(name)
+    if (h is None):
+      h = self.histograms[name] = histogram()
+    h.observe(seconds)
+
+  def profile_start(self) -> None:
+    """
+    Start profiling, if profiling is on. Calls can be nested
+    """
+    if (self.profiler is None): return
+    if (self.profile_depth == 0): self.profiler.enable()
+    self.profile_depth += 1
+
+  def profile_stop(self) -> None:
+    """
+    Stop profiling, once the outermost profiled call returns
+    """
+    if (self.profiler is None): return
+    self.profile_depth -= 1
+    if (self.profile_depth == 0): self.profiler.disable()
+
+  def snapshot(self) -> dict:
+    """
+    Current value of every metric
+    """
+    return {'time': time.time(), 'uptime': time.monotonic() - self.start_time,
+            'counters': dict(self.counters),
+            'gauges': {name: function() for name, function in self.gauges.items()},
+            'histograms': {name: h.to_dict() for name, h in self.histograms.items()}}
+
+  def write_snapshot(self) -> None:
+    """
+    Write a snapshot to the snapshot file. It is written to a temporary file that
+    then replaces it, so readers never see half a snapshot. The profile, if there
+    is one, goes to the same file with .prof added
+    """
+    if (self.snapshot_file is None): return
+    temporary = self.snapshot_file + '.tmp'
+    with open(temporary, 'w') as f:
+      json.dump(self.snapshot(), f, indent=1)
+    os.replace(temporary, self.snapshot_file)
+    # Dumping the profile stops it, so only when no profiled call is running
+    if (self.profiler is not None and self.profile_depth == 0):
+      self.profiler.dump_stats(self.snapshot_file + '.prof')
+    self.next_snapshot = time.monotonic() + self.snapshot_interval
+
+  def maybe_snapshot(self) -> bool:
+    """
+    Write a snapshot if it is due. Returns whether it was written
+    """
+    if (self.snapshot_file is None or time.monotonic() < self.next_snapshot): return False
+    self.write_snapshot()
+    return True
+
+
+def timed(name: str):
+  """
+  Decorator for methods of objects with metrics: how long each call takes is
+  added to the histogram with the given name, and the call is profiled if
+  profiling is on
+  """
+  def decorator(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      m = self.metrics
+      m.profile_start()
+      start = time.perf_counter()
+      try:
+        return method(self, *args, **kwargs)
+      finally:
+        m.observe(name, time.perf_counter() - start)
+        m.profile_stop()
+    return wrapper
+  return decorator
+
+
+if __name__ == '__main__':
+  # Get variables from console
+  args = sys.argv
+  if (len(args) < 2):
+    raise ValueError('ValueError: 1 value needed from console: snapshot file. Optional: number of profiled functions to show')
+
+  with open(args[1]) as f:
+    snapshot = json.load(f)
+  print('Uptime:', round(snapshot['uptime']), 's')
+  for name, value in sorted(snapshot['counters'].items()):
+    print(' ', name + ':', value)
+  for name, value in sorted(snapshot['gauges'].items()):
+    print(' ', name + ':', value)
+  for name, h in sorted(snapshot['histograms'].items()):
+    print('  {}: {} calls, mean {:.1f}us, p50 {:.1f}us, p99 {:.1f}us, max {:.1f}us'.format(
+      name, h['count'], h['mean'] * 1e6, h['p50'] * 1e6, h['p99'] * 1e6, h['max'] * 1e6))
+  if (len(args) > 2 and os.path.exists(args[1] + '.prof')):
+    import pstats
+    pstats.Stats(args[1] + '.prof').sort_stats('cumulative').print_stats(int(args[2]))
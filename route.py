@@ -0,0 +1,122 @@
+from __future__ import annotations
+import hashlib
+from types import MappingProxyType
+
+class route:
+  """
+  A class for a route to a destination, through the contacts of the plan.
+  Routes are shared by all the bundles (and nodes) that use them, so they
+  are immutable and have no per-instance dictionary. Their fields can also
+  be read like the keys of a dictionary, the format routes used to have.
+  """
+  __slots__ = ('path', 'nodes', 'start_time', 'end_time', 'distance', 'total_time', 'rate', 'contacts', 'id')
+
+  def __init__(self, path: str, start_time: dict, end_time: dict, distance: dict, total_time: float, rate: float,
+               contacts: list = None, id: int = None) -> None:
+    """
+    A class for a route to a destination, through the contacts of the plan.
+
+    Parameters
+    ----------
+    path : str
+      Nodes of the route, separated by spaces
+    start_time : dict
+      Start time of the contact to each node of the path
+    end_time : dict
+      End time of the contact to each node of the path
+    distance : dict
+      Distance to each node of the path, from the one before it
+    total_time : float
+      Time of arrival to the destination
+    rate : float
+      Volume of the route
+    contacts : list
+      Index of each contact in the contact plan. None if it is not known
+    id : int
+      Id of the route in the route table. If None, it is computed
+    """
+    set = object.__setattr__
+    set(self, 'path', path)
+    set(self, 'nodes', tuple(path.split()))                  # Nodes of the path, already split
+    set(self, 'start_time', MappingProxyType(dict(start_time)))
+    set(self, 'end_time', MappingProxyType(dict(end_time)))
+    set(self, 'distance', MappingProxyType(dict(distance)))
+    set(self, 'total_time', total_time)
+    set(self, 'rate', rate)
+    set(self, 'contacts', tuple(contacts) if contacts is not None else None)
+    set(self, 'id', id if id is not None else route.route_id(self))
+
+  def __setattr__(self, name: str, value: any) -> None:
+    raise AttributeError('Routes are shared, they can not be modified')
+
+  def __delattr__(self, name: str) -> None:
+    raise AttributeError('Routes are shared, they can not be modified')
+
+  def __reduce__(self) -> tuple:
+    """
+    For sending routes to other processes
+    """
+    return (route, (self.path, dict(self.start_time), dict(self.end_time), dict(self.distance), self.total_time,
+                    self.rate, self.contacts, self.id))
+
+  def __repr__(self) -> str:
+    return 'route(' + repr(self.to_dict()) + ')'
+
+  def __getitem__(self, key: str) -> any:
+    """
+    Read a field as if the route was a dictionary
+    """
+    if (key not in self.__slots__ or (key == 'contacts' and self.contacts is None)):
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.__slots__ and (key != 'contacts' or self.contacts is not None)
+
+  def get(self, key: str, default: any = None) -> any:
+    """
+    Read a field as if the route was a dictionary
+    """
+    return self[key] if key in self else default
+
+  @staticmethod
+  def route_id(data: dict | route) -> int:
+    """
+    Compute the id of a route: a 64 bit hash of the contacts it uses.
+    If the route doesn't have its contacts, its path and contact times are used
+    """
+    if ('contacts' in data):
+      key = repr(tuple(data['contacts']))
+    else:
+      key = repr((data['path'], sorted(data['start_time'].items()), sorted(data['end_time'].items())))
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+  @staticmethod
+  def from_dict(data: dict | route) -> route:
+    """
+    Create a route from a dictionary, like the ones in route list files
+    """
+    if (isinstance(data, route)): return data
+    return route(data['path'], data['start_time'], data['end_time'], data['distance'], data['total_time'],
+                 data['rate'], data.get('contacts'), data.get('id'))
+
+  def to_dict(self) -> dict:
+    """
+    The route as a dictionary, for writing it to a file
+    """
+    data = {'path': self.path, 'start_time': dict(self.start_time), 'end_time': dict(self.end_time), 'total_time': self.total_time,
+            'distance': dict(self.distance), 'rate': self.rate, 'id': self.id}
+    if (self.contacts is not None): data['contacts'] = list(self.contacts)
+    return data
+
+  def first_hop(self) -> str:
+    """
+    The node the route goes to first
+    """
+    return self.nodes[1]
+
+  def expiry_time(self) -> float:
+    """
+    Time when the route can no longer be used: when the first of its contacts ends
+    """
+    return min(self.end_time.values())
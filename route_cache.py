@@ -0,0 +1,130 @@
+from __future__ import annotations
+import heapq
+from route import route
+
+class route_cache:
+  """
+  A class for the routes of a node to each destination. Routes are indexed
+  by the time they stop being usable (when the first of their contacts ends),
+  so the ones that expired are evicted as time goes on and lookups only see
+  routes that can still be used. When a destination runs low on routes, more
+  are computed from the current time, but only if there can be new ones.
+  """
+
+  def __init__(self, compute = None, min_routes: int = 1) -> None:
+    """
+    A class for the routes of a node to each destination.
+
+    Parameters
+    ----------
+    compute : function
+      compute(destination, current_time) returns the routes to the destination
+      from current_time, in order of arrival time. Used when running low on routes
+    min_routes : int
+      Number of usable routes under which more are computed
+    """
+    self.compute = compute
+    self.min_routes = min_routes
+    self.K = 0              # Number of routes computed to each destination, 0 means all
+    self.routes = {}        # Usable routes to each destination, in order of arrival time
+    self.expiry = {}        # Min-heap of (expiry time, route index) of the routes to each destination
+    self.complete = {}      # Whether the routes of each destination are all the ones there can be
+    self.count = 0          # Tiebreak for routes with the same expiry time
+
+  @staticmethod
+  def expiry_time(route: route) -> float:
+    """
+    Time when a route can no longer be used: when the first of its contacts ends
+    """
+    return route.expiry_time()
+
+  def __getitem__(self, destination: str) -> list:
+    """
+    Routes to a destination, without evicting the expired ones
+    """
+    return self.routes[destination]
+
+  def __setitem__(self, destination: str, routes: list) -> None:
+    """
+    Set the routes to a destination, computed with the K of the cache
+    """
+    self.routes[destination] = list(routes)
+    heap = []
+    for r in routes:
+      heap.append((self.expiry_time(r), self.count))
+      self.count += 1
+    heapq.heapify(heap)
+    self.expiry[destination] = heap
+    # If less than K routes were found, there are no more. Later on there can only be less
+    self.complete[destination] = self.K == 0 or len(routes) < self.K
+
+  def __contains__(self, destination: str) -> bool:
+    """
+    Whether routes to the destination were computed
+    """
+    return destination in self.routes
+
+  def __iter__(self):
+    """
+    Go through the destinations
+    """
+    return iter(self.routes)
+
+  def __len__(self) -> int:
+    """
+    Number of destinations in the cache
+    """
+    return len(self.routes)
+
+  def get(self, destination: str, default: list = None) -> list:
+    """
+    Routes to a destination, without evicting the expired ones
+    """
+    return self.routes.get(destination, default)
+
+  def items(self):
+    """
+    Pairs of destination and its routes
+    """
+    return self.routes.items()
+
+  def update(self, routes: dict) -> None:
+    """
+    Set the routes to several destinations
+    """
+    for destination, r in routes.items():
+      self[destination] = r
+
+  def evict(self, destination: str, current_time: float) -> int:
+    """
+    Remove the routes to a destination that can no longer be used.
+    Returns how many were removed
+    """
+    heap = self.expiry.get(destination)
+    if (not heap or heap[0][0] > current_time): return 0
+    removed = 0
+    while heap and heap[0][0] <= current_time:
+      heapq.heappop(heap)
+      removed += 1
+    self.routes[destination] = [r for r in self.routes[destination] if self.expiry_time(r) > current_time]
+    return removed
+
+  def prune(self, current_time: float) -> int:
+    """
+    Remove the routes to all destinations that can no longer be used.
+    Returns how many were removed
+    """
+    return sum(self.evict(d, current_time) for d in self.routes)
+
+  def viable(self, destination: str, current_time: float) -> list:
+    """
+    Routes to a destination that can still be used. If there are less than
+    min_routes, new ones are computed from current_time
+    """
+    self.evict(destination, current_time)
+    routes = self.routes.get(destination, [])
+    if (len(routes) < self.min_routes and not self.complete.get(destination, False) and self.compute is not None):
+      self[destination] = self.compute(destination, current_time)
+      self.evict(destination, current_time)
+      routes = self.routes[destination]
+    return routes
@@ -0,0 +1,196 @@
+from __future__ import annotations
+import mmap, struct
+import numpy as np
+from route import route
+
+# File layout (all little endian, every section aligned to 8 bytes):
+# header: magic, version, K, start time, and the (offset, count) of each section
+# nodes: node ids, interned, as offsets into a block of utf-8 bytes
+# hosts, ports: address of each node
+# sources: for each node, its range in destinations
+# destinations: destination node and range in routes, sorted by node inside each source
+# routes: id, total time, rate and range in hops
+# hops: contact index, receiving node and times of each hop
+
+FILE_MAGIC = b'DTNR'
+FILE_VERSION = 1
+SECTIONS = ('node_offsets', 'node_bytes', 'host_offsets', 'host_bytes', 'ports', 'sources', 'destinations', 'routes', 'hops')
+HEADER = '<4sHHId' + 'QQ' * len(SECTIONS)
+
+DESTINATION_DTYPE = np.dtype([('node', '<u4'), ('first_route', '<u4'), ('n_routes', '<u4')])
+ROUTE_DTYPE = np.dtype([('id', '<u8'), ('total_time', '<f8'), ('rate', '<f8'), ('first_hop', '<u4'), ('n_hops', '<u4')])
+HOP_DTYPE = np.dtype([('contact', '<i4'), ('node', '<u4'), ('start', '<f8'), ('end', '<f8'), ('distance', '<f8')])
+SECTION_DTYPES = {
+  'node_offsets': np.dtype('<u4'), 'node_bytes': np.dtype('u1'), 'host_offsets': np.dtype('<u4'), 'host_bytes': np.dtype('u1'),
+  'ports': np.dtype('<u2'), 'sources': np.dtype('<u4'), 'destinations': DESTINATION_DTYPE, 'routes': ROUTE_DTYPE, 'hops': HOP_DTYPE
+}
+
+class route_file:
+  """
+  A class for reading a route table stored in a compact binary file, with
+  the routes of every node to every destination. The file is memory-mapped
+  read-only, so all the nodes of a host share the same pages, and routes are
+  only decoded into route objects when a node asks for one of its destinations.
+  """
+
+  def __init__(self, file_path: str) -> None:
+    """
+    A class for reading a route table stored in a compact binary file.
+
+    Parameters
+    ----------
+    file_path : str
+      Route table file (.rt), written with route_file.write
+    """
+    with open(file_path, 'rb') as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = struct.unpack_from(HEADER, self.mmap)
+    if (header[0] != FILE_MAGIC):
+      raise ValueError('Not a route table file: ' + file_path)
+    if (header[1] != FILE_VERSION):
+      raise ValueError('Unknown route table version: ' + str(header[1]))
+    self.K = header[3]            # Number of routes computed to each destination, 0 means all
+    self.start_time = header[4]   # Time from which routes were computed
+    # Arrays are views of the file, nothing is copied
+    self.sections = {}
+    for i, name in enumerate(SECTIONS):
+      offset, count = header[5 + 2*i], header[6 + 2*i]
+      self.sections[name] = np.frombuffer(self.mmap, SECTION_DTYPES[name], count, offset)
+    self.nodes = self.strings('node_offsets', 'node_bytes')   # Id of each node number
+    self.node_index = {id: i for i, id in enumerate(self.nodes)}
+
+  def strings(self, offsets_name: str, bytes_name: str) -> list[str]:
+    """
+    Decode a block of strings
+    """
+    offsets = self.sections[offsets_name].tolist()
+    data = self.sections[bytes_name].tobytes()
+    return [data[offsets[i]:offsets[i+1]].decode() for i in range(len(offsets)-1)]
+
+  def close(self) -> None:
+    """
+    Release the file. The routes already decoded can still be used
+    """
+    self.sections = {}
+    self.mmap.close()
+
+  def addresses(self) -> dict:
+    """
+    Address of each node that has one
+    """
+    hosts = self.strings('host_offsets', 'host_bytes')
+    ports = self.sections['ports'].tolist()
+    return {id: (hosts[i], ports[i]) for i, id in enumerate(self.nodes) if hosts[i]}
+
+  def destination_range(self, origin: str) -> tuple[int, int]:
+    """
+    Range of the destinations of a node
+    """
+    sources = self.sections['sources']
+    i = self.node_index[origin]
+    return int(sources[i]), int(sources[i+1])
+
+  def destinations(self, origin: str) -> list[str]:
+    """
+    Destinations with routes from a node
+    """
+    if (origin not in self.node_index): return []
+    first, last = self.destination_range(origin)
+    return [self.nodes[n] for n in self.sections['destinations']['node'][first:last].tolist()]
+
+  def routes(self, origin: str, destination: str) -> list[route]:
+    """
+    Decode the routes from origin to destination, in the same format as
+    contact_graph.to_route. Empty if there are none
+    """
+    if (origin not in self.node_index or destination not in self.node_index): return []
+    first, last = self.destination_range(origin)
+    entries = self.sections['destinations'][first:last]
+    i = int(np.searchsorted(entries['node'], self.node_index[destination]))
+    if (i == len(entries) or entries['node'][i] != self.node_index[destination]): return []
+    _, first_route, n_routes = entries[i].tolist()
+    routes = []
+    hops = self.sections['hops']
+    for id, total_time, rate, first_hop, n_hops in self.sections['routes'][first_route:first_route+n_routes].tolist():
+      path = [origin]
+      start_time, end_time, distance, contacts = {}, {}, {}, []
+      for contact, node, start, end, dist in hops[first_hop:first_hop+n_hops].tolist():
+        node = self.nodes[node]
+        path.append(node)
+        start_time[node] = start
+        end_time[node] = end
+        distance[node] = dist
+        contacts.append(contact)
+      # Routes loaded from old files may not know their contacts or id
+      routes.append(route(' '.join(path), start_time, end_time, distance, total_time, rate,
+                          contacts if -1 not in contacts else None, id if id != 0 else None))
+    return routes
+
+  @staticmethod
+  def write(file_path: str, routes: dict, addresses: dict = None, K: int = 0, start_time: float = 0) -> None:
+    """
+    Write a route table file.
+
+    Parameters
+    ----------
+    file_path : str
+      File where the table is written
+    routes : dict
+      For each origin node, a dictionary with the list of routes to each destination
+    addresses : dict
+      Address (host, port) of each node
+    K : int
+      Number of routes that were computed to each destination, 0 means all
+    start_time : float
+      Time from which routes were computed
+    """
+    addresses = addresses or {}
+    # Intern every node id
+    nodes = list(dict.fromkeys(list(addresses) + list(routes) +
+                               [d for dests in routes.values() for d in dests] +
+                               [n for dests in routes.values() for rs in dests.values() for r in rs for n in r['path'].split()]))
+    node_index = {id: i for i, id in enumerate(nodes)}
+
+    def string_block(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+      data = [s.encode() for s in strings]
+      offsets = np.zeros(len(data) + 1, dtype='<u4')
+      offsets[1:] = np.cumsum([len(d) for d in data]) if data else []
+      return offsets, np.frombuffer(b''.join(data), dtype='u1')
+
+    sources = np.zeros(len(nodes) + 1, dtype='<u4')
+    destination_rows, route_rows, hop_rows = [], [], []
+    for i, origin in enumerate(nodes):
+      dests = routes.get(origin, {})
+      for destination in sorted(dests, key=node_index.get):
+        destination_rows.append((node_index[destination], len(route_rows), len(dests[destination])))
+        for r in dests[destination]:
+          hop_nodes = r['path'].split()[1:]
+          contacts = r.get('contacts', [-1] * len(hop_nodes))
+          route_rows.append((r.get('id', 0), r['total_time'], r['rate'], len(hop_rows), len(hop_nodes)))
+          for node, contact in zip(hop_nodes, contacts):
+            hop_rows.append((contact, node_index[node], r['start_time'][node], r['end_time'][node], r['distance'][node]))
+      sources[i+1] = len(destination_rows)
+
+    node_offsets, node_bytes = string_block(nodes)
+    host_offsets, host_bytes = string_block([addresses[n][0] if n in addresses else '' for n in nodes])
+    arrays = {
+      'node_offsets': node_offsets, 'node_bytes': node_bytes, 'host_offsets': host_offsets, 'host_bytes': host_bytes,
+      'ports': np.array([addresses[n][1] if n in addresses else 0 for n in nodes], dtype='<u2'),
+      'sources': sources,
+      'destinations': np.array(destination_rows, dtype=DESTINATION_DTYPE),
+      'routes': np.array(route_rows, dtype=ROUTE_DTYPE),
+      'hops': np.array(hop_rows, dtype=HOP_DTYPE),
+    }
+
+    # Sections go one after the other, after the header
+    offset = struct.calcsize(HEADER)
+    layout = []
+    for name in SECTIONS:
+      offset += -offset % 8
+      layout += [offset, len(arrays[name])]
+      offset += arrays[name].nbytes
+    with open(file_path, 'wb') as f:
+      f.write(struct.pack(HEADER, FILE_MAGIC, FILE_VERSION, 0, K, start_time, *layout))
+      for i, name in enumerate(SECTIONS):
+        f.write(b'\0' * (layout[2*i] - f.tell()))
+        f.write(arrays[name].tobytes())
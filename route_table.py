@@ -0,0 +1,89 @@
+import heapq
+from route import route as route_record
+
+class route_table:
+  """
+  A class for a table of routes, shared by all the nodes that use the
+  same contact plan. Each route is interned with an id derived from the
+  contacts it uses, so every node gives the same id to the same route
+  and bundles only need to carry that id instead of the whole route.
+  """
+
+  def __init__(self) -> None:
+    """
+    A class for a table of routes, shared by all the nodes that use the
+    same contact plan.
+    """
+    self.routes = {}    # Dictionary of route id -> route
+    self.by_contact = {}  # Ids of the routes that use each contact
+    self.expiry = []      # Min-heap of (end time of the last contact, id) of the routes
+
+  def __len__(self) -> int:
+    """
+    Number of routes in the table
+    """
+    return len(self.routes)
+
+  @staticmethod
+  def route_id(route: dict) -> int:
+    """
+    Compute the id of a route: a 64 bit hash of the contacts it uses
+    """
+    return route_record.route_id(route)
+
+  def intern(self, route: route_record | dict) -> route_record:
+    """
+    Add a route to the table. Dictionaries are turned into route objects.
+    If the same route was already interned, the one in the table is
+    returned, so all nodes share it
+    """
+    id = route.get('id')
+    if (id is None):
+      id = self.route_id(route)
+    interned = self.routes.get(id)
+    if (interned is None):
+      interned = route_record.from_dict(route)
+      self.routes[id] = interned
+      for c in interned.contacts or ():
+        self.by_contact.setdefault(c, set()).add(id)
+      heapq.heappush(self.expiry, (max(interned.end_time.values()), id))
+    return interned
+
+  def discard_contacts(self, contacts: list) -> set:
+    """
+    Remove the routes that use any of the given contacts, because they changed.
+    Returns the ids of the removed routes
+    """
+    removed = set()
+    for c in contacts:
+      removed |= self.by_contact.pop(c, set())
+    for id in removed:
+      self.remove(id)
+    return removed
+
+  def prune(self, current_time: float) -> int:
+    """
+    Remove the routes whose last contact already ended, since no bundle can
+    use them anymore. Returns how many were removed
+    """
+    removed = 0
+    while self.expiry and self.expiry[0][0] <= current_time:
+      _, id = heapq.heappop(self.expiry)
+      if (self.remove(id) is not None): removed += 1
+    return removed
+
+  def remove(self, id: int) -> route_record | None:
+    """
+    Remove a route from the table. Returns it, or None if it wasn't there
+    """
+    route = self.routes.pop(id, None)
+    if (route is None): return None
+    for c in route.contacts or ():
+      if (c in self.by_contact): self.by_contact[c].discard(id)
+    return route
+
+  def get(self, id: int) -> route_record | None:
+    """
+    Get the route with the given id, or None if it is not in the table
+    """
+    return self.routes.get(id)
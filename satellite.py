@@ -1,20 +1,31 @@
-import sys, time, os
-from DTNnode import DTNnode
+import sys, time, os, bisect
+from DTNnode import DTNnode, console_flags
+from datagram_reader import MAX_DATAGRAM
 
 # For example: python3 satellite.py A 3 graph1.json
+# Or, with route lists made by compile_routes.py: python3 satellite.py A 3 graph1.json graph1_routes
+# Or, keeping its bundles on disk: python3 satellite.py A 3 graph1.json none store_A
+# Or, writing its metrics and profiling its routing: python3 satellite.py A 3 graph1.json none none metrics_A.json profile
+# Or, sending straight to the other nodes, without space, with a loss probability of 0.1: python3 satellite.py A 3 graph1.json direct=0.1
 
-# Get variables from console
-args = sys.argv
+# Get variables from console. Flags (profile, direct) can go anywhere after the time graph
+args, flags = console_flags(sys.argv)
 
-if len(args)==4:
+if len(args) in (4, 5, 6, 7):
   id = args[1]
   priorities_amount = int(args[2])
   time_graph = args[3]
+  route_lists = args[4] if len(args) >= 5 and args[4] != 'none' else None
+  store = args[5] if len(args) >= 6 and args[5] != 'none' else None
+  metrics_file = args[6] if len(args) >= 7 else None
 else:
-  raise ValueError('ValueError: 3 values needed from console: id, amout of priority queues, time graph')
+  raise ValueError('ValueError: 3 values needed from console: id, amout of priority queues, time graph. Optional: route lists folder (or none), bundle store folder (or none), metrics file. Flags: profile, direct[=loss_prob]')
 
 # Create the node
 satellite = DTNnode(id, priorities_amount)
+# Bundles go straight to the next hop, the node makes them wait and loses some of them
+satellite.direct = flags['direct']
+satellite.loss_probability = flags['loss_probability']
 
 # Create and assign the time graph from the file
 time_graph = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/' + time_graph
@@ -26,33 +37,100 @@ satellite.bind(address)
 # Set the timeout for the receiving socket
 satellite.settimeout(1)
 
-for addr in satellite.address_list:
-  if (satellite.id != addr):
-    satellite.create_route_list(addr, 0)
+# Start from the precomputed route list, if there is one
+# A binary route table (.rt) is shared by all nodes, a folder has one route list per node
+if (route_lists is not None):
+  route_lists = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/' + route_lists
+  satellite.update_route_list(route_lists if route_lists.endswith('.rt') else route_lists + '/' + id + '.json')
+else:
+  satellite.create_route_lists(0)
+
+# Keep the bundles on disk, and recover the ones of a previous run
+if (store is not None):
+  satellite.open_store(store)
+
+# Write the metrics of the node, instead of printing what it does with each bundle
+if (metrics_file is not None):
+  satellite.open_metrics(metrics_file, flags['profile'])
+  satellite.verbose = False
 
 start_time = time.time()
 current_time = 0
 
-alarm_on = False
-send_queue_timer = 0
+# Starts of the contacts the node sends through. When one opens, the routes that
+# ended are forgotten and the limbo tries again, as in async_satellite.py
+graph = satellite.time_graph
+contact_starts = sorted(graph.start[graph.node_contacts(graph.labels[satellite.id])].tolist())
+next_contact = bisect.bisect_right(contact_starts, 0)
+# Bundles recovered from the store are routed again
+send_queue_timer = satellite.limbo_to_queue(0) if satellite.limbo_list else 0
+alarm_on = send_queue_timer > 0
+# Wake up for the first contact that opens, if nothing comes before
+if (next_contact < len(contact_starts) and (not alarm_on or contact_starts[next_contact] < send_queue_timer)):
+  alarm_on = True
+  send_queue_timer = max(contact_starts[next_contact], 1)
 
 # Main loop
 try:
   while True:
     # Listen for messages
-    send_queue_timer = satellite.recv(1024, current_time, alarm_on=alarm_on, timer=send_queue_timer)
+    send_queue_timer = satellite.recv(MAX_DATAGRAM, current_time, alarm_on=alarm_on, timer=send_queue_timer)
 
     # For keeping track of how much time has passed
     current_time = time.time() - start_time
 
+    # Discard the bundles that expired. Those that were in the store
+    # are deleted from it, which may start the compaction of its log
+    if (satellite.next_expiry is not None and satellite.next_expiry <= current_time):
+      satellite.drop_expired(current_time)
+
+    # A contact opened, queued bundles may go
+    if (next_contact < len(contact_starts) and contact_starts[next_contact] <= current_time):
+      next_contact = bisect.bisect_right(contact_starts, current_time)
+      satellite.refresh_route_lists(current_time)
+      send_queue_timer = satellite.send_bundles_in_queue(current_time)
+      alarm_on = send_queue_timer > 0
+
     # If it has to wait for the route to be available
     if (send_queue_timer > 0 and not alarm_on):
       alarm_on = True
     # If timer expired, start sending
     if (alarm_on and send_queue_timer==-1):
       alarm_on = False
-      satellite.send_bundles_in_queue(current_time)
+      send_queue_timer = satellite.send_bundles_in_queue(current_time)
+      # The alarm may have been for custody, so bundles that still wait set it again
+      if (send_queue_timer > 0):
+        alarm_on = True
+
+    # Send what was sent straight to other nodes and already got there
+    satellite.flush_outbox()
+
+    # Write the metrics, if it is time
+    satellite.metrics.maybe_snapshot()
+
+    # Send the custody signals that are due, and the bundles that were not accepted in time.
+    # Bundles sent again may have to wait for their route, like the ones received
+    retransmit_timer = satellite.custody_tick(current_time)
+    if (retransmit_timer > 0 and (not alarm_on or retransmit_timer < send_queue_timer)):
+      alarm_on = True
+      send_queue_timer = retransmit_timer
+    # Wake up when the next ones are due, unless the alarm already goes off sooner
+    custody_time = satellite.next_custody_time()
+    if (custody_time is not None):
+      custody_timer = max(custody_time - current_time, 1)
+      if (not alarm_on or custody_timer < send_queue_timer):
+        alarm_on = True
+        send_queue_timer = custody_timer
+    # And when the next bundle expires, or the next contact opens
+    wakeups = [t for t in (satellite.next_expiry, contact_starts[next_contact] if next_contact < len(contact_starts) else None) if t is not None]
+    if (wakeups):
+      wakeup_timer = max(min(wakeups) - current_time, 1)
+      if (not alarm_on or wakeup_timer < send_queue_timer):
+        alarm_on = True
+        send_queue_timer = wakeup_timer
 
 
 except KeyboardInterrupt:
+  if (satellite.store is not None): satellite.store.close()
+  satellite.metrics.write_snapshot()
   print('Program finished.')
\ No newline at end of file
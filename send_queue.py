@@ -0,0 +1,124 @@
+from __future__ import annotations
+import heapq
+from collections import deque
+from bundle import bundle
+
+class send_queue:
+  """
+  A class for the send queues of a node, one per priority. Bundles are
+  kept in deques, and the backlog of each queue (when the last queued
+  bundle can be sent) is kept updated as bundles come and go, so it
+  never has to be recalculated by going through the queue.
+  """
+
+  def __init__(self, n_priorities: int) -> None:
+    """
+    A class for the send queues of a node, one per priority.
+
+    Parameters
+    ----------
+    n_priorities: int
+      Number of priorities the bundles can have
+    """
+    self.queues = {}        # Deque of bundles of each priority, from highest to lowest
+    self.start_times = {}   # Max-heap (negated) of the first contact start time of the bundles of each priority
+    self.start_count = {}   # How many queued bundles of each priority have each start time
+    for p in range(n_priorities, 0, -1):
+      self.queues[p] = deque()
+      self.start_times[p] = []
+      self.start_count[p] = {}
+
+  def __getitem__(self, priority: int) -> deque:
+    """
+    Queue of the given priority
+    """
+    return self.queues[priority]
+
+  def __iter__(self):
+    """
+    Go through the priorities, from highest to lowest
+    """
+    return iter(self.queues)
+
+  def __len__(self) -> int:
+    """
+    Number of bundles in all the queues
+    """
+    return sum(len(q) for q in self.queues.values())
+
+  def values(self):
+    """
+    The queues of all priorities
+    """
+    return self.queues.values()
+
+  @staticmethod
+  def start_time(b: bundle) -> float:
+    """
+    When the first contact of the bundle's route starts
+    """
+    return b.get_route().start_time[b.get_next_hop()]
+
+  def account(self, b: bundle, sign: int) -> None:
+    """
+    Add (sign=1) or remove (sign=-1) a bundle from the backlog
+    """
+    p = b.priority
+    start = self.start_time(b)
+    count = self.start_count[p].get(start, 0) + sign
+    if (count > 0):
+      if (sign > 0 and count == 1): heapq.heappush(self.start_times[p], -start)
+      self.start_count[p][start] = count
+    else:
+      self.start_count[p].pop(start, None)
+
+  def append(self, b: bundle) -> None:
+    """
+    Add a bundle, with a route and next hop, at the end of the queue of its priority
+    """
+    self.queues[b.priority].append(b)
+    self.account(b, 1)
+
+  def peek(self, priority: int) -> bundle | None:
+    """
+    First bundle of the queue of the given priority, without removing it
+    """
+    queue = self.queues[priority]
+    return queue[0] if queue else None
+
+  def popleft(self, priority: int) -> bundle:
+    """
+    Remove and return the first bundle of the queue of the given priority
+    """
+    b = self.queues[priority].popleft()
+    self.account(b, -1)
+    return b
+
+  def remove_if(self, condition) -> list[bundle]:
+    """
+    Remove all bundles for which condition(bundle) is true, and return them
+    """
+    removed = []
+    for p, queue in self.queues.items():
+      kept = deque()
+      for b in queue:
+        if (condition(b)):
+          removed.append(b)
+          self.account(b, -1)
+        else:
+          kept.append(b)
+      self.queues[p] = kept
+    return removed
+
+  def available_time(self, priority: int) -> float:
+    """
+    Earliest time a new bundle of this priority could be sent, based on
+    the queue: when the latest first contact of the queued bundles starts.
+    0 if the queue is empty
+    """
+    heap = self.start_times[priority]
+    count = self.start_count[priority]
+    # Start times with no bundles left are removed lazily
+    while heap and -heap[0] not in count:
+      heapq.heappop(heap)
+    return -heap[0] if heap else 0
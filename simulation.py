@@ -0,0 +1,304 @@
+import sys, os, json, time, random
+from DTNnode import DTNnode
+from bundle import bundle
+from event_queue import event_queue
+from custody_signal import custody_signal
+from time_evolving_graph import time_evolving_graph
+
+# For example: python3 simulation.py graph2.json 3 traffic2.txt
+# Or, with a contact that is cancelled in the middle: python3 simulation.py graph2.json 3 traffic2_plan.txt
+
+class simulated_node(DTNnode):
+  """
+  A DTN node driven by the simulator. It uses the same routing
+  as a real node, but bundles are handed to the simulator instead
+  of being sent through space.
+  """
+
+  def __init__(self, id: str, n_priorities: int, simulator: 'simulation') -> None:
+    """
+    A DTN node driven by the simulator. It uses the same routing
+    as a real node, but bundles are handed to the simulator instead
+    of being sent through space.
+
+    Parameters
+    ----------
+    id : str
+      Unique identifier of the node
+    n_priorities: int
+      Number of priorities the bundles can have
+    simulator : simulation
+      The simulation the node belongs to
+    """
+    super().__init__(id, n_priorities, sockets=False)
+    self.simulator = simulator
+    self.verbose = False
+
+  def send(self, bundle: bundle) -> None:
+    """
+    Send a bundle forward to the next hop, through the simulator
+    """
+    self.simulator.transmit(self, bundle)
+
+  def send_signal(self, signal: custody_signal, custodian: str, distance: float) -> None:
+    """
+    Send a custody signal to a custodian, through the simulator
+    """
+    self.simulator.transmit_signal(signal, custodian, distance)
+
+  def deliver(self, recv_bundle: bundle, current_time: float) -> None:
+    """
+    A bundle reached its destination, let the simulator know
+    """
+    self.simulator.delivered(self, recv_bundle, current_time)
+
+
+class simulation:
+  """
+  A discrete-event simulation of a whole DTN in a single process.
+  Time is virtual: instead of waiting, the simulation jumps from one
+  event to the next (bundle arrivals, contact starts and ends, TTL expirations
+  and queue wake-ups), so contact plans run much faster than real time.
+  """
+
+  def __init__(self, file_path: str, n_priorities: int, loss_probability: float = 0, K: int = 0, seed: int = None) -> None:
+    """
+    A discrete-event simulation of a whole DTN in a single process.
+
+    Parameters
+    ----------
+    file_path : str
+      Time graph (.json) with the contact plan
+    n_priorities : int
+      Number of priority queues of each node
+    loss_probability : float
+      Probability of a bundle being lost, for each second it travels through space
+    K : int
+      Number of routes each node computes to each destination. 0 means all
+    seed : int
+      Seed for the random losses, for repeatable simulations
+    """
+    if (file_path.split('.')[-1] != 'json'):
+      raise TypeError('File is not .json')
+    with open(file_path) as f:
+      data = json.load(f)
+
+    # The time graph (and its contact graph) is shared by all nodes
+    self.time_graph = time_evolving_graph(data['labels'], data['edges'], data['start_time'], data['end_time'])
+    self.loss_probability = loss_probability
+    self.K = K
+    self.random = random.Random(seed)
+    self.events = event_queue()
+    self.now = data['start_time']   # Virtual time of the simulation
+    self.wakeups = set()            # Pending queue wake-ups, as (node id, time)
+    self.custody_wakeups = set()    # Pending custody wake-ups, as (node id, time)
+
+    # Statistics
+    self.injected = 0
+    self.delivered_bundles = {}     # First delivery time of each bundle
+    self.latencies = []
+    self.lost = 0
+    self.signals = 0                # Custody signals sent, and their bytes
+    self.signal_bytes = 0
+
+    # Create the nodes, all with the same contact plan
+    self.nodes = {}
+    for id in data['labels']:
+      node = simulated_node(id, n_priorities, self)
+      node.time_graph = self.time_graph
+      node.route_table = self.time_graph.route_table
+      node.address_list = {k: tuple(v) for k, v in data.get('addresses', {}).items()}
+      node.create_route_lists(self.now, K)
+      self.nodes[id] = node
+
+    # Contacts wake up the node that sends through them, when they start and end
+    self.label_list = {v: k for k, v in data['labels'].items()}
+    graph = self.time_graph
+    for sender, start, end in zip(graph.src.tolist(), graph.start.tolist(), graph.end.tolist()):
+      self.events.push(start, ('contact_start', self.label_list[sender]))
+      self.events.push(end, ('contact_end', self.label_list[sender]))
+
+  def inject(self, new_bundle: bundle, injection_time: float) -> None:
+    """
+    Add a bundle to the network, starting at its source node at the given time
+    """
+    if (new_bundle.source not in self.nodes):
+      raise ValueError('Source node ' + new_bundle.source + ' is not in the time graph')
+    new_bundle.creation_time = injection_time
+    self.injected += 1
+    self.events.push(injection_time, ('arrival', new_bundle.source, new_bundle))
+
+  def load_traffic(self, file_path: str) -> None:
+    """
+    Read bundles to inject from a file. Each line has the time of injection
+    and the bundle, parsed as a string, separated by a space.
+    Example: 0 A|||C|||00000000|||1|||0|||0|||1|||1000|||holii
+    A line can also change the contact plan: the time, 'plan' and the list of
+    changes in JSON, as in time_evolving_graph.apply_delta.
+    Example: 20 plan [{"action": "cancel", "index": 2}]
+    """
+    with open(file_path) as f:
+      for line in f:
+        line = line.strip()
+        if (not line or line.startswith('#')): continue
+        event_time, event = line.split(' ', 1)
+        if (event.startswith('plan ')):
+          self.change_contact_plan(json.loads(event[len('plan '):]), float(event_time))
+        else:
+          self.inject(bundle.to_bundle(event), float(event_time))
+
+  def change_contact_plan(self, delta: list, change_time: float) -> None:
+    """
+    Change the contact plan at the given time. The delta is a list of
+    changes, as in time_evolving_graph.apply_delta
+    """
+    self.events.push(change_time, ('contact_plan', None, delta))
+
+  def apply_contact_plan(self, delta: list) -> None:
+    """
+    Apply a change of the contact plan, which is shared by all nodes,
+    and let each node update the routes it affects
+    """
+    graph = self.time_graph
+    n_contacts = len(graph.src)
+    changed = graph.apply_delta(delta)
+    # New contacts also wake up the node that sends through them
+    for c in range(n_contacts, len(graph.src)):
+      sender = self.label_list[int(graph.src[c])]
+      self.events.push(max(self.now, float(graph.start[c])), ('contact_start', sender))
+      self.events.push(max(self.now, float(graph.end[c])), ('contact_end', sender))
+    for node in self.nodes.values():
+      node.update_routes(changed, self.now, self.K)
+      self.schedule_wakeup(node, node.send_bundles_in_queue(self.now))
+
+  def schedule_wakeup(self, node: simulated_node, delta_time: float) -> None:
+    """
+    Wake a node up after delta_time, if it has to wait for a route
+    """
+    if (delta_time <= 0): return
+    wakeup = (node.id, self.now + delta_time)
+    if (wakeup not in self.wakeups):
+      self.wakeups.add(wakeup)
+      self.events.push(wakeup[1], ('wakeup', node.id))
+
+  def transmit(self, node: simulated_node, sent_bundle: bundle) -> None:
+    """
+    A node sent a bundle. It arrives to the next hop after the distance between
+    them, unless it gets lost in space
+    """
+    next_hop = sent_bundle.get_next_hop()
+    distance = sent_bundle.get_route().distance[next_hop]
+    # Each second travelled has the same probability of losing the bundle
+    if (self.random.random() < 1 - (1 - self.loss_probability) ** distance):
+      self.lost += 1
+      return
+    self.events.push(self.now + distance, ('arrival', next_hop, sent_bundle))
+
+  def transmit_signal(self, signal: custody_signal, custodian: str, distance: float) -> None:
+    """
+    A node sent a custody signal. It arrives to the custodian after the distance
+    between them, unless it gets lost in space too
+    """
+    self.signals += 1
+    self.signal_bytes += len(signal.to_bytes())
+    if (self.random.random() < 1 - (1 - self.loss_probability) ** distance): return
+    self.events.push(self.now + distance, ('signal', custodian, signal))
+
+  def schedule_custody(self, node: simulated_node) -> None:
+    """
+    Wake a node up when it has to send custody signals, or send again a bundle in custody
+    """
+    custody_time = node.next_custody_time()
+    if (custody_time is None): return
+    wakeup = (node.id, max(custody_time, self.now))
+    if (wakeup not in self.custody_wakeups):
+      self.custody_wakeups.add(wakeup)
+      self.events.push(wakeup[1], ('custody', node.id))
+
+  def delivered(self, node: simulated_node, recv_bundle: bundle, current_time: float) -> None:
+    """
+    A bundle reached its destination. Only the first copy counts for the statistics
+    """
+    key = (recv_bundle.source, recv_bundle.creation_time, recv_bundle.message)
+    if (key in self.delivered_bundles): return
+    self.delivered_bundles[key] = current_time
+    self.latencies.append(current_time - recv_bundle.creation_time)
+
+  def step(self) -> None:
+    """
+    Process the next event
+    """
+    self.now, event = self.events.pop()
+    kind, node_id = event[0], event[1]
+    if (kind == 'contact_plan'):
+      self.apply_contact_plan(event[2])
+      return
+    node = self.nodes[node_id]
+
+    if (kind == 'arrival'):
+      recv_bundle = event[2]
+      # Wake the node up when the bundle expires, for discarding it
+      deadline = recv_bundle.get_deadline()
+      if (deadline != -1 and deadline > self.now):
+        self.events.push(deadline, ('expire', node_id))
+      self.schedule_wakeup(node, node.process_bundle(recv_bundle, self.now))
+    elif (kind == 'expire'):
+      node.drop_expired(self.now)
+    elif (kind == 'signal'):
+      node.process_custody_signal(event[2], self.now)
+    elif (kind == 'custody'):
+      self.custody_wakeups.discard((node_id, self.now))
+      self.schedule_wakeup(node, node.custody_tick(self.now))
+    else:
+      if (kind == 'wakeup'):
+        self.wakeups.discard((node_id, self.now))
+      elif (kind == 'contact_start'):
+        # Routes that ended are forgotten, and a new contact may give a route to the bundles in limbo
+        node.refresh_route_lists(self.now)
+      # Try to send what is in the queues
+      self.schedule_wakeup(node, node.send_bundles_in_queue(self.now))
+    self.schedule_custody(node)
+
+  def run(self, until: float = None) -> None:
+    """
+    Run the simulation until there are no more events, or until the given time
+    """
+    while self.events:
+      if (until is not None and self.events.peek_time() > until): break
+      self.step()
+
+  def summary(self) -> str:
+    """
+    Statistics of the simulation
+    """
+    delivered = len(self.delivered_bundles)
+    ratio = delivered / self.injected if self.injected else 0
+    latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0
+    queued = sum(len(q) for n in self.nodes.values() for q in n.send_queue.values())
+    limbo = sum(len(n.limbo_list) for n in self.nodes.values())
+    summary = ('Virtual time: {now}s\nBundles injected: {inj}\nBundles delivered: {dlv} ({ratio:.1%})\n'
+               'Mean latency: {lat:.2f}s\nLost in space: {lost}\nStill in queues: {queued}\nStill in limbo: {limbo}').format(
+      now=self.now, inj=self.injected, dlv=delivered, ratio=ratio, lat=latency, lost=self.lost, queued=queued, limbo=limbo)
+    # Only when bundles were sent with custody
+    if (self.signals > 0):
+      in_custody = sum(len(n.custody_list) for n in self.nodes.values())
+      summary += '\nCustody signals: {n} ({size} bytes)\nStill in custody: {custody}'.format(n=self.signals, size=self.signal_bytes, custody=in_custody)
+    return summary
+
+
+if __name__ == '__main__':
+  # Get variables from console
+  args = sys.argv
+  if (len(args) < 4):
+    raise ValueError('ValueError: 3 values needed from console: time graph, amount of priority queues, traffic file. Optional: loss probability, K')
+
+  dir_path = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+  loss_probability = float(args[4]) if len(args) > 4 else 0
+  K = int(args[5]) if len(args) > 5 else 0
+
+  wall_start = time.time()
+  sim = simulation(dir_path + args[1], int(args[2]), loss_probability, K)
+  sim.load_traffic(dir_path + args[3])
+  sim.run()
+  print(sim.summary())
+  print('Wall time:', str(round(time.time() - wall_start, 3)) + 's')
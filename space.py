@@ -1,95 +1,152 @@
 from bundle import bundle
-import socket, time, sys, random, os
-
-# Get variables from console
-try:
-  loss_probability = float(sys.argv[1]) #Between 0 and 1
-  loss_causes = [
-    'It hit an asteroid!',
-    'A cosmic laser got in the way!!',
-    'Space swalloed it, nobody know where it went...',
-    'Someone though this was important and stole it.'
-  ]
-except (IndexError, ValueError):
-  loss_probability = 0
-
-dir_path = os.path.dirname(os.path.realpath(__file__))
-spaceAddress_file = dir_path + '/time_graphs/space_address.txt'
-with open(spaceAddress_file) as f:
-  a = f.read().split()
-  spaceAddress = (a[0], int(a[1]))
+from event_queue import event_queue
+from metrics import metrics
+from datagram_reader import datagram_reader, MAX_DATAGRAM
+from DTNnode import spaceAddress, space_addresses
+from launcher import launch, as_child, shard_file
+import socket, time, sys, random, os, json
+
+# For example: python3 space.py 0.1
+# Or, writing its metrics instead of printing each bundle: python3 space.py 0.1 metrics_space.json
+# Or, in the shards given by the 'space_shards' of a contact plan, one process each: python3 space.py 0.1 none walker66.json
+
+loss_causes = [
+  'It hit an asteroid!',
+  'A cosmic laser got in the way!!',
+  'Space swalloed it, nobody know where it went...',
+  'Someone though this was important and stole it.'
+]
 
 class travelling_bundle:
   """
   Class that simulates a bundle travelling through space.
-  It receives the bundle, sleeps the distance in seconds
-  and afterwards sends it to the destionation.
+  It receives the bundle, and when its delivery time comes
+  it is sent to the destination, through the socket of space.
   """
-  def __init__(self, bundle: bundle, distance : int, destination: tuple[str, int], next_hop_id: str) -> None:
-    self.bundle = bundle    # The bundle to be sent
-    self.timer = distance   # How much time it needs to travel
-    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # The socket to send the bundle
+  __slots__ = ('bundle_data', 'distance', 'destination', 'next_hop_id')
+
+  def __init__(self, bundle_data: bytes, distance : float, destination: tuple[str, int], next_hop_id: str) -> None:
+    self.bundle_data = bundle_data  # The encoded bundle to be sent, in the same format it arrived
+    self.distance = distance  # How much time it needs to travel
     self.destination = destination
     self.next_hop_id = next_hop_id
 
-  def send(self) -> None:
+  def send(self, sock: socket.socket, verbose: bool = True) -> None:
     """
     Send the associated bundle to the next hop
     """
-    self.socket.sendto(str(self.bundle).encode(), self.destination)
-    print('Bundle arriving to node', self.next_hop_id, '\n')
+    sock.sendto(self.bundle_data, self.destination)
+    if (verbose): print('Bundle arriving to node', self.next_hop_id, '\n')
+
+
+def run(loss_probability: float, metrics_file: str = None, address: tuple[str, int] = spaceAddress) -> None:
+  """
+  Bind space and run it until it is interrupted
+  """
+  # Counters and latencies of space, written to a file if one is given
+  space_metrics = metrics(metrics_file)
+  verbose = space_metrics.snapshot_file is None   # Printing each bundle costs time, the metrics say the same
+
+  # Create the socket for space, which will receive the bundles
+  # and store them before passing on. The same socket sends them
+  spaceSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  spaceSocket.bind(address)
+  reader = datagram_reader(spaceSocket, MAX_DATAGRAM)
+
+  # Bundles that are still travelling, ordered by the time they must be delivered
+  bundle_queue = event_queue()
+  space_metrics.gauge('in_flight', lambda: len(bundle_queue))
+
+  start_time = time.monotonic()
+
+  def receive(data: memoryview) -> None:
+    """
+    A bundle entered space. Unless it is lost, it waits until it reaches its next hop
+    """
+    # Get the address and distance to the next hop, the bundle itself is not decoded
+    parse_start = time.perf_counter()
+    destination, next_hop_id, distance, bundle_data = bundle.from_space_bytes(data)
+    space_metrics.observe('parse', time.perf_counter() - parse_start)
+    space_metrics.count('received')
+
+    # Probability of bundle getting lost in space, for each second it travels
+    if (random.random() < 1 - (1 - loss_probability) ** distance):
+      space_metrics.count('dropped.loss')
+      if (verbose): print('Bundle lost. ' + random.choice(loss_causes) + ' \n')
+      return
+
+    # Create a new instance that will wait until its delivery time.
+    # The data is copied out of the receive buffer, which is reused
+    new_bundle = travelling_bundle(bytes(bundle_data), distance, destination, next_hop_id)
+    bundle_queue.push(time.monotonic() + distance, new_bundle)
+    if (verbose): print('Bundle travelling through space to the next hop, node {hop_id}. Has to travel {dist} light-seconds. Elapsed time: {t}s\n'.format(
+      hop_id=next_hop_id, dist=distance, t=round(time.monotonic()-start_time)))
+
+  try:
+    print('Space running.')
+    while True:
+      # Deliver all bundles whose travelling time already passed
+      now = time.monotonic()
+      while bundle_queue and bundle_queue.peek_time() <= now:
+        _, b = bundle_queue.pop()
+        b.send(spaceSocket, verbose)
+        space_metrics.count('delivered')
+      space_metrics.maybe_snapshot()
+
+      # Sleep until the next bundle must be delivered, or until a new one arrives
+      # Also wake up for the next snapshot of the metrics
+      next_delivery = bundle_queue.peek_time()
+      if (space_metrics.snapshot_file is not None):
+        next_delivery = min(next_delivery, space_metrics.next_snapshot) if next_delivery is not None else space_metrics.next_snapshot
+      if (next_delivery is None):
+        spaceSocket.settimeout(None)
+      else:
+        spaceSocket.settimeout(max(next_delivery - time.monotonic(), 0.0001))
+
+      try:
+        # Receive bundles
+        data = reader.read()
+      except TimeoutError:
+        continue
+      receive(data)
+      # And the ones that arrived meanwhile, without waiting for more
+      for data in reader.pending():
+        receive(data)
+  finally:
+    space_metrics.write_snapshot()
+
+def run_shard(loss_probability: float, metrics_file: str, address: tuple[str, int], shard: int) -> None:
+  """
+  Run one shard of space, in its own process. Each shard writes its metrics
+  to its own file, with the number of the shard added
+  """
+  as_child()
+  try:
+    run(loss_probability, shard_file(metrics_file, shard) if metrics_file is not None else None, address)
+  except KeyboardInterrupt:
+    print('Space shard', shard, 'finished.')
 
 
-# Create the socket for space, which will receive the bundles
-# and store them before passing on.
-# The timeout is used for updating the bundle timers, one second at a time
-spaceSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-spaceSocket.settimeout(1)
-spaceSocket.bind(spaceAddress)
+if __name__ == '__main__':
+  # Get variables from console
+  try:
+    loss_probability = float(sys.argv[1]) #Between 0 and 1
+  except (IndexError, ValueError):
+    loss_probability = 0
 
-# List of bundles that are still waiting
-bundle_list = []
+  metrics_file = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != 'none' else None
 
-start_time = time.time()
+  # The contact plan says in how many shards space is split
+  addresses = [spaceAddress]
+  if (len(sys.argv) > 3):
+    with open(os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/' + sys.argv[3]) as f:
+      addresses = space_addresses(json.load(f))
 
-try:
-  print('Space running. Elapsed time:', str(round(time.time()-start_time)) + 's')
-  while True:
+  if (len(addresses) > 1):
+    launch(run_shard, [(loss_probability, metrics_file, address, shard) for shard, address in enumerate(addresses)])
+    print('Program finished.')
+  else:
     try:
-      # Receive bundles
-      bundle_recv, _ = spaceSocket.recvfrom(10000)
-      bundle_recv, destination, next_hop_id = bundle_recv.decode().split('###')
-      bundle_recv = bundle.to_bundle(bundle_recv)
-      # Get the distance between the nodes
-      distance = bundle_recv.route['distance'][next_hop_id]
-      # Get the destination address
-      destination_split = destination.split(',')
-      destination = (destination_split[0][2:-1], int(destination_split[1][1:-1]))
-
-      # Create a new instance that will wait and add it to the list
-      new_bundle = travelling_bundle(bundle_recv, distance, destination, next_hop_id)
-      bundle_list.append(new_bundle)
-      print('Bundle travelling through space to the next hop, node {hop_id}. Has to travel {dist} light-seconds\n'.format(hop_id=next_hop_id, dist=distance))
-    except TimeoutError:
-      # Every second, see if bundles must be sent
-      for b in bundle_list:
-        if (b.timer <= 0):
-          # If timer expired, send the bundle and remove from list
-          b.send()
-          bundle_list.remove(b)
-        else:
-          # Else, decrease timer in one second
-          b.timer -= 1
-          # Probability of bundle getting lost in space
-          n = random.random()
-          if (n < loss_probability):
-            bundle_list.remove(b)
-            print('Bundle lost. ' + random.choice(loss_causes) + ' \n')
-
-
-      print ("\033[A\033[A")
-      print('Space running. Elapsed time:', str(round(time.time()-start_time)) + 's')
-      continue
-
-except KeyboardInterrupt:
-    print('Program finished.')
\ No newline at end of file
+      run(loss_probability, metrics_file)
+    except KeyboardInterrupt:
+      print('Program finished.')
@@ -0,0 +1,185 @@
+import os, json, random
+from DTNnode import DTNnode
+from bundle import bundle
+from route_cache import route_cache
+from simulation import simulation
+from time_evolving_graph import time_evolving_graph
+
+# Behavior of the routing: routes, the route cache and the route table. Run with: python3 -m pytest
+
+GRAPHS = os.path.dirname(os.path.realpath(__file__)) + '/time_graphs/'
+
+def random_mesh(seed: int, n_nodes: int = 6, n_contacts: int = 30) -> time_evolving_graph:
+  """
+  A contact plan with random contacts between a few nodes
+  """
+  rnd = random.Random(seed)
+  labels = {chr(ord('A') + i): i for i in range(n_nodes)}
+  edges = []
+  for _ in range(n_contacts):
+    src, dst = rnd.sample(range(n_nodes), 2)
+    start = rnd.randint(0, 80)
+    edges.append({'contact': [src, dst], 'start_time': start, 'end_time': start + rnd.randint(5, 40),
+                  'distance': rnd.randint(1, 5), 'rate': 20})
+  return time_evolving_graph(labels, edges, 0, 120)
+
+def load_graph(name: str) -> time_evolving_graph:
+  """
+  A contact plan of the time_graphs folder
+  """
+  with open(GRAPHS + name) as f:
+    data = json.load(f)
+  return time_evolving_graph(data['labels'], data['edges'], data['start_time'], data['end_time'])
+
+def ids(routes) -> list:
+  """
+  The ids of some routes, to compare them
+  """
+  return [r.id for r in routes]
+
+def through(routes, contact: int) -> list:
+  """
+  The routes that go through a contact
+  """
+  return [r for r in routes if contact in (r.contacts or ())]
+
+
+def test_first_k_routes_are_a_prefix():
+  for seed in range(20):
+    graph = random_mesh(seed)
+    for destination in 'BCDEF':
+      every_route = graph.get_routes('A', destination, 0, 0)
+      for K in (1, 2, 3, 5):
+        assert ids(graph.get_routes('A', destination, K, 0)) == ids(every_route[:K])
+
+def test_routes_are_loop_free_and_ordered():
+  graph = load_graph('graph2.json')
+  for origin in graph.labels:
+    for destination in graph.labels:
+      if (origin == destination): continue
+      routes = graph.get_routes(origin, destination, 0, 0)
+      assert routes
+      arrivals = [r.total_time for r in routes]
+      assert arrivals == sorted(arrivals)
+      for r in routes:
+        assert len(set(r.nodes)) == len(r.nodes)
+        assert r.nodes[0] == origin and r.nodes[-1] == destination
+        # Each contact goes from one node of the path to the next
+        for c, (src, dst) in zip(r.contacts, zip(r.nodes, r.nodes[1:])):
+          assert (int(graph.src[c]), int(graph.dst[c])) == (graph.labels[src], graph.labels[dst])
+
+def test_all_routes_match_each_destination():
+  for seed in range(20):
+    graph = random_mesh(seed)
+    for start_time in (0, 30):
+      for K in (0, 2):
+        every_destination = graph.get_all_routes('A', K, start_time)
+        assert set(every_destination) == set('BCDEF')
+        for destination, routes in every_destination.items():
+          assert ids(routes) == ids(graph.get_routes('A', destination, K, start_time))
+
+def test_route_cache_evicts_and_computes_again():
+  graph = load_graph('graph2.json')
+  computed = []
+  def compute(destination: str, current_time: float) -> list:
+    computed.append(current_time)
+    return graph.get_routes('A', destination, 2, current_time)
+
+  cache = route_cache(compute)
+  cache.K = 2
+  cache['D'] = graph.get_routes('A', 'D', 2, 0)
+  # Both routes can be used until their first contact ends, at 90
+  assert [r.expiry_time() for r in cache['D']] == [90, 90]
+  assert len(cache.viable('D', 50)) == 2 and not computed
+  # Then they are evicted, and new ones are computed from that time on
+  routes = cache.viable('D', 95)
+  assert computed == [95]
+  assert routes and all(r.expiry_time() > 95 for r in routes)
+
+  # All the routes there can be were found, so none are computed once they expire
+  cache.K = 0
+  cache['C'] = graph.get_routes('A', 'C', 0, 0)
+  assert cache.viable('C', 130) == [] and computed == [95]
+
+def test_route_table_prune():
+  graph = load_graph('graph2.json')
+  table = graph.route_table
+  graph.get_all_routes('A', 0, 0)
+  known = len(table)
+  assert table.prune(95) > 0
+  assert 0 < len(table) < known
+  # Only the routes whose last contact ended are removed
+  assert all(max(r.end_time.values()) > 95 for r in table.routes.values())
+  for contact, route_ids in table.by_contact.items():
+    assert route_ids <= set(table.routes)
+
+def test_volume_booked_and_given_back():
+  sim = simulation(GRAPHS + 'graph2.json', 3)
+  node = sim.nodes['D']
+  full = [node.residual_volume(c) for c in range(len(sim.time_graph.src))]
+  # D can't send anything until its first contact starts, at 20
+  expiring = bundle('x' * 100, 'D', 'A', deadline=100)
+  node.process_bundle(expiring, 0)
+  contacts = expiring.get_route().contacts
+  assert len(node.send_queue) == 1 and len(contacts) > 1
+  for c in contacts:
+    assert node.residual_volume(c) == full[c] - expiring.get_size()
+  node.drop_expired(100)
+  assert len(node.send_queue) == 0
+  assert [node.residual_volume(c) for c in range(len(full))] == full
+
+  # Also when it is discarded from the front of the queue
+  late = bundle('x' * 100, 'D', 'A', deadline=100)
+  node.process_bundle(late, 0)
+  assert node.residual_volume(contacts[0]) == full[contacts[0]] - late.get_size()
+  node.send_bundles_in_queue(100)
+  assert len(node.send_queue) == 0
+  assert [node.residual_volume(c) for c in range(len(full))] == full
+
+def test_batch_never_overbooks():
+  sim = simulation(GRAPHS + 'graph2.json', 3)
+  node = sim.nodes['D']
+  volumes = sim.time_graph.volumes
+  # Many more bytes than the contacts of D can carry, of every priority
+  batch = [bundle('x' * 300, 'D', destination, p=1 + i % 3) for i in range(30) for destination in 'ABC']
+  node.add_batch_to_queue(batch, 0)
+  assert len(node.send_queue) > 0 and len(node.limbo_list) > 0
+  assert all(booked <= volumes[c] for c, booked in node.contact_booked.items())
+  # What is booked is what the queued bundles still have to carry
+  queued = {}
+  for queue in node.send_queue.values():
+    for b in queue:
+      for c in b.get_route().contacts[b.hop-1:]:
+        queued[c] = queued.get(c, 0) + b.get_size()
+  assert queued == {c: booked for c, booked in node.contact_booked.items() if booked}
+
+def test_cancelled_contact_leaves_routes():
+  sim = simulation(GRAPHS + 'graph2.json', 3)
+  sim.load_traffic(GRAPHS + 'traffic2_plan.txt')
+  table = sim.time_graph.route_table
+  # The contact from C to D, which the traffic file cancels at 10
+  cancelled = 8
+  assert through(sim.nodes['A'].route_list['D'], cancelled)
+  assert through(table.routes.values(), cancelled)
+
+  sim.run(until=10)
+  for node in sim.nodes.values():
+    for _, routes in node.route_list.items():
+      assert not through(routes, cancelled)
+  assert not through(table.routes.values(), cancelled)
+  assert not table.by_contact.get(cancelled)
+  # There are still routes to D, through other contacts
+  assert sim.nodes['A'].route_list['D']
+
+def test_node_contact_delta():
+  node = DTNnode('A', 3, sockets=False)
+  node.verbose = False
+  node.assign_time_graph(GRAPHS + 'graph2.json')
+  node.create_route_lists(0)
+  cancelled = 8
+  assert through(node.route_list['D'], cancelled)
+
+  assert 'D' in node.apply_contact_delta([{'action': 'cancel', 'index': cancelled}], 10)
+  for _, routes in node.route_list.items():
+    assert not through(routes, cancelled)
+  assert not through(node.route_table.routes.values(), cancelled)
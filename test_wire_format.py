@@ -0,0 +1,126 @@
+import os
+from bundle import bundle
+from bundle_store import bundle_store, RECORD_HEADER, OP_PUT, LOG_NAME
+from custody_signal import custody_signal
+
+# Behavior of the wire formats, fragments and the bundle store. Run with: python3 -m pytest
+
+def fields(b: bundle) -> tuple:
+  """
+  What a bundle carries on the wire
+  """
+  return (b.source, b.destination, b.priority, b.critical, b.custody, b.fragment, b.get_deadline(), bytes(b.payload()),
+          b.fragment_id, b.fragment_offset, b.total_length, b.custodian, b.custody_id)
+
+def custody_bundle() -> bundle:
+  """
+  A bundle sent with custody, held by node A
+  """
+  b = bundle('custody from A', 'A', 'D', p=2, cust=True, deadline=500)
+  b.custodian, b.custody_id = 'A', 42
+  return b
+
+def cut_fragment() -> bundle:
+  """
+  The first fragment of a bundle, cut in the middle of a character of two bytes
+  """
+  b = bundle('hé, fragmented', 'A', 'C', deadline=100)
+  fragment, _ = b.split(b.fragment_overhead() + 2)
+  assert bytes(fragment.payload()) == 'hé'.encode()[:2]
+  return fragment
+
+
+def test_binary_round_trip_fragment():
+  fragment = cut_fragment()
+  assert fields(bundle.from_bytes(fragment.to_bytes())) == fields(fragment)
+
+def test_binary_round_trip_custodian():
+  b = custody_bundle()
+  assert fields(bundle.decode(b.to_bytes())) == fields(b)
+
+def test_text_round_trip_fragment():
+  fragment = cut_fragment()
+  assert fields(bundle.decode(fragment.to_text_bytes())) == fields(fragment)
+
+def test_text_round_trip_custodian():
+  b = custody_bundle()
+  assert fields(bundle.decode(b.to_text_bytes())) == fields(b)
+
+def test_reassemble_out_of_order():
+  b = bundle('a message long enough to be split in a few fragments', 'A', 'C')
+  fragments = b.fragment_message(b.fragment_overhead() + 10)
+  assert len(fragments) > 2
+  whole = bundle.reassemble(fragments[::-1])
+  assert whole.get_message() == b.get_message() and not whole.is_fragment()
+
+def test_reassemble_overlapping():
+  b = bundle('fragments of fragments overlap with their parent', 'A', 'C')
+  first, rest = b.split(b.fragment_overhead() + 12)
+  middle, _ = rest.split(rest.fragment_overhead() + 8)
+  # The middle one is also inside rest, which arrives as well
+  whole = bundle.reassemble([middle, rest, first])
+  assert whole.get_message() == b.get_message()
+
+def test_store_reopen_after_partial_record(tmp_path):
+  store = bundle_store(str(tmp_path))
+  kept = [bundle('bundle ' + str(i), 'A', 'C') for i in range(3)]
+  for b in kept:
+    store.put(b)
+  store.delete(kept[1])
+  store.close()
+  size = os.path.getsize(store.path)
+  # A crash in the middle of writing a record leaves only part of it
+  with open(store.path, 'ab') as f:
+    f.write(RECORD_HEADER.pack(OP_PUT, 99, 100, 0) + b'cut')
+
+  store = bundle_store(str(tmp_path))
+  assert [b.get_message() for b in store.bundles()] == ['bundle 0', 'bundle 2']
+  assert os.path.getsize(store.path) == size
+  # The log goes on where the last whole record ended
+  store.put(bundle('after the crash', 'A', 'C'))
+  store.close()
+  store = bundle_store(str(tmp_path))
+  assert [b.get_message() for b in store.bundles()] == ['bundle 0', 'bundle 2', 'after the crash']
+  store.close()
+
+def test_store_reopen_empty_log(tmp_path):
+  # A crash right after the log was created leaves it empty
+  open(os.path.join(str(tmp_path), LOG_NAME), 'wb').close()
+  store = bundle_store(str(tmp_path))
+  assert len(store) == 0
+  store.put(bundle('after the crash', 'A', 'C'))
+  store.close()
+  store = bundle_store(str(tmp_path))
+  assert [b.get_message() for b in store.bundles()] == ['after the crash']
+  store.close()
+
+def test_store_compacts_while_in_use(tmp_path):
+  # Any deleted bytes are enough, so deleting most bundles starts the compaction
+  store = bundle_store(str(tmp_path), compact_bytes=1)
+  stored = [bundle('bundle ' + str(i), 'A', 'C') for i in range(200)]
+  for b in stored:
+    store.put(b)
+  full_size = store.end
+  for b in stored[:150]:
+    store.delete(b)
+  # The node goes on while the log is rewritten
+  later = [bundle('later ' + str(i), 'A', 'C') for i in range(50)]
+  for b in later:
+    store.put(b)
+  for b in later[::2]:
+    store.delete(b)
+  expected = [b.get_message() for b in stored[150:] + later[1::2]]
+  assert [b.get_message() for b in store.bundles()] == expected
+  store.close()
+  assert os.path.getsize(store.path) < full_size
+  store = bundle_store(str(tmp_path))
+  assert [b.get_message() for b in store.bundles()] == expected
+  store.close()
+
+def test_custody_ranges_round_trip():
+  ids = [7, 3, 4, 5, 12, 1, 4, 13]
+  ranges = custody_signal.to_ranges(ids)
+  assert ranges == [(1, 1), (3, 3), (7, 1), (12, 2)]
+  signal = custody_signal.from_bytes(custody_signal('B', 'A', ids).to_bytes())
+  assert (signal.sender, signal.custodian, signal.ranges) == ('B', 'A', ranges)
+  assert list(signal.ids()) == sorted(set(ids)) and len(signal) == len(set(ids))
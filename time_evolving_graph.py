@@ -1,11 +1,16 @@
 import igraph as ig
+import numpy as np
 import matplotlib.pyplot as plt
 from contact_graph import contact_graph
+from route_table import route_table
 
 class time_evolving_graph:
   """
   A class for representing a time evolving graph of satellite
-  nodes, as they change over time
+  nodes, as they change over time.
+  The contact plan is kept in columnar NumPy arrays (one entry per contact,
+  in the same order as in the plan), with indexes for searching contacts by
+  start time and by the node they start from.
   """
   def __init__(self, labels: dict, edges: dict, start_time: int, end_time: int, layout: str = 'rt'):
     """
@@ -37,109 +42,222 @@ class time_evolving_graph:
     self.graph.es['rate'] = [d['rate'] for d in edges]
     self.start_time = start_time
     self.end_time = end_time
-    self.layout = self.graph.layout(layout)   # The layour for drawing
+    self.layout_name = layout       # Layout algorithm, only computed when drawing
+    self.layout = None              # The layout for drawing
+
+    # Contact plan as arrays, the index of each contact is its index in the plan
+    contacts = np.array([d['contact'] for d in edges], dtype=np.int64).reshape(-1, 2)
+    self.src = contacts[:, 0]                                             # Node each contact starts from
+    self.dst = contacts[:, 1]                                             # Node each contact goes to
+    self.start = np.array([d['start_time'] for d in edges], dtype=float)  # Start time of each contact
+    self.end = np.array([d['end_time'] for d in edges], dtype=float)      # End time of each contact
+    self.distance = np.array([d['distance'] for d in edges], dtype=float) # One way light time of each contact
+    self.rate = np.array([d['rate'] for d in edges], dtype=float)         # Rate of each contact
+    self.volumes = self.rate * (self.end - self.start)                    # Bytes each contact can carry
+    self.index_contacts()
     self.visual_style = {}          # Dictionary for storing the visual style options for drawing
+    self.contact_graph = None       # Contact graph of the whole plan, built the first time it is needed
+    self.route_table = route_table()  # Routes found on this plan, shared by all the nodes that use it
+
+  def index_contacts(self) -> None:
+    """
+    Build the index of the contact plan: contacts grouped by the node they
+    start from (sorted by start time inside each group), with the offset
+    where each node's group begins
+    """
+    self.by_source = np.lexsort((self.start, self.src))
+    counts = np.bincount(self.src, minlength=self.n_vertices)
+    self.source_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+  def node_contacts(self, node: int) -> np.ndarray:
+    """
+    Indexes of the contacts starting from a node, sorted by start time
+    """
+    return self.by_source[self.source_offsets[node]:self.source_offsets[node+1]]
+
+  def contacts_between(self, origin: int, destination: int) -> np.ndarray:
+    """
+    Indexes of the contacts from origin to destination, sorted by start time
+    """
+    out = self.node_contacts(origin)
+    return out[self.dst[out] == destination]
 
   def plot(self, curved_edges : bool | list = False) -> None:
     """
     Plot the graph with the layout defined at the start.
     It needs a list of the edges that need to be curved, for avoiding others
     """
+    if (self.layout is None):
+      self.layout = self.graph.layout(self.layout_name)
     fig, ax = plt.subplots(figsize=(7, 7))
     ig.plot(self.graph, target=ax, layout=self.layout, edge_curved=curved_edges,
       edge_label=['[{start},{end}]'.format(start=d['start_time'], end=d['end_time']) for d in self.graph.es],
       vertex_label=self.labels.keys())
     plt.show()
 
-  def to_contact_graph(self, origin_node: str, destination_node: str) -> contact_graph:
-    """
-    Transforms this graph into a contact graph from the desired origin to destination
-    """
-    if (origin_node == destination_node):
-      raise ValueError("Origin same as destination")
-    origin = self.labels[origin_node]
-    destination = self.labels[destination_node]
-    # Gets all paths from origin node to destination
-    paths = self.graph.get_all_simple_paths(origin, destination)
-    if (not paths):
-      print('No paths from origin to destination')
-      return None
-    contacts = {}   # Dictionary for storing all contacts for each node
-    # Goes through all the paths found
-    for p in paths:
-      n = len(p)
-      # For each path, go through each node it visits
-      for i in range(n-1):
-        node = p[i]
-        # And for each node, get all edges from it to the next node on the path
-        edges = self.graph.es.select(_source_eq = node, _target_eq = p[i+1])
-        # Get the array of contacts for this node
-        try:
-          c = contacts[node]
-        except KeyError:
-          c = []  # If it doesn't exists, create it
-        for e in edges:
-          # Append all edges, which are the contacts between this and the next node in the path
-          c.append(e.attributes())
-        contacts[node] = c
-
-    ## First, the vertices for the contact graph are calculated
-
-    label_list = list(self.labels.keys())
-
-    # Start the variables for the contact graph,
-    # with the values for the origin node
-    n_vertices = 0
-    contact_nodes = {n_vertices : [origin, origin]}
-    start_times = [self.start_time]
-    end_times = [self.end_time]
-    distances = [0]
-    labels = [origin_node + '-' + origin_node]
-    rates = [100000]  # Big number for rate for first contact, in theory is infinite from A to A
-    # Go through all nodes
-    for node in contacts:
-      # For each node, go through all contacts of it
-      for c in contacts[node]:
-        n_vertices += 1                         # Add to the number of vertices for the contact graph
-        contact = c['contact']
-        contact_nodes[n_vertices] = (contact)   # Assign the next index of the graph to this contact
-        start_times.append(c['start_time'])     # Add the properties
-        end_times.append(c['end_time'])
-        distances.append(c['distance'])
-        labels.append(str(label_list[contact[0]]) + '-' + str(label_list[contact[1]]))
-        rates.append(c['rate'])
-    # In the end, add the final contact destination-destination
-    n_vertices += 1
-    contact_nodes[n_vertices] = ([destination, destination])
-    start_times.append(self.start_time)
-    end_times.append(self.end_time)
-    distances.append(0)
-    labels.append(destination_node + '-' + destination_node)
-    rates.append(100000)
-
-    ## Next, we get the edges connecting each vertex
-    edges = []
-    for c in contact_nodes:
-      dest_node = contact_nodes[c][1]
-      # Check all other vertices that should be connected to this contact
-      connections = [k for k,v in contact_nodes.items() if v[0]==dest_node]
-      for next_node in connections:
-        if c!=next_node:
-          edges.append([c, next_node])
+  def to_contact_graph(self) -> contact_graph:
+    """
+    Transforms this graph into the contact graph of the whole contact plan.
+    It is built only once and shared by all (origin, destination) queries,
+    each of which adds its own virtual root and terminal contacts.
+    """
+    if (self.contact_graph is not None):
+      return self.contact_graph
+
+    # Inverse of the labels, for getting the name of each node number
+    label_list = {v: k for k, v in self.labels.items()}
+
+    ## First, the vertices for the contact graph, one per contact.
+    # Their index is the same as the index of the contact in the plan
+    labels = [str(label_list[s]) + '-' + str(label_list[d]) for s, d in zip(self.src.tolist(), self.dst.tolist())]
+
+    ## Next, we get the edges connecting each vertex.
+    # A contact arriving to a node connects with the contacts leaving it, except the
+    # ones that go straight back and those that finish before a bundle could ever
+    # arrive through the first one. It is computed for each node with arrays
+    earliest_arrival = self.start + self.distance
+    by_destination = np.argsort(self.dst, kind='stable')
+    dest_counts = np.bincount(self.dst, minlength=self.n_vertices)
+    dest_offsets = np.concatenate(([0], np.cumsum(dest_counts)))
+    edge_parts = []
+    for node in range(self.n_vertices):
+      incoming = by_destination[dest_offsets[node]:dest_offsets[node+1]]
+      outgoing = self.node_contacts(node)
+      if (len(incoming) == 0 or len(outgoing) == 0): continue
+      connected = (self.dst[outgoing][None, :] != self.src[incoming][:, None]) \
+        & (self.end[outgoing][None, :] > earliest_arrival[incoming][:, None])
+      i, o = np.nonzero(connected)
+      edge_parts.append(np.stack((incoming[i], outgoing[o]), axis=1))
+    edges = np.concatenate(edge_parts).tolist() if edge_parts else []
 
     # With edges and vertices calculated,
     # and each with its properties,
     # Create the contact graph
-    g = contact_graph(n_vertices+1, edges) # Since we used n_vertices as an index starting from 0, we need to add one more to the count
-    g.add_attributes('start', start_times)
-    g.add_attributes('end', end_times)
-    g.add_attributes('distance', distances)
+    g = contact_graph(len(self.src), edges)
+    g.add_attributes('start', self.graph.es['start_time'])
+    g.add_attributes('end', self.graph.es['end_time'])
+    g.add_attributes('distance', self.graph.es['distance'])
     g.add_attributes('label', labels)
-    g.add_attributes('rate', rates)
+    g.add_attributes('rate', self.graph.es['rate'])
 
-    # Returns the contact graph calculated
+    # Stored, so it is calculated only once
+    self.contact_graph = g
     return g
 
+  def add_contact(self, edge: dict) -> int:
+    """
+    Add a contact to the plan, given like the edges of the time graph files.
+    It gets the next free index, so the indexes of the other contacts (and the
+    routes using them) don't change. Returns its index
+    """
+    source, destination = edge['contact']
+    c = len(self.src)
+    self.graph.add_edge(source, destination, contact=list(edge['contact']), start_time=edge['start_time'],
+                        end_time=edge['end_time'], distance=edge['distance'], rate=edge['rate'])
+    self.src = np.append(self.src, source)
+    self.dst = np.append(self.dst, destination)
+    self.start = np.append(self.start, float(edge['start_time']))
+    self.end = np.append(self.end, float(edge['end_time']))
+    self.distance = np.append(self.distance, float(edge['distance']))
+    self.rate = np.append(self.rate, float(edge['rate']))
+    self.volumes = self.rate * (self.end - self.start)
+    self.index_contacts()
+
+    # Connect it in the contact graph, if it was already built
+    if (self.contact_graph is not None):
+      incoming = np.nonzero(self.dst[:c] == source)[0]
+      predecessors = incoming[(self.src[incoming] != destination) & (self.end[c] > self.start[incoming] + self.distance[incoming])]
+      outgoing = self.node_contacts(destination)
+      successors = outgoing[(outgoing != c) & (self.dst[outgoing] != source) & (self.end[outgoing] > self.start[c] + self.distance[c])]
+      label_list = {v: k for k, v in self.labels.items()}
+      self.contact_graph.add_contact(str(label_list[source]) + '-' + str(label_list[destination]), edge['start_time'],
+                                     edge['end_time'], edge['distance'], edge['rate'], predecessors.tolist(), successors.tolist())
+    return c
+
+  def set_contact_times(self, contact: int, start_time: float, end_time: float) -> None:
+    """
+    Change when a contact of the plan starts and ends
+    """
+    self.graph.es[contact]['start_time'] = start_time
+    self.graph.es[contact]['end_time'] = end_time
+    self.start[contact] = start_time
+    self.end[contact] = end_time
+    self.volumes[contact] = self.rate[contact] * (end_time - start_time)
+    self.index_contacts()
+    if (self.contact_graph is not None):
+      self.contact_graph.update_contact(contact, start_time, end_time)
+
+  def shorten_contact(self, contact: int, start_time: float, end_time: float) -> None:
+    """
+    Make a contact of the plan start later and/or end earlier
+    """
+    if (start_time < self.start[contact] or end_time > self.end[contact] or start_time > end_time):
+      raise ValueError('Contact ' + str(contact) + ' can only be shortened, not extended')
+    self.set_contact_times(contact, start_time, end_time)
+
+  def cancel_contact(self, contact: int) -> None:
+    """
+    Cancel a contact of the plan. It is kept with no duration, so it can't be used
+    and the indexes of the other contacts don't change
+    """
+    start_time = self.graph.es[contact]['start_time']
+    self.set_contact_times(contact, start_time, start_time)
+
+  def apply_delta(self, delta: list) -> set:
+    """
+    Apply a list of changes to the contact plan. Each change is a dictionary with an 'action':
+    - 'add': with the same fields as the edges of the time graph files
+    - 'shorten': with the 'index' of the contact and its new 'start_time' and 'end_time'
+    - 'cancel': with the 'index' of the contact
+    The routes that use changed contacts are removed from the route table.
+    Returns the indexes of the contacts that changed
+    """
+    changed = set()
+    for change in delta:
+      action = change['action']
+      if (action == 'add'):
+        changed.add(self.add_contact(change))
+      elif (action == 'shorten'):
+        self.shorten_contact(change['index'], change['start_time'], change['end_time'])
+        changed.add(change['index'])
+      elif (action == 'cancel'):
+        self.cancel_contact(change['index'])
+        changed.add(change['index'])
+      else:
+        raise ValueError('Unknown contact plan change: ' + str(action))
+    self.route_table.discard_contacts(changed)
+    return changed
+
+  def arrivals_through(self, origin_node: str, contacts: list, start_time: float = 0) -> dict:
+    """
+    Earliest arrival time at each node, for routes from origin that go through one of the given contacts
+    """
+    return self.to_contact_graph().arrivals_through(origin_node, contacts, start_time)
+
+  def get_routes(self, origin_node: str, destination_node: str, K: int = 0, start_time: float = 0) -> list:
+    """
+    Get the first K routes from origin to destination, using the shared contact graph.
+    They are interned in the route table
+    """
+    routes = self.to_contact_graph().get_routes(origin_node, destination_node, K, start_time)
+    return [self.route_table.intern(r) for r in routes]
+
+  def get_all_routes(self, origin_node: str, K: int = 0, start_time: float = 0) -> dict:
+    """
+    Get the first K routes from origin to every other node. The best route
+    to each destination comes from a single route tree, computed once.
+    """
+    g = self.to_contact_graph()
+    tree = g.route_tree(origin_node, start_time)
+    routes = {}
+    for destination in self.labels:
+      if (destination == origin_node): continue
+      if (destination not in tree):
+        routes[destination] = []
+        continue
+      routes[destination] = [self.route_table.intern(r) for r in g.get_routes(origin_node, destination, K, start_time, first=tree[destination])]
+    return routes
+
 
 # ## Example
 # # Nodes
@@ -159,7 +277,7 @@ class time_evolving_graph:
 # a.plot(curved_edges=[False, True, False, False, True])
 
 # # Convert to contact graph
-# g = a.to_contact_graph('A','C')
-# # Get the routes and plot the graph
-# print(g.get_routes())
+# g = a.to_contact_graph()
+# # Get the routes from A to C and plot the graph
+# print(g.get_routes('A', 'C'))
 # g.plot()